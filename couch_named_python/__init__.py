@@ -2,30 +2,76 @@
 
 # Utility functions for view functions
 
-_current_vs = None
-_current_funcs = None
+_vs_funcs = {}
+_bound = []
 
 def _set_vs(vs, funcs=[]):
-    global _current_vs, _current_funcs
-    _current_vs = vs
-    _current_funcs = funcs
+    """bind the proxies named in funcs to vs, and unbind any others"""
+    global _bound
+
+    for f in _bound:
+        f.unbind()
+
+    if vs is None:
+        _bound = []
+    else:
+        _bound = [_vs_funcs[name] for name in funcs]
+        for f in _bound:
+            f.bind(vs)
+
+def _unavailable(*args, **kwargs):
+    raise AssertionError("This function is not available here")
 
 class VSFunc(object):
-    """A callable object that proxies calls to the view server object"""
+    """
+    A callable object that proxies calls to the view server object
+
+    _set_vs binds each VSFunc to the method of the same name on the view
+    server, if it is allowed; otherwise calls raise AssertionError. Only
+    the proxies that are allowed are bound (and later unbound), so that
+    commands that allow few of them are cheap to set up.
+    """
 
     def __init__(self, name):
         self.name = name
+        self.target = _unavailable
+        _vs_funcs[name] = self
 
-    def vs(self):
-        global _current_vs, _current_funcs
-        assert _current_vs
-        assert self.name in _current_funcs
-        return getattr(_current_vs, self.name)
+    def bind(self, vs):
+        self.target = getattr(vs, self.name)
+
+    def unbind(self):
+        self.target = _unavailable
 
     def __call__(self, *args, **kwargs):
-        return self.vs()(*args, **kwargs)
+        return self.target(*args, **kwargs)
+
+class EmitFunc(VSFunc):
+    """
+    The emit() proxy, which can append to a list of emissions directly
+
+    While a map function runs, the view server sets append to the append
+    method of its list of emissions, so that emit(key, value) costs one
+    call. Otherwise, it calls the view server's emit method (or raises
+    AssertionError, if emit is not allowed).
+    """
+
+    def bind(self, vs):
+        super(EmitFunc, self).bind(vs)
+        emit = self.target
+        self.append = lambda pair: emit(*pair)
+
+    def unbind(self):
+        super(EmitFunc, self).unbind()
+        self.append = _unavailable
+
+    def __call__(self, key, value):
+        self.append([key, value])
+
+emit = EmitFunc("emit")
+emit.append = _unavailable
 
-for funcname in ["emit", "log", "start", "send", "get_row"]:
+for funcname in ["log", "start", "send", "get_row", "memo"]:
     locals()[funcname] = VSFunc(funcname)
 del funcname
 
@@ -50,6 +96,48 @@ def get_version(func):
     except AttributeError:
         return None
 
+def pure(func):
+    """
+    A function decorator that marks a reduce function as 'pure'
+
+    A pure function's result depends only on its arguments, so the view
+    server may remember and reuse its results (see --rereduce-cache).
+    """
+    func._cnp_pure = True
+    return func
+
+def is_pure(func):
+    return getattr(func, "_cnp_pure", False)
+
+def vectorized(func):
+    """
+    A function decorator for reduce functions that use numpy
+
+    If numpy is installed and the values are all numbers (or lists of
+    numbers, all the same length), values is given to the function as a
+    numpy array rather than a list; otherwise it is a list, as usual.
+    numpy numbers and arrays in its result are converted to python ones.
+    The array is shared with other functions, so should not be modified.
+    """
+    func._cnp_vectorized = True
+    return func
+
+def is_vectorized(func):
+    return getattr(func, "_cnp_vectorized", False)
+
+def batch_filter(func):
+    """
+    A function decorator for filter functions that filter many docs at once
+
+    The function is called as func(docs, req), and should return a list of
+    booleans, one for each doc, rather than being called for each doc.
+    """
+    func._cnp_batch_filter = True
+    return func
+
+def is_batch_filter(func):
+    return getattr(func, "_cnp_batch_filter", False)
+
 class ForbiddenError(Exception):
     pass
 
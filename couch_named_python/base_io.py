@@ -1,13 +1,114 @@
 # Copyright 2011 (C) Daniel Richman; GNU GPL 3
 
 import sys
+import os
+import select
 import traceback
+from collections import deque
 
-try:
-    # C speedups!
-    import simplejson as json
-except ImportError:
-    import json
+from .jsoncodec import get_codec
+
+class ProtocolError(ValueError):
+    """input that isn't a command we understand: always fatal"""
+
+class RequestError(Exception):
+    """
+    A command failed, and ["error", error, reason] should be sent
+
+    The view server carries on with the next command.
+    """
+
+    def __init__(self, error, reason):
+        super(RequestError, self).__init__(error, reason)
+        self.error = error
+        self.reason = reason
+
+class LineReader(object):
+    """
+    Reads lines from a file descriptor, using large os.read calls
+
+    before_block, if given, is called before each os.read (i.e., whenever
+    the reader may be about to wait for more input). This is where a
+    BufferedWriter should be flushed.
+    """
+
+    def __init__(self, fd, read_size=65536, before_block=None):
+        self.fd = fd
+        self.read_size = read_size
+        self.before_block = before_block
+
+        self.lines = deque()
+        self.partial = []
+        self.eof = False
+
+    def fileno(self):
+        return self.fd
+
+    def _fill(self):
+        """read from fd, splitting the data into self.lines"""
+        if self.before_block is not None:
+            self.before_block()
+
+        data = os.read(self.fd, self.read_size)
+        if not data:
+            self.eof = True
+            return
+
+        self.partial.append(data)
+        if "\n" in data:
+            parts = "".join(self.partial).split("\n")
+            rest = parts.pop()
+            self.partial = [rest] if rest else []
+            self.lines.extend(part + "\n" for part in parts)
+
+    def readline(self):
+        """return a line, including the newline, or "" at end of file"""
+        while not self.lines and not self.eof:
+            self._fill()
+
+        if self.lines:
+            return self.lines.popleft()
+        else:
+            rest = "".join(self.partial)
+            self.partial = []
+            return rest
+
+    def ready(self):
+        """True if readline can (probably) return without blocking"""
+        return bool(self.lines) or self.eof or \
+               bool(select.select([self.fd], [], [], 0)[0])
+
+class BufferedWriter(object):
+    """
+    Collects output, writing it to a file descriptor when flushed
+
+    The buffer is also flushed if it grows larger than max_size.
+    """
+
+    def __init__(self, fd, max_size=1048576):
+        self.fd = fd
+        self.max_size = max_size
+        self.buffer = []
+        self.size = 0
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.flush()
+
+    def flush(self):
+        """write everything that has been buffered"""
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+        while data:
+            n = os.write(self.fd, data)
+            data = data[n:]
 
 class BaseViewServer(object):
     """
@@ -38,15 +139,48 @@ class BaseViewServer(object):
      - exception: reports the exception currently being handled to CouchDB
      - log: sends a log message to CouchDB
 
+    If a command raises an exception, it is reported with error() and the
+    view server carries on, so that it (and everything it has imported)
+    stays warm. Raise RequestError to choose the error and reason. Only
+    input that can't be understood (ProtocolError) is fatal, since the
+    view server and CouchDB may no longer agree on what comes next.
+
     Finally, note that add_ddoc, use_ddoc and set_lib are not actual commands
     from CouchDB. Instead, these are called from the helper functions ddoc and
     add_lib. You may wish to overide these instead if you do not like the
     helper behaviour
     """
 
-    def __init__(self, stdin, stdout):
+    map_doc_prefix = '["map_doc"'
+
+    def __init__(self, stdin, stdout, batch=0, codec=None, profiler=None,
+                 recorder=None):
+        """
+        stdin, stdout: where to read and write data
+        batch: if nonzero, map_doc commands already waiting on stdin are
+               handled together, at most batch at a time; stdin should
+               then be a LineReader, since lines that a file object has
+               buffered can't be seen to be waiting
+        codec: a jsoncodec.Codec, or the name of one (see get_codec)
+        profiler: a profiler.Profiler, to collect statistics
+        recorder: a recorder.Recorder, to write a transcript to; it is
+                  closed when run() returns
+        """
+
         self.stdin = stdin
         self.stdout = stdout
+        self.batch = batch
+        self.profiler = profiler
+        self.recorder = recorder
+        self._command = None
+
+        if codec is None or isinstance(codec, basestring):
+            codec = get_codec(codec)
+        self.codec = codec
+
+        self._pending = deque()
+        self._out_buffer = None
+        self._input_line_length = 0
 
         self.commands = ["ddoc", "reset", "add_fun", "add_lib", "map_doc",
                          "reduce", "rereduce"]
@@ -54,7 +188,7 @@ class BaseViewServer(object):
     def handle_input(self, cmd_name, *args):
         """Call the correct method(*args), checking cmd_name first"""
         if cmd_name not in self.commands:
-            raise ValueError("Unknown command: " + cmd_name)
+            raise ProtocolError("Unknown command: {0!r}".format(cmd_name))
         getattr(self, cmd_name)(*args)
 
     def ddoc(self, *args):
@@ -100,6 +234,34 @@ class BaseViewServer(object):
         """run all map functions on a document"""
         raise NotImplementedError
 
+    def map_docs(self, docs):
+        """
+        run map_doc on several documents, writing the output in one go
+
+        The responses are written in order, in one write call.
+        """
+        self._out_buffer = []
+        try:
+            for doc in docs:
+                self.map_doc_or_error(doc)
+        finally:
+            (lines, self._out_buffer) = (self._out_buffer, None)
+            self.stdout.write(''.join(lines))
+
+    def map_doc_or_error(self, doc):
+        """
+        map_doc(doc), responding with an error if it raises an exception
+
+        Each document in a batch gets exactly one response, so that
+        CouchDB and the view server stay in step.
+        """
+        try:
+            self.map_doc(doc)
+        except Exception:
+            self.abort()
+            self.exception("map_doc_runtime_error", fatal=False,
+                           respond=True)
+
     def reduce(self, funcs, data):
         """run reduce functions on some data"""
         raise NotImplementedError
@@ -108,11 +270,17 @@ class BaseViewServer(object):
         """run reduce functions on some reduce function outputs"""
         raise NotImplementedError
 
-    def exception(self, where="unhandled exception", fatal=True,
-                  doc_id=None, func=None, log_traceback=None):
-        """report the current exception to couchdb, and exit if it's fatal"""
-        exc_tb = traceback.format_exc()
-        info = exc_tb.splitlines()[-1].strip()
+    def profile_stats(self):
+        """extra statistics to include in profiler reports"""
+        return {}
+
+    def abort(self):
+        """clean up after a command that raised an exception"""
+        pass
+
+    def exception_info(self, doc_id=None, func=None):
+        """a one line description of the current exception"""
+        info = traceback.format_exc().splitlines()[-1].strip()
 
         if doc_id:
             info += ", doc_id=" + doc_id
@@ -121,30 +289,62 @@ class BaseViewServer(object):
         if func and hasattr(func, "__module__"):
             info += ", func_mod=" + func.__module__
 
+        return info
+
+    def exception(self, where="unhandled exception", fatal=True,
+                  doc_id=None, func=None, log_traceback=None, respond=None):
+        """
+        report the current exception to couchdb, and exit if it's fatal
+
+        respond: send ["error", where, info] (the default if fatal);
+                 otherwise, it is only logged as ignored
+        """
+        info = self.exception_info(doc_id, func)
+
+        if respond is None:
+            respond = fatal
         if log_traceback is None:
-            log_traceback = fatal
+            log_traceback = respond
 
         if log_traceback:
-            self.log(exc_tb)
+            self.log(traceback.format_exc())
 
-        if fatal:
-            self.output("error", where, info)
-            sys.exit(1)
+        if respond:
+            self.error(where, info)
         else:
             self.log("Ignored exception ({0}): {1}".format(where, info))
 
+        if fatal:
+            sys.exit(1)
+
+    def error(self, error, reason):
+        """send an error response to couchdb"""
+        self.output("error", error, reason)
+
     def log(self, string):
         """send a log message to couchdb"""
         self.output("log", string)
 
     def single(self, obj, limit=None):
         """print out a single json object"""
-        line = json.dumps(obj) + "\n"
+        line = self.codec.dumps(obj) + "\n"
 
         if limit != None and len(line) > limit:
             raise ValueError("Output line length is above the limit")
 
-        self.stdout.write(line)
+        self.write(line)
+
+    def write(self, line):
+        """write out a line that has already been encoded"""
+        if self.profiler is not None:
+            self.profiler.count_out(self._command, len(line))
+        if self.recorder is not None:
+            self.recorder.record_out(line)
+
+        if self._out_buffer is not None:
+            self._out_buffer.append(line)
+        else:
+            self.stdout.write(line)
 
     def okay(self, **kwargs):
         """report success with no output"""
@@ -155,23 +355,114 @@ class BaseViewServer(object):
         self.single(args, **kwargs)
 
     def read_line(self):
-        line = self.stdin.readline()
+        if self._pending:
+            line = self._pending.popleft()
+        else:
+            line = self.stdin.readline()
         self._input_line_length = len(line)
 
         if not line:
             return None
-        else:
-            return json.loads(line)
+
+        obj = self._decode(line)
+        if self.recorder is not None:
+            self.recorder.record_in(line, obj)
+        if self.profiler is not None and isinstance(obj, list) and obj:
+            self._command = obj[0]
+            self.profiler.count_in(self._command, len(line))
+        return obj
+
+    def _decode(self, line):
+        try:
+            obj = self.codec.loads(line)
+        except Exception as e:
+            raise ProtocolError("Invalid JSON: {0}".format(e))
+        if not isinstance(obj, list) or not obj:
+            raise ProtocolError("Expected a command, got {0!r}"
+                                .format(line[:100]))
+        return obj
+
+    def _input_ready(self):
+        """True if stdin can be read without blocking"""
+        if isinstance(self.stdin, LineReader):
+            return self.stdin.ready()
+        return bool(select.select([self.stdin], [], [], 0)[0])
+
+    def _read_ahead(self):
+        """move lines that can be read without blocking into self._pending"""
+        while len(self._pending) < self.batch - 1 and self._input_ready():
+            line = self.stdin.readline()
+            self._pending.append(line)
+            if not line:
+                break
+
+    def _map_batch(self, doc):
+        """handle a map_doc command, and any others already waiting"""
+        self._read_ahead()
+
+        lines = []
+        while self._pending and \
+                self._pending[0].startswith(self.map_doc_prefix):
+            lines.append(self._pending.popleft())
+
+        docs = [doc]
+        for line in lines:
+            obj = self._decode(line)
+            if self.recorder is not None:
+                # recorded (or not) with the first
+                self.recorder.record_in(line, obj, continued=True)
+            docs.append(obj[1])
+
+        if self.profiler is not None:
+            for line in lines:
+                self.profiler.count_in("map_doc", len(line))
+        self.map_docs(docs)
 
     def run(self):
         """run until self.stdin is closed, reading and handling commands"""
+        try:
+            self._run()
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+
+    def _run(self):
         while True:
             try:
                 obj = self.read_line()
-                if obj == None:
-                    break
-                self.handle_input(*obj)
             except SystemExit:
                 raise
+            except:
+                self.exception("query_protocol_error")
+
+            if obj == None:
+                break
+
+            try:
+                if self.batch and obj[0] == "map_doc":
+                    self._map_batch(*obj[1:])
+                else:
+                    self.handle_input(*obj)
+            except SystemExit:
+                raise
+            except ProtocolError:
+                self.exception("query_protocol_error")
+            except RequestError as e:
+                self.abort()
+                self.error(e.error, e.reason)
+            except Exception:
+                self.abort()
+                self.exception(_error_name(obj), fatal=False, respond=True)
             except:
                 self.exception()
+
+            if self.profiler is not None and self.profiler.report_due():
+                self.profiler.report(self.log, self.profile_stats())
+
+def _error_name(command):
+    """the error to report for an exception raised by command"""
+    name = command[0]
+    if name == "ddoc" and len(command) > 2 and \
+            isinstance(command[2], list) and command[2]:
+        name = command[2][0]
+    return "{0}_runtime_error".format(name)
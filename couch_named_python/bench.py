@@ -0,0 +1,311 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+"""
+Benchmarks for the view server.
+
+    python -m couch_named_python.bench [--docs N] [--funcs N]
+
+map_doc is run over synthetic documents with a mix of emit()-style and
+generator-style map functions, and the throughput printed in docs/sec.
+Output is discarded, so this measures the view server and not the pipe.
+
+    python -m couch_named_python.bench --replay FILE [--format json]
+    python -m couch_named_python.bench --synthetic [--docs N] [--funcs N]
+
+replays a transcript of protocol input (see read_transcript), or a
+synthetic one using every kind of command (see make_transcript), through
+a NamedPythonViewServer reading from and writing to memory. Reported are
+commands, docs and bytes (in and out) per second, and the latency of each
+kind of command ("map_doc", "reduce", "ddoc shows", ...); with --format
+json, as a JSON object, for keeping track of regressions.
+"""
+
+import sys
+import time
+import gzip
+import json
+import optparse
+from StringIO import StringIO
+from collections import defaultdict
+
+from . import emit, send, get_row
+from .pyviews import BasePythonViewServer, NamedPythonViewServer
+from .profiler import Histogram
+from .jsoncodec import get_codec
+
+def map_emit(doc):
+    emit(doc["_id"], doc["n"])
+    emit([doc["type"], doc["n"]], None)
+
+def map_yield(doc):
+    yield doc["_id"], doc["n"]
+    yield [doc["type"], doc["n"]], None
+
+def show_doc(doc, req):
+    return {"body": doc["_id"], "headers": {"Content-Type": "text/plain"}}
+
+def list_ids(head, req):
+    while True:
+        row = get_row()
+        if row is None:
+            break
+        send(row["id"] + "\n")
+
+def filter_even(doc, req):
+    return doc["n"] % 2 == 0
+
+def update_touch(doc, req):
+    doc["touched"] = True
+    return [doc, "touched"]
+
+def validate_n(newdoc, olddoc, userctx, secobj):
+    assert isinstance(newdoc["n"], int)
+
+class NullWriter(object):
+    """a stdout that discards everything written to it"""
+    def write(self, data):
+        pass
+
+class CountingWriter(object):
+    """a stdout that counts the bytes written to it, and discards them"""
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+class BenchViewServer(BasePythonViewServer):
+    """a view server whose functions are looked up in a dict"""
+
+    functions = {"map_emit": map_emit, "map_yield": map_yield}
+
+    def compile(self, function):
+        return self.functions[function]
+
+def make_docs(count):
+    """produce count small documents"""
+    return [{"_id": "doc{0}".format(i), "_rev": "1-abc", "n": i,
+             "type": "type{0}".format(i % 7)} for i in xrange(count)]
+
+def bench_map_doc(docs=20000, funcs=12):
+    """time map_doc over docs documents with funcs map functions"""
+    vs = BenchViewServer(None, NullWriter())
+    names = sorted(BenchViewServer.functions)
+    for i in xrange(funcs):
+        vs.add_fun(names[i % len(names)])
+
+    documents = make_docs(docs)
+
+    start = time.time()
+    for doc in documents:
+        vs.map_doc(doc)
+    elapsed = max(time.time() - start, 1e-6)
+
+    return {"docs": docs, "funcs": funcs, "seconds": elapsed,
+            "docs_per_sec": docs / elapsed}
+
+def command_label(command):
+    """the kind of a command, e.g. "map_doc" or "ddoc shows" """
+    if command[0] != "ddoc":
+        return command[0]
+    elif command[1] == "new":
+        return "ddoc new"
+    else:
+        return "ddoc " + command[2][0]
+
+class ReplayViewServer(NamedPythonViewServer):
+    """a view server that times each command, and counts documents"""
+
+    def __init__(self, *args, **kwargs):
+        super(ReplayViewServer, self).__init__(*args, **kwargs)
+        self.latencies = defaultdict(Histogram)
+        self.docs = 0
+
+    def handle_input(self, cmd_name, *args):
+        label = command_label((cmd_name, ) + args)
+        start = time.time()
+        try:
+            super(ReplayViewServer, self).handle_input(cmd_name, *args)
+        finally:
+            self.latencies[label].add(time.time() - start)
+
+        if label == "map_doc":
+            self.docs += 1
+        elif label == "ddoc filters":
+            self.docs += len(args[2][0])
+
+def read_transcript(filename):
+    """
+    the commands in a transcript file (which may be gzipped, as .gz)
+
+    Each line is either a command, as CouchDB would send it, or a record
+    [time, "in", command] or [time, "out", response], as written by
+    couch-named-python --record. Responses are skipped.
+    """
+
+    if filename.endswith(".gz"):
+        f = gzip.open(filename)
+    else:
+        f = open(filename)
+
+    commands = []
+    with f:
+        for line in f:
+            obj = json.loads(line)
+            if isinstance(obj[0], basestring):
+                commands.append(obj)
+            elif obj[1] == "in":
+                commands.append(obj[2])
+    return commands
+
+def make_transcript(docs=1000, funcs=4, batch=100):
+    """
+    produce a synthetic transcript, using every kind of command
+
+    A view with funcs map functions is built over docs documents, and
+    reduced and rereduced, batch rows at a time; each batch of documents
+    is then filtered, and its first document shown, updated and validated.
+    Finally, a list function is run over every document.
+    """
+
+    prefix = "couch_named_python.bench."
+    reducers = ["couch_named_python.reducers.sum|1",
+                "couch_named_python.reducers.count|1"]
+    ddoc_id = "_design/bench"
+    ddoc = {"_id": ddoc_id, "language": "python",
+            "shows": {"doc": prefix + "show_doc"},
+            "lists": {"ids": prefix + "list_ids"},
+            "filters": {"even": prefix + "filter_even"},
+            "updates": {"touch": prefix + "update_touch"},
+            "validate_doc_update": prefix + "validate_n"}
+    req = {"method": "GET", "query": {}, "headers": {}}
+    names = sorted(BenchViewServer.functions)
+    documents = make_docs(docs)
+
+    commands = [["reset", {"reduce_limit": True}]]
+    commands += [["add_fun", prefix + names[i % len(names)]]
+                 for i in xrange(funcs)]
+    commands += [["map_doc", doc] for doc in documents]
+
+    reductions = []
+    for i in xrange(0, docs, batch):
+        rows = [[[doc["_id"], doc["_id"]], doc["n"]]
+                for doc in documents[i:i + batch]]
+        commands.append(["reduce", reducers, rows])
+        reductions.append(sum(doc["n"] for doc in documents[i:i + batch]))
+    commands.append(["rereduce", reducers[:1], reductions])
+
+    commands.append(["ddoc", "new", ddoc_id, ddoc])
+    for i in xrange(0, docs, batch):
+        chunk = documents[i:i + batch]
+        commands.append(["ddoc", ddoc_id, ["filters", "even"],
+                         [chunk, req]])
+        commands.append(["ddoc", ddoc_id, ["shows", "doc"],
+                         [chunk[0], req]])
+        commands.append(["ddoc", ddoc_id, ["updates", "touch"],
+                         [chunk[0], req]])
+        commands.append(["ddoc", ddoc_id, ["validate_doc_update"],
+                         [chunk[0], chunk[0], {"name": None}, {}]])
+
+    commands.append(["ddoc", ddoc_id, ["lists", "ids"],
+                     [{"total_rows": docs, "offset": 0}, req]])
+    commands += [["list_row", {"id": doc["_id"], "key": doc["_id"],
+                               "value": doc["n"]}] for doc in documents]
+    commands.append(["list_end"])
+
+    return commands
+
+def replay(commands, codec=None):
+    """
+    run commands through a ReplayViewServer, returning statistics
+
+    The commands are encoded in advance, and the output discarded.
+    """
+
+    if codec is None or isinstance(codec, basestring):
+        codec = get_codec(codec)
+
+    data = "".join(codec.dumps(command) + "\n" for command in commands)
+    stdout = CountingWriter()
+    vs = ReplayViewServer(StringIO(data), stdout, codec=codec)
+
+    exit_code = None
+    start = time.time()
+    try:
+        vs.run()
+    except SystemExit as e:
+        exit_code = e.code
+    elapsed = max(time.time() - start, 1e-6)
+
+    count = sum(h.count for h in vs.latencies.values())
+    return {"codec": codec.name, "exit_code": exit_code,
+            "seconds": elapsed,
+            "commands": count, "commands_per_sec": count / elapsed,
+            "docs": vs.docs, "docs_per_sec": vs.docs / elapsed,
+            "bytes_in": len(data), "bytes_out": stdout.bytes,
+            "bytes_per_sec": (len(data) + stdout.bytes) / elapsed,
+            "latency": dict((label, h.summary())
+                            for (label, h) in vs.latencies.items())}
+
+def format_replay(result):
+    """replay() results, as text"""
+    lines = ["{commands} commands in {seconds:.3f}s: "
+             "{commands_per_sec:.0f} commands/sec, {docs_per_sec:.0f} "
+             "docs/sec, {bytes_per_sec:.0f} bytes/sec".format(**result)]
+    if result["exit_code"] is not None:
+        lines.append("view server exited: {0}".format(result["exit_code"]))
+    for label in sorted(result["latency"]):
+        lines.append("{0:>24}: {calls:8} calls, p50 {p50_ms:.3f}ms, "
+                     "p99 {p99_ms:.3f}ms, max {max_ms:.3f}ms".format(
+                         label, p50_ms=result["latency"][label]["p50"] * 1e3,
+                         p99_ms=result["latency"][label]["p99"] * 1e3,
+                         max_ms=result["latency"][label]["max"] * 1e3,
+                         **result["latency"][label]))
+    return "\n".join(lines)
+
+usage = "%prog [options]"
+oparser = optparse.OptionParser(usage=usage)
+oparser.add_option("--docs", dest="docs", type="int", default=20000,
+                   help="Number of documents to map")
+oparser.add_option("--funcs", dest="funcs", type="int", default=12,
+                   help="Number of map functions")
+oparser.add_option("--replay", dest="replay", default=None, metavar="FILE",
+                   help="Replay the commands in a transcript")
+oparser.add_option("--synthetic", dest="synthetic", action="store_true",
+                   default=False,
+                   help="Replay a synthetic transcript of --docs documents "
+                        "and --funcs map functions")
+oparser.add_option("--codec", dest="codec", default=None, metavar="NAME",
+                   help="JSON codec for the view server to use (as for "
+                        "couch-named-python --json)")
+oparser.add_option("--format", dest="format", default="text",
+                   choices=["text", "json"],
+                   help="Print results as text (default) or json")
+
+def main():
+    """main method for python -m couch_named_python.bench"""
+    (options, args) = oparser.parse_args()
+
+    if options.replay or options.synthetic:
+        if options.replay:
+            commands = read_transcript(options.replay)
+        else:
+            commands = make_transcript(options.docs, options.funcs)
+        result = replay(commands, options.codec)
+        if options.format == "json":
+            json.dump(result, sys.stdout, indent=1, sort_keys=True,
+                      separators=(',', ': '))
+            print
+        else:
+            print format_replay(result)
+        return
+
+    result = bench_map_doc(options.docs, options.funcs)
+    if options.format == "json":
+        print json.dumps(result, sort_keys=True)
+    else:
+        print "map_doc: {docs} docs, {funcs} functions, {seconds:.3f}s, " \
+              "{docs_per_sec:.0f} docs/sec".format(**result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+class LRUCache(object):
+    """
+    A bounded dict-like cache, discarding the least recently used item
+
+    Lookups made with get() or [] update the hits and misses counters;
+    items pushed out because the cache is full are counted in evictions.
+    A maxsize of None means the cache is unbounded.
+
+    Items may also expire ttl seconds after they are set (by default,
+    never); looking up an expired item counts as a miss, and in
+    expirations. If maxbytes is set, items are also evicted while the
+    total of their sizes in bytes (given to set(); by default 0) is larger,
+    although the most recently set item is always kept.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.items = OrderedDict()
+        self.expiry = {}
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """return the cached value for key (marking it used), or default"""
+        value = self.items.pop(key, _missing)
+
+        if value is not _missing and self.expiry:
+            expires = self.expiry.get(key)
+            if expires is not None and expires <= time.time():
+                del self.expiry[key]
+                self.bytes -= self.sizes.pop(key, 0)
+                self.expirations += 1
+                value = _missing
+
+        if value is _missing:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.items[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None, nbytes=0):
+        """
+        cache value, expiring after ttl seconds (default: self.ttl)
+
+        nbytes is its (approximate) size, which counts towards maxbytes.
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+
+        self.items.pop(key, None)
+        self.items[key] = value
+        if ttl is not None:
+            self.expiry[key] = time.time() + ttl
+        elif self.expiry:
+            self.expiry.pop(key, None)
+        if nbytes or key in self.sizes:
+            self.bytes += nbytes - self.sizes.pop(key, 0)
+            if nbytes:
+                self.sizes[key] = nbytes
+
+        while (self.maxsize is not None and len(self.items) > self.maxsize) \
+                or (self.maxbytes is not None and self.bytes > self.maxbytes
+                    and len(self.items) > 1):
+            (old, v) = self.items.popitem(last=False)
+            self.expiry.pop(old, None)
+            self.bytes -= self.sizes.pop(old, 0)
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        del self.items[key]
+        self.expiry.pop(key, None)
+        self.bytes -= self.sizes.pop(key, 0)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        """discard every item (the counters are not reset)"""
+        self.items.clear()
+        self.expiry.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    def keys(self):
+        return self.items.keys()
+
+    def values(self):
+        return self.items.values()
+
+    def nbytes(self, key):
+        """the size that key was set with"""
+        return self.sizes.get(key, 0)
+
+    def stats(self):
+        """a dict of the counters, suitable for logging"""
+        return {"size": len(self.items), "maxsize": self.maxsize,
+                "bytes": self.bytes, "maxbytes": self.maxbytes,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations}
@@ -0,0 +1,132 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+"""
+JSON encoding and decoding for the view server protocol.
+
+A codec turns python objects into protocol lines (without the trailing
+newline) and back. Several backends are provided, from fastest to
+slowest: ujson, simplejson and the standard library's json.
+
+All codecs produce the same compact, ASCII-only output (non-ASCII
+characters are escaped), which is checked by check_codec() before a codec
+is used. get_codec() picks the named backend,
+or the CNP_JSON_CODEC environment variable, or the fastest available
+backend that passes the self test ("auto").
+"""
+
+import os
+
+class Codec(object):
+    """Base class: encodes and decodes protocol lines"""
+
+    name = None
+
+    def dumps(self, obj):
+        """encode obj as a single line of JSON (a str)"""
+        raise NotImplementedError
+
+    def loads(self, line):
+        """decode a line of JSON"""
+        raise NotImplementedError
+
+class UjsonCodec(Codec):
+    """
+    ujson
+
+    ujson 1.x (the last for python 2) rounds floats to at most 15
+    significant digits, so fails check_codec, and is never used.
+    """
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+        self.loads = ujson.loads
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, escape_forward_slashes=False)
+
+class _EncoderCodec(Codec):
+    """codecs for modules with the json.JSONEncoder interface"""
+
+    module = None
+
+    def __init__(self):
+        json = __import__(self.module)
+        self.dumps = json.JSONEncoder(separators=(',', ':')).encode
+        self.loads = json.loads
+
+class SimplejsonCodec(_EncoderCodec):
+    name = "simplejson"
+    module = "simplejson"
+
+class StdlibCodec(_EncoderCodec):
+    name = "json"
+    module = "json"
+
+codecs = [UjsonCodec, SimplejsonCodec, StdlibCodec]
+
+check_objects = [
+    True,
+    ["log", "a log message"],
+    ["error", "not_found", u"caf\u00e9 \u4e2d\u6587"],
+    [[["key", 1], {"value": [1, -2, 2.5, 0.1, None, False]}], []],
+    [True, [12345678901234, -1.75, {"sum": 0, "count": 4}]],
+    [1.0 / 3, 1e-20, 1e300, 1.5e-07, 12345678.123456789, -2.0 / 3, 2 ** 63],
+    ["resp", {"body": "<p>\"quoted\" / slash \\ tab\t newline\n</p>",
+              "headers": {"Content-Type": "text/html"}}],
+]
+
+def check_codec(codec, reference=None):
+    """
+    check that codec produces byte-identical output to the reference
+
+    Raises ValueError if it does not, or if it decodes a line differently
+    or loses anything (e.g., the precision of floats) in a round trip.
+    """
+
+    if reference is None:
+        reference = StdlibCodec()
+
+    for obj in check_objects:
+        expect = reference.dumps(obj)
+        line = codec.dumps(obj)
+        if line != expect:
+            raise ValueError("JSON codec {0} output {1!r} differs from "
+                             "{2!r}".format(codec.name, line, expect))
+        if codec.loads(expect) != reference.loads(expect) or \
+                codec.loads(line) != obj:
+            raise ValueError("JSON codec {0} decoded {1!r} "
+                             "incorrectly".format(codec.name, expect))
+
+def get_codec(name=None):
+    """
+    get a codec by name, which should be "auto" or the name of a backend
+
+    If name is None, the CNP_JSON_CODEC environment variable is used,
+    defaulting to "auto". Raises ImportError if the backend is not
+    installed and ValueError if it fails check_codec().
+    """
+
+    if name is None:
+        name = os.environ.get("CNP_JSON_CODEC", "auto")
+
+    if name == "auto":
+        for cls in codecs:
+            try:
+                codec = cls()
+                check_codec(codec)
+            except (ImportError, ValueError):
+                continue
+            else:
+                return codec
+        raise ImportError("No usable JSON codec")
+
+    for cls in codecs:
+        if cls.name == name:
+            codec = cls()
+            check_codec(codec)
+            return codec
+
+    raise ValueError("Unknown JSON codec: " + name)
@@ -0,0 +1,90 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+"""
+Startup manifests, and timing of imports at startup.
+
+A manifest lists the functions that the view server should import and
+check before it reads its first command, one module.function|version per
+line. Blank lines and lines starting with # are ignored. cnp-upload
+--manifest writes one for the design docs that it uploads; pass it to
+couch-named-python --manifest.
+"""
+
+import sys
+import time
+import __builtin__
+
+builtin_reduces = ["_sum", "_count", "_stats", "_approx_count_distinct"]
+
+def design_doc_functions(doc):
+    """yield each function path in a design doc (as uploaded)"""
+
+    for func_type in ["shows", "lists", "filters", "updates"]:
+        for key in sorted(doc.get(func_type, {})):
+            yield doc[func_type][key]
+
+    if "validate_doc_update" in doc:
+        yield doc["validate_doc_update"]
+
+    for key in sorted(doc.get("views", {})):
+        view = doc["views"][key]
+        if "map" in view:
+            yield view["map"]
+        if "reduce" in view and view["reduce"] not in builtin_reduces:
+            yield view["reduce"]
+
+def read_manifest(filename):
+    """the list of function paths in a manifest file"""
+    functions = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                functions.append(line)
+    return functions
+
+def write_manifest(filename, functions):
+    """write each of functions (without duplicates) to a manifest file"""
+    with open(filename, "w") as f:
+        f.write("# couch-named-python startup manifest\n")
+        for function in sorted(set(functions)):
+            f.write(function + "\n")
+
+class ImportTimer(object):
+    """
+    Records how long each module took to import, while started
+
+    Times exclude the time spent importing other modules from within that
+    module, and only imports that loaded something new are recorded.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self._import = None
+        self._children = []
+
+    def start(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+
+    def stop(self):
+        __builtin__.__import__ = self._import
+
+    def _timed_import(self, name, *args, **kwargs):
+        before = len(sys.modules)
+        self._children.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children = self._children.pop()
+            if self._children:
+                self._children[-1] += elapsed
+            if len(sys.modules) > before:
+                self.times[name] = self.times.get(name, 0.0) + \
+                                   elapsed - children
+
+    def report(self):
+        """{"total": seconds, "modules": {name: seconds}}"""
+        return {"total": sum(self.times.values()), "modules": self.times}
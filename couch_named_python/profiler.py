@@ -0,0 +1,159 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+"""
+Optional instrumentation for the view server.
+
+A Profiler counts calls, total time and latency percentiles for each
+function, and bytes read and written for each command. The view server
+reports it when asked to (e.g., on SIGUSR1), or every interval seconds,
+either to a file (as JSON) or to CouchDB's log.
+"""
+
+import math
+import time
+import json
+from collections import defaultdict
+
+from . import get_version
+
+class Histogram(object):
+    """
+    Latencies, counted in logarithmic buckets (each 10% wider)
+
+    Percentiles are therefore accurate to about 10%.
+    """
+
+    step = math.log(1.1)
+    smallest = 1e-7
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds < self.smallest:
+            seconds = self.smallest
+        self.buckets[int(math.floor(math.log(seconds) / self.step))] += 1
+
+    def percentile(self, p):
+        """the latency (upper bound) below which p percent of calls fell"""
+        if not self.count:
+            return None
+
+        target = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                break
+        return min(math.exp((bucket + 1) * self.step), self.max)
+
+    def summary(self):
+        return {"calls": self.count, "total": self.total,
+                "p50": self.percentile(50), "p99": self.percentile(99),
+                "max": self.max}
+
+def function_key(func, prefix):
+    """a name for func, like "map my.module.func|3" """
+    key = "{0} {1}.{2}".format(prefix, getattr(func, "__module__", None),
+                               getattr(func, "__name__", repr(func)))
+    version = get_version(func)
+    if version is not None:
+        key += "|" + str(version)
+    return key
+
+class Profiler(object):
+    """
+    Records function latencies and per-command byte counts
+
+    filename: where report() should write to; if None, it is logged
+    interval: if set, report every interval seconds
+    """
+
+    def __init__(self, filename=None, interval=None):
+        self.filename = filename
+        self.interval = interval
+        self.functions = defaultdict(Histogram)
+        self.commands = defaultdict(lambda: {"count": 0, "bytes_in": 0,
+                                             "bytes_out": 0})
+        self.report_requested = False
+        self.last_report = time.time()
+        self._keys = {}
+
+    def key(self, func, prefix):
+        """function_key(func, prefix), remembered"""
+        try:
+            return self._keys[prefix, func]
+        except KeyError:
+            k = self._keys[prefix, func] = function_key(func, prefix)
+            return k
+
+    def record(self, key, seconds):
+        """record a call to the function named key"""
+        self.functions[key].add(seconds)
+
+    def wrap(self, key, func):
+        """wrap func, so that calls to it are recorded"""
+        histogram = self.functions[key]
+        clock = time.time
+
+        def timed(*args):
+            start = clock()
+            try:
+                return func(*args)
+            finally:
+                histogram.add(clock() - start)
+
+        return timed
+
+    def count_in(self, command, length):
+        c = self.commands[command]
+        c["count"] += 1
+        c["bytes_in"] += length
+
+    def count_out(self, command, length):
+        self.commands[command]["bytes_out"] += length
+
+    def request_report(self, *args):
+        """ask for a report after the current command (a signal handler)"""
+        self.report_requested = True
+
+    def report_due(self):
+        if self.report_requested:
+            return True
+        if self.interval is not None:
+            return time.time() - self.last_report >= self.interval
+        return False
+
+    def stats(self):
+        """all of the statistics, as a dict"""
+        return {"time": time.time(),
+                "functions": dict((k, h.summary())
+                                  for (k, h) in self.functions.items()),
+                "commands": dict(self.commands)}
+
+    def report(self, log, extra=None):
+        """
+        write stats() (updated with extra) to self.filename, or log them
+
+        log is the view server's log method
+        """
+
+        stats = self.stats()
+        if extra:
+            stats.update(extra)
+
+        if self.filename is not None:
+            with open(self.filename, "w") as f:
+                json.dump(stats, f, indent=1, sort_keys=True)
+        else:
+            log("profile: " + json.dumps(stats, sort_keys=True))
+
+        self.report_requested = False
+        self.last_report = time.time()
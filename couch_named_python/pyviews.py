@@ -2,36 +2,159 @@
 
 import sys
 import os
-import inspect
+import time
+import types
+import optparse
 import base_io
+from .cache import LRUCache
+from .manifest import read_manifest, ImportTimer
 
-from . import _set_vs, get_version, ForbiddenError, UnauthorizedError, \
-        NotFoundError, Redirect
+from . import _set_vs, get_version, is_pure, is_vectorized, \
+        is_batch_filter, ForbiddenError, UnauthorizedError, NotFoundError, \
+        Redirect, emit as emit_proxy
+
+CO_GENERATOR = 0x20
+
+_missing = object()
+
+def _is_generator(func):
+    """inspect.isgeneratorfunction(func), without importing inspect"""
+    code = getattr(func, "__code__", None)
+    return code is not None and bool(code.co_flags & CO_GENERATOR)
+
+_numpy = None
+
+def _import_numpy():
+    """numpy, or None if it is not installed (imported on first use)"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+def _as_array(values):
+    """values as a numpy array, if numpy is installed and they're numeric"""
+    numpy = _import_numpy()
+    if numpy is None:
+        return values
+
+    try:
+        array = numpy.array(values)
+    except (TypeError, ValueError):
+        return values
+
+    if array.dtype.kind not in "biuf":
+        return values
+    return array
+
+def _min_encoded_length(obj):
+    """a cheap lower bound on the length of obj encoded as JSON"""
+    if isinstance(obj, list):
+        return 2 * len(obj) + 1 if obj else 2
+    elif isinstance(obj, dict):
+        return 5 * len(obj) + 1 if obj else 2
+    elif isinstance(obj, basestring):
+        return len(obj) + 2
+    else:
+        return 1
+
+def _to_builtin(obj):
+    """replace numpy numbers and arrays in obj with python ones"""
+    if isinstance(obj, dict):
+        return dict((k, _to_builtin(v)) for (k, v) in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        return [_to_builtin(v) for v in obj]
+    elif hasattr(obj, "tolist"):
+        return obj.tolist()
+    else:
+        return obj
 
 class BasePythonViewServer(base_io.BaseViewServer):
     """Python view server logic, with an overridable compile() method"""
 
-    def __init__(self, stdin, stdout):
+    # smaller batches of documents are filtered without the worker pool
+    filter_pool_min_docs = 100
+
+    def __init__(self, stdin, stdout, reduce_cache_size=100, map_workers=0,
+                 list_flush_bytes=0, list_flush_rows=0, filter_workers=0,
+                 rereduce_cache_size=0, memo_size=100, memo_ttl=300,
+                 ddoc_cache_size=None, ddoc_cache_bytes=None, **kwargs):
         """
         stdin, stdout: where to read and write data
+        reduce_cache_size: how many compiled reduce functions to keep
+        filter_workers: if greater than one, filter functions are run
+                     over large batches of documents by this many forked
+                     worker processes
+        rereduce_cache_size: if set, remember the results of this many
+                     rereduce calls to @pure functions, and reuse them
+                     when the same values are rereduced again
+        memo_size, memo_ttl: the size of each design doc's memo() store,
+                     and how many seconds its values are kept for
+        ddoc_cache_size, ddoc_cache_bytes: if set, the least recently used
+                     design docs (and their compiled functions) are
+                     forgotten when there are more than this many, or
+                     their JSON is larger than this in total
+        map_workers: if greater than one, batches of map_doc commands are
+                     shared between this many forked worker processes
+        list_flush_bytes, list_flush_rows: if either is set, output from
+                     list functions is held back (and joined together)
+                     until at least this many bytes have been sent, or
+                     rows received
+
+        Other keyword arguments are passed to BaseViewServer.
 
         warning: they should be opened in 'line buffered' or 'unbuffered' mode
         """
 
-        super(BasePythonViewServer, self).__init__(stdin, stdout)
-        self.ddocs = {}
+        super(BasePythonViewServer, self).__init__(stdin, stdout, **kwargs)
+        self.ddocs = LRUCache(ddoc_cache_size, maxbytes=ddoc_cache_bytes)
+        self.ddoc_memos = {}
+        self.memo_size = memo_size
+        self.memo_ttl = memo_ttl
+        self._current_ddoc = None
+        self.reduce_funcs = LRUCache(reduce_cache_size)
+        if rereduce_cache_size:
+            self.rereduce_memo = LRUCache(rereduce_cache_size)
+        else:
+            self.rereduce_memo = None
+        self.map_workers = map_workers
+        self.list_flush_bytes = list_flush_bytes
+        self.list_flush_rows = list_flush_rows
+        self._empty_chunks = self.codec.dumps(["chunks", []]) + "\n"
+        self._map_pool = None
+        self._map_pool_funcs = None
+        self.filter_workers = filter_workers
+        self._filter_pool = None
         self.reset(silent=True)
 
     def add_ddoc(self, doc_id, doc):
         """Add a new ddoc, or replace a ddoc"""
-        self.ddocs[doc_id] = (doc, {})
+        nbytes = self._input_line_length or len(self.codec.dumps(doc))
+        self.ddocs.set(doc_id, (doc, {}), nbytes=nbytes)
+
+        for memo_doc_id in self.ddoc_memos.keys():
+            if memo_doc_id == doc_id or memo_doc_id not in self.ddocs:
+                del self.ddoc_memos[memo_doc_id]
+
+        # filter workers have memo() stores of their own, which may hold
+        # values from the old design doc: fork new ones when next needed
+        self._stop_filter_pool()
+
         self.okay()
 
     def use_ddoc(self, doc_id, func_path, func_args):
         """Call a function of a previously added ddoc"""
 
-        assert doc_id in self.ddocs
-        (doc, cache) = self.ddocs[doc_id]
+        ddoc = self.ddocs.get(doc_id)
+        if ddoc is None:
+            # as couchjs does: CouchDB will start a new view server
+            self.output("error", "query_protocol_error",
+                        "uncached design doc: " + doc_id)
+            sys.exit(1)
+        (doc, cache) = ddoc
 
         # tuplify it, so that it can be used as a dict key.
         func_path = tuple(func_path)
@@ -49,14 +172,57 @@ class BasePythonViewServer(base_io.BaseViewServer):
             func = self.compile(find)
             cache[func_path] = func
 
-        getattr(self, "ddoc_" + func_type)(func, func_args)
+        handler = getattr(self, "ddoc_" + func_type)
+        self._current_ddoc = doc_id
+        self._timed(func_type, func, handler, func, func_args)
+
+    def memo(self, key, compute, ttl=None):
+        """
+        return the value remembered for key, or remember compute()
+
+        Values are shared by the functions of the current design doc,
+        until it is replaced or ttl seconds (default: self.memo_ttl) pass.
+        Lists and dicts may be used as keys (they are encoded as JSON, so
+        dicts with their keys in a different order may be missed).
+        """
+
+        store = self.ddoc_memos.get(self._current_ddoc)
+        if store is None:
+            store = LRUCache(self.memo_size, self.memo_ttl)
+            self.ddoc_memos[self._current_ddoc] = store
+
+        if isinstance(key, (list, dict)):
+            key = self.codec.dumps(key)
+
+        value = store.get(key, _missing)
+        if value is _missing:
+            value = compute()
+            store.set(key, value, ttl)
+        return value
+
+    def _timed(self, prefix, func, call, *args):
+        """
+        return call(*args), timing it if there is a profiler
+
+        The time is recorded against func, labelled with prefix.
+        """
+
+        if self.profiler is None:
+            return call(*args)
+
+        start = time.time()
+        try:
+            return call(*args)
+        finally:
+            key = self.profiler.key(func, prefix)
+            self.profiler.record(key, time.time() - start)
 
     def ddoc_shows(self, func, args):
         """execute a show function"""
 
         (doc, req) = args
 
-        _set_vs(self, ["start", "send", "log"])
+        _set_vs(self, ["start", "send", "log", "memo"])
         self._clear_state()
 
         try:
@@ -102,13 +268,13 @@ class BasePythonViewServer(base_io.BaseViewServer):
         """execute a list function"""
         (head, req) = args
 
-        _set_vs(self, ["start", "send", "get_row", "log"])
+        _set_vs(self, ["start", "send", "get_row", "log", "memo"])
         self._clear_state()
 
         tail = None
 
         try:
-            if inspect.isgeneratorfunction(func):
+            if _is_generator(func):
                 g = func(head, req, self._get_row_generator())
                 for y in g:
                     if isinstance(y, dict):
@@ -149,15 +315,57 @@ class BasePythonViewServer(base_io.BaseViewServer):
         """execute a filter function"""
 
         (docs, req) = args
-        _set_vs(self, ["log"])
-        self.output(True, [bool(func(doc, req)) for doc in docs])
-        _set_vs(None)
+
+        if self._use_filter_pool(func, docs):
+            results = self._pool_filter(func, docs, req)
+        else:
+            _set_vs(self, ["log", "memo"])
+            results = _filter_docs(func, docs, req)
+            _set_vs(None)
+
+        self.output(True, results)
+
+    def _use_filter_pool(self, func, docs):
+        """should func be run over docs by the filter worker pool?"""
+        if self.filter_workers < 2 or len(docs) < self.filter_pool_min_docs:
+            return False
+
+        # the function is sent to the workers by name
+        import cPickle as pickle
+        try:
+            pickle.dumps(func, 2)
+        except (pickle.PicklingError, TypeError):
+            return False
+        return True
+
+    def _pool_filter(self, func, docs, req):
+        """run a filter function over docs in the filter worker pool"""
+        if self._filter_pool is None:
+            import multiprocessing
+            self._filter_pool = multiprocessing.Pool(self.filter_workers,
+                    initializer=_pool_init, initargs=(self, ))
+
+        size = -(-len(docs) // (self.filter_workers * 4))
+        tasks = [(func, docs[i:i + size], req, self._current_ddoc)
+                 for i in xrange(0, len(docs), size)]
+
+        results = []
+        for (lines, chunk) in self._filter_pool.map(_pool_filter_docs, tasks):
+            if lines:
+                self.write(lines)
+            results.extend(chunk)
+        return results
+
+    def _stop_filter_pool(self):
+        if self._filter_pool is not None:
+            self._filter_pool.terminate()
+            self._filter_pool = None
 
     def ddoc_updates(self, func, args):
         """execute an update function"""
 
         (doc, req) = args
-        _set_vs(self, ["log"])
+        _set_vs(self, ["log", "memo"])
         (doc, response) = func(doc, req)
         _set_vs(None)
 
@@ -171,7 +379,7 @@ class BasePythonViewServer(base_io.BaseViewServer):
 
         assert len(args) == 4 # newdoc, olddoc, userctx, secobj
 
-        _set_vs(self, ["log"])
+        _set_vs(self, ["log", "memo"])
 
         try:
             func(*args)
@@ -193,6 +401,7 @@ class BasePythonViewServer(base_io.BaseViewServer):
     def send(self, chunk):
         """the send() callback from show functions"""
         self.chunks.append(chunk)
+        self.chunks_size += len(chunk)
 
     def get_row(self):
         """the get_row() callback from list functions"""
@@ -225,26 +434,68 @@ class BasePythonViewServer(base_io.BaseViewServer):
             self.response_start = {}
         self.output("start", self.chunks, self.response_start)
         self.chunks = []
+        self.chunks_size = 0
         self.have_sent_start = True
         self.response_start = None
 
     def _send_list_chunks(self, label="chunks"):
-        """empty self.chunks by sending them to couch"""
-        self.output(label, self.chunks)
+        """
+        empty self.chunks by sending them to couch
+
+        CouchDB expects a reply to every list_row, so if there is nothing
+        to send, or the flush policy says to wait (see __init__), an empty
+        "chunks" message (encoded once, in advance) is sent instead.
+        """
+
+        if label == "chunks":
+            self.rows_since_flush += 1
+            if not self._list_flush_due():
+                self.write(self._empty_chunks)
+                return
+
+        chunks = self.chunks
+        if len(chunks) > 1 and (self.list_flush_bytes or self.list_flush_rows):
+            chunks = [''.join(chunks)]
+
+        self.output(label, chunks)
         self.chunks = []
+        self.chunks_size = 0
+        self.rows_since_flush = 0
+
+    def _list_flush_due(self):
+        """should the chunks be sent now, according to the flush policy?"""
+        if not self.chunks:
+            return False
+        if not (self.list_flush_bytes or self.list_flush_rows):
+            return True
+        (max_bytes, max_rows) = (self.list_flush_bytes, self.list_flush_rows)
+        if max_bytes and self.chunks_size >= max_bytes:
+            return True
+        if max_rows and self.rows_since_flush >= max_rows:
+            return True
+        return False
 
     def _clear_state(self):
         """clear request specific state (emit, send, etc)"""
         self.emissions = []
         self.response_start = None
         self.chunks = []
+        self.chunks_size = 0
+        self.rows_since_flush = 0
         self.have_sent_start = False
         self.list_ended = False
 
+    def abort(self):
+        """clean up after a command that raised an exception"""
+        _set_vs(None)
+        self._clear_state()
+
     def reset(self, config=None, silent=False):
         """Reset state and garbage collect. Apply config, if present"""
 
         self.map_funcs = []
+        self.map_func_names = []
+        self.map_plan = []
         self.view_ddoc = {}
         if config:
             self.query_config = config
@@ -255,9 +506,50 @@ class BasePythonViewServer(base_io.BaseViewServer):
 
     def add_fun(self, new_fun):
         """Add a new map function"""
-        self.map_funcs.append(self.compile(new_fun))
+        self._add_map_func(new_fun)
         self.okay()
 
+    def _add_map_func(self, new_fun):
+        (func, invoke) = self._compile_map(new_fun)
+        self.map_funcs.append(func)
+        self.map_func_names.append(new_fun)
+        self.map_plan.append((func, invoke))
+
+    def _compile_map(self, new_fun):
+        """compile a map function, returning (func, invoker)"""
+        func = self.compile(new_fun)
+        invoke = self._map_invoker(func)
+        if self.profiler is not None:
+            invoke = self.profiler.wrap(self.profiler.key(func, "map"), invoke)
+        return (func, invoke)
+
+    def _map_invoker(self, func):
+        """
+        prebuild a function that runs func on a doc, returning its emissions
+
+        This is done once in add_fun, so that map_doc needn't inspect each
+        function for every document.
+
+        Each invoker points couch_named_python.emit straight at the append
+        method of a new list of emissions before calling the function.
+        """
+
+        if _is_generator(func):
+            def invoke(doc):
+                self.emissions = emissions = []
+                emit_proxy.append = append = emissions.append
+                for (key, value) in func(doc):
+                    append([key, value])
+                return emissions
+        else:
+            def invoke(doc):
+                self.emissions = emissions = []
+                emit_proxy.append = emissions.append
+                func(doc)
+                return emissions
+
+        return invoke
+
     def set_lib(self, lib):
         """Set the current view ddoc"""
         self.view_ddoc = lib
@@ -269,27 +561,55 @@ class BasePythonViewServer(base_io.BaseViewServer):
         _set_vs(self, ["emit", "log"])
         results = []
 
-        for func in self.map_funcs:
-            self._clear_state()
-
+        for (func, invoke) in self.map_plan:
             try:
-                if inspect.isgeneratorfunction(func):
-                    for y in func(doc):
-                        self.emit(*y)
-                else:
-                    func(doc)
+                results.append(invoke(doc))
             except:
                 results.append([])
                 self.exception("map_runtime_error", fatal=False,
                                doc_id=doc["_id"], func=func)
-            else:
-                results.append(self.emissions)
 
         _set_vs(None)
-        self._clear_state()
+        self.emissions = []
 
         self.output(*results)
 
+    def map_docs(self, docs):
+        """
+        run map_doc on several documents, writing the output in one go
+
+        If there are map_workers, the documents are mapped in parallel by a
+        pool of worker processes, which are forked with the current map
+        functions already loaded.
+        """
+
+        if self.map_workers < 2 or len(docs) < 2:
+            super(BasePythonViewServer, self).map_docs(docs)
+            return
+
+        if self._map_pool_funcs != self.map_funcs:
+            self._start_map_pool()
+
+        chunksize = max(1, len(docs) // (self.map_workers * 4))
+        output = ''.join(self._map_pool.map(_pool_map_doc, docs, chunksize))
+        if self.recorder is not None:
+            self.recorder.record_out(output)
+        self.stdout.write(output)
+
+    def _start_map_pool(self):
+        """(re)start the map worker pool, copying the current map functions"""
+        self._stop_map_pool()
+        import multiprocessing
+        self._map_pool = multiprocessing.Pool(self.map_workers,
+                initializer=_pool_init, initargs=(self, ))
+        self._map_pool_funcs = list(self.map_funcs)
+
+    def _stop_map_pool(self):
+        if self._map_pool is not None:
+            self._map_pool.terminate()
+            self._map_pool = None
+            self._map_pool_funcs = None
+
     def emit(self, key, value):
         """the emit() callback from map functions"""
         self.emissions.append([key, value])
@@ -304,6 +624,43 @@ class BasePythonViewServer(base_io.BaseViewServer):
         i = self._input_line_length
         return max(200, i / 2)
 
+    def _output_reduce(self, results):
+        """
+        output the results of reduce functions, checking the reduce limit
+
+        If the output would be too large, a (non-fatal) reduce_overflow_error
+        is sent instead. Results are encoded one at a time, stopping at the
+        first that takes the output over the limit, and a result is not
+        encoded at all if it is a list, dict or string that must be too
+        long for the space that remains.
+        """
+
+        limit = self._reduce_limit()
+        if limit is None:
+            self.output(True, results)
+            return
+
+        parts = []
+        length = len("[true,[]]\n") - 1
+
+        for r in results:
+            if length + 1 + _min_encoded_length(r) > limit:
+                break
+            part = self.codec.dumps(r)
+            length += 1 + len(part)
+            parts.append(part)
+            if length > limit:
+                break
+        else:
+            # codecs are compact, so this is codec.dumps([True, results])
+            self.write("[true,[" + ",".join(parts) + "]]\n")
+            return
+
+        preview = ("[" + ",".join(parts))[:100]
+        self.output("error", "reduce_overflow_error",
+                    "Reduce output must shrink more rapidly: Current output: "
+                    "'{0}'... (limit {1} bytes)".format(preview, limit))
+
     def reduce(self, funcs, data):
         """run reduce functions on some data"""
 
@@ -314,10 +671,13 @@ class BasePythonViewServer(base_io.BaseViewServer):
 
         _set_vs(self, ["log"])
 
+        converted = {}
+
         for func_str in funcs:
-            func = self.compile(func_str)
+            func = self._compile_reduce(func_str)
             try:
-                r = func(keys, values, False)
+                r = self._call_reduce("reduce", func, keys, values, False,
+                                      converted)
             except:
                 self.exception("reduce_runtime_error", fatal=False, func=func)
                 r = None
@@ -325,67 +685,551 @@ class BasePythonViewServer(base_io.BaseViewServer):
 
         _set_vs(None)
 
-        self.output(True, results, limit=self._reduce_limit())
+        self._output_reduce(results)
 
     def rereduce(self, funcs, values):
         """run reduce functions on some reduce function outputs"""
 
         results = []
+        digest = None
+        converted = {}
 
         _set_vs(self, ["log"])
 
         for func_str in funcs:
-            func = self.compile(func_str)
+            func = self._compile_reduce(func_str)
+
+            memo = self.rereduce_memo is not None and is_pure(func)
+            if memo:
+                if digest is None:
+                    import hashlib
+                    line = self.codec.dumps(values)
+                    digest = hashlib.sha1(line).digest()
+                r = self.rereduce_memo.get((func_str, digest), _missing)
+                if r is not _missing:
+                    results.append(r)
+                    continue
+
             try:
-                r = func(None, values, True)
+                r = self._call_reduce("rereduce", func, None, values, True,
+                                      converted)
             except:
                 self.exception("rereduce_runtime_error", fatal=False,
                                func=func)
                 r = None
+            else:
+                if memo:
+                    self.rereduce_memo[func_str, digest] = r
             results.append(r)
 
         _set_vs(None)
 
-        self.output(True, results, limit=self._reduce_limit())
+        self._output_reduce(results)
+
+    def _call_reduce(self, label, func, keys, values, rereduce, converted):
+        """
+        call a reduce function, giving @vectorized ones an array of values
+
+        The array is made once per command, and kept in converted.
+        """
+
+        if not is_vectorized(func):
+            return self._timed(label, func, func, keys, values, rereduce)
+
+        if "values" not in converted:
+            converted["values"] = _as_array(values)
+        r = self._timed(label, func, func, keys, converted["values"],
+                        rereduce)
+        return _to_builtin(r)
+
+    def profile_stats(self):
+        """extra statistics to include in profiler reports"""
+        stats = {"reduce_cache": self.reduce_funcs.stats(),
+                 "ddoc_cache": self.ddocs.stats(),
+                 "ddocs": self.ddoc_usage()}
+        if self.rereduce_memo is not None:
+            stats["rereduce_cache"] = self.rereduce_memo.stats()
+        if self.ddoc_memos:
+            stats["memo"] = dict((doc_id, memo.stats())
+                                 for (doc_id, memo) in self.ddoc_memos.items())
+        return stats
+
+    def ddoc_usage(self):
+        """{doc_id: {"bytes": size of its JSON, "functions": compiled}}"""
+        return dict((doc_id, {"bytes": self.ddocs.nbytes(doc_id),
+                              "functions": len(cache)})
+                    for (doc_id, (doc, cache)) in self.ddocs.items.iteritems())
+
+    def _compile_reduce(self, func_str):
+        """compile a reduce function, or fetch it from self.reduce_funcs"""
+        func = self.reduce_funcs.get(func_str)
+        if func is None:
+            func = self.compile(func_str)
+            self.reduce_funcs[func_str] = func
+        return func
+
+    def clear_caches(self):
+        """forget every compiled function, so that it will be recompiled"""
+        self.reduce_funcs.clear()
+        if self.rereduce_memo is not None:
+            self.rereduce_memo.clear()
+        for (doc, cache) in self.ddocs.values():
+            cache.clear()
+        self.ddoc_memos.clear()
+
+    def refresh_functions(self):
+        """
+        clear_caches(), and recompile the current map functions
+
+        If any of the map functions can't be recompiled, the error is
+        fatal, since map_doc must run all of them.
+        """
+
+        self.clear_caches()
+        self._stop_filter_pool()
+
+        try:
+            plan = [self._compile_map(name) for name in self.map_func_names]
+        except base_io.RequestError as e:
+            self.error(e.error, e.reason)
+            sys.exit(1)
+
+        self.map_funcs = [func for (func, invoke) in plan]
+        self.map_plan = plan
 
     def compile(self, function):
         """produce something that can be executed, from a string"""
         raise NotImplementedError
 
+_pool_vs = None
+
+def _pool_init(vs):
+    """runs in each map worker process as it starts"""
+    global _pool_vs
+    _pool_vs = vs
+    # only the parent writes the transcript
+    vs.recorder = None
+
+def _filter_docs(func, docs, req):
+    """run a filter function (which may be a @batch_filter) over docs"""
+    if not is_batch_filter(func):
+        return [bool(func(doc, req)) for doc in docs]
+
+    results = [bool(r) for r in func(docs, req)]
+    if len(results) != len(docs):
+        raise ValueError("Batch filter returned {0} results for {1} docs"
+                         .format(len(results), len(docs)))
+    return results
+
+def _pool_filter_docs(task):
+    """filter docs in a worker process, returning (output, results)"""
+    vs = _pool_vs
+    (func, docs, req, vs._current_ddoc) = task
+    vs._out_buffer = []
+    _set_vs(vs, ["log", "memo"])
+    try:
+        results = _filter_docs(func, docs, req)
+    finally:
+        _set_vs(None)
+        (lines, vs._out_buffer) = (vs._out_buffer, None)
+    return (''.join(lines), results)
+
+def _pool_map_doc(doc):
+    """map a document in a worker process, returning the output"""
+    vs = _pool_vs
+    vs._out_buffer = []
+    try:
+        vs.map_doc_or_error(doc)
+    finally:
+        (lines, vs._out_buffer) = (vs._out_buffer, None)
+    return ''.join(lines)
+
 class NamedPythonViewServer(BasePythonViewServer):
     """python server that 'compiles' functions by importing the given path"""
 
+    def __init__(self, stdin, stdout, modules_loaded=None, **kwargs):
+        """
+        modules_loaded: when the modules were loaded (default: now); ones
+                        whose source has been modified since are reloaded
+                        by reload_modules. Pass the daemon's start time in
+                        a view server forked from it.
+
+        Other keyword arguments are passed to BasePythonViewServer.
+        """
+
+        super(NamedPythonViewServer, self).__init__(stdin, stdout, **kwargs)
+        if modules_loaded is None:
+            modules_loaded = time.time()
+        self._modules_loaded = modules_loaded
+        self._module_mtimes = {}
+        self._reloading = False
+
     def compile(self, function):
         """import a function by name"""
         try:
-            (function, sep, version) = function.partition("|")
-            if version == "":
-                version = None
-            else:
-                version = int(version)
-            parts = function.split(".")
-            if len(parts) < 2 or "" in parts:
-                raise ValueError("Invalid function path")
-            module = '.'.join(parts[:-1])
-            name = parts[-1]
-        except:
-            self.exception("compile_func_name", log_traceback=False)
+            (module, name, version) = self._parse(function)
+        except Exception:
+            raise base_io.RequestError("compile_func_name",
+                                       self.exception_info())
 
         try:
-            __import__(module)
-            f = getattr(sys.modules[module], name)
-            f_ver = get_version(f)
-            if f_ver != version:
-                raise ValueError("Loaded version {0!r} did not match "
-                        "expected version {1!r}".format(f_ver, version))
-        except:
-            self.exception("compile_load", log_traceback=False)
+            f = self._load(module, name, version)
+        except base_io.RequestError:
+            raise
+        except Exception:
+            raise base_io.RequestError("compile_load", self.exception_info())
 
         return f
 
+    def preload(self, functions):
+        """
+        import and check the version of each of functions
+
+        This is meant to be called before run(), so that the imports are
+        done before CouchDB is waiting for a response. Failures are
+        logged, and are not fatal.
+        """
+
+        for function in functions:
+            try:
+                self._load(*self._parse(function))
+            except:
+                self.exception("preload " + function, fatal=False)
+
+    def _parse(self, function):
+        """split "module.function|version" into its parts"""
+        (function, sep, version) = function.partition("|")
+        if version == "":
+            version = None
+        else:
+            version = int(version)
+        parts = function.split(".")
+        if len(parts) < 2 or "" in parts:
+            raise ValueError("Invalid function path")
+        module = '.'.join(parts[:-1])
+        name = parts[-1]
+        return (module, name, version)
+
+    def _load(self, module, name, version):
+        """import a function, reloading if its version is not version"""
+        f = self._import(module, name)
+        if get_version(f) != version and self.reload_modules(module):
+            f = self._import(module, name)
+        f_ver = get_version(f)
+        if f_ver != version:
+            raise ValueError("Loaded version {0!r} did not match "
+                    "expected version {1!r}".format(f_ver, version))
+        return f
+
+    def _import(self, module, name):
+        if module not in sys.modules:
+            before = set(sys.modules)
+            __import__(module)
+            # modules imported just now are up to date
+            loaded = set(sys.modules) - before
+            self._module_mtimes.update(self._source_mtimes(loaded))
+        return getattr(sys.modules[module], name)
+
+    def reload_modules(self, module):
+        """
+        reload module, modules whose source has changed, and their dependents
+
+        A module is considered changed if the modification time of its
+        source file differs from when it was imported by compile() or last
+        reloaded (or is later than the server's start, if neither). If
+        nothing has changed, nothing is reloaded, since reloading would
+        not change the version that module has. Dependents are modules that hold a reference to a reloaded module,
+        or to a function or class defined in one. couch_named_python
+        itself is never reloaded.
+
+        Afterwards, every compiled function is forgotten and the map
+        functions are recompiled. Returns False (doing nothing) if module
+        is not loaded, nothing has changed, or a reload is already under
+        way.
+        """
+
+        if self._reloading or module not in sys.modules:
+            return False
+
+        mtimes = self._source_mtimes()
+        reload_names = set()
+        for (name, mtime) in mtimes.items():
+            known = self._module_mtimes.get(name)
+            if known is None:
+                changed = mtime > self._modules_loaded
+            else:
+                changed = mtime != known
+            if changed:
+                reload_names.add(name)
+
+        if not reload_names:
+            return False
+
+        while True:
+            dependents = set(self._dependents(reload_names, mtimes))
+            if dependents <= reload_names:
+                break
+            reload_names |= dependents
+
+        order = self._reload_order(reload_names)
+        self.log("Reloading modules: " + ", ".join(order))
+
+        self._reloading = True
+        try:
+            for name in order:
+                reload(sys.modules[name])
+            self._module_mtimes = self._source_mtimes()
+            self.refresh_functions()
+        finally:
+            self._reloading = False
+
+        return True
+
+    def _source_mtimes(self, names=None):
+        """{module name: source mtime} for reloadable modules (in names)"""
+        own_dir = os.path.dirname(os.path.abspath(__file__))
+        mtimes = {}
+
+        if names is None:
+            names = sys.modules.keys()
+
+        for name in names:
+            module = sys.modules[name]
+            filename = getattr(module, "__file__", None)
+            if not filename:
+                continue
+            if filename.endswith((".pyc", ".pyo")):
+                filename = filename[:-1]
+            if os.path.dirname(os.path.abspath(filename)) == own_dir:
+                continue
+            try:
+                mtimes[name] = os.stat(filename).st_mtime
+            except OSError:
+                continue
+
+        return mtimes
+
+    def _references(self, name):
+        """names of the modules that module name refers to"""
+        references = set()
+        for value in vars(sys.modules[name]).values():
+            if isinstance(value, types.ModuleType):
+                owner = value.__name__
+                if owner.startswith(name + "."):
+                    # a package's reference to its own submodule
+                    continue
+            elif isinstance(value, (types.FunctionType, types.ClassType,
+                                    type)):
+                owner = value.__module__
+            else:
+                continue
+            references.add(owner)
+        references.discard(name)
+        return references
+
+    def _dependents(self, names, candidates):
+        """names of modules in candidates that refer to those in names"""
+        for name in candidates:
+            if name not in names and self._references(name) & names:
+                yield name
+
+    def _reload_order(self, names):
+        """
+        names, sorted so that modules come after the modules they refer to
+
+        Packages come before their submodules. Otherwise (and if modules
+        refer to each other in a circle), modules are sorted by name.
+        """
+
+        requires = {}
+        for name in names:
+            requires[name] = self._references(name) & names
+            parts = name.split(".")
+            for i in xrange(1, len(parts)):
+                parent = ".".join(parts[:i])
+                if parent in names:
+                    requires[name].add(parent)
+
+        order = []
+        while requires:
+            done = set(order)
+            ready = sorted(name for (name, required) in requires.items()
+                           if required <= done)
+            if not ready:
+                ready = [min(requires)]
+            for name in ready:
+                del requires[name]
+            order.extend(ready)
+
+        return order
+
+usage = "%prog [options]"
+oparser = optparse.OptionParser(usage=usage)
+oparser.add_option("--batch", dest="batch", type="int", default=0,
+                   metavar="N",
+                   help="Handle up to N map_doc commands that are already "
+                        "waiting on stdin at once")
+oparser.add_option("--json", dest="codec", default=None, metavar="CODEC",
+                   help="JSON library to use: auto, ujson, simplejson or "
+                        "json (default: $CNP_JSON_CODEC, or auto)")
+
+oparser.add_option("--map-workers", dest="map_workers", type="int",
+                   default=0, metavar="N",
+                   help="Map batches of documents (see --batch) in N "
+                        "worker processes")
+oparser.add_option("--filter-workers", dest="filter_workers", type="int",
+                   default=0, metavar="N",
+                   help="Run filter functions over large batches of "
+                        "documents in N worker processes")
+oparser.add_option("--list-flush-bytes", dest="list_flush_bytes",
+                   type="int", default=0, metavar="N",
+                   help="Hold back output from list functions until at "
+                        "least N bytes are ready")
+oparser.add_option("--list-flush-rows", dest="list_flush_rows",
+                   type="int", default=0, metavar="N",
+                   help="Hold back output from list functions until N rows "
+                        "have been received")
+oparser.add_option("--ddoc-cache-size", dest="ddoc_cache_size", type="int",
+                   default=None, metavar="N",
+                   help="Keep at most N design docs, forgetting the least "
+                        "recently used")
+oparser.add_option("--ddoc-cache-bytes", dest="ddoc_cache_bytes",
+                   type="int", default=None, metavar="N",
+                   help="Keep design docs totalling at most N bytes of JSON")
+oparser.add_option("--rereduce-cache", dest="rereduce_cache", type="int",
+                   default=0, metavar="N",
+                   help="Remember the results of up to N rereduce calls to "
+                        "functions decorated with @pure")
+oparser.add_option("--profile", dest="profile", default=None,
+                   metavar="FILE",
+                   help="Collect timings of every function, writing them to "
+                        "FILE (as JSON; {pid} is replaced with the process "
+                        "id) on SIGUSR1 or every --profile-interval seconds")
+oparser.add_option("--profile-interval", dest="profile_interval",
+                   type="float", default=None, metavar="SECONDS",
+                   help="Collect timings of every function, and report them "
+                        "every SECONDS seconds (to CouchDB's log, unless "
+                        "--profile is given)")
+oparser.add_option("--manifest", dest="manifest", default=None,
+                   metavar="FILE",
+                   help="Before reading the first command, import and check "
+                        "the functions listed in FILE (e.g., written by "
+                        "cnp-upload --manifest)")
+oparser.add_option("--preload", dest="preload", action="append",
+                   default=None, metavar="FUNC",
+                   help="Import and check module.function|version FUNC "
+                        "before reading the first command (may be repeated)")
+oparser.add_option("--startup-profile", dest="startup_profile",
+                   action="store_true", default=False,
+                   help="Log how long each module took to import at startup")
+oparser.add_option("--serve", dest="serve", default=None, metavar="SOCKET",
+                   help="Run as a daemon, forking a view server for each "
+                        "connection to the Unix socket SOCKET (see "
+                        "--zygote)")
+oparser.add_option("--zygote", dest="zygote", default=None, metavar="SOCKET",
+                   help="Connect to a daemon started with --serve SOCKET, "
+                        "if there is one, rather than starting up")
+oparser.add_option("--record", dest="record", default=None, metavar="FILE",
+                   help="Write a gzipped transcript of every command and "
+                        "response to FILE ({pid} is replaced with the "
+                        "process id), for python -m "
+                        "couch_named_python.bench --replay")
+oparser.add_option("--record-sample", dest="record_sample", type="float",
+                   default=1.0, metavar="FRACTION",
+                   help="Record only this fraction of commands (except "
+                        "those that set up functions)")
+oparser.add_option("--record-redact", dest="record_redact",
+                   action="append", default=None, metavar="FIELD",
+                   help="Hide the values of FIELD in recorded commands, and "
+                        "don't record responses (may be repeated)")
+oparser.add_option("--record-duration", dest="record_duration",
+                   type="float", default=None, metavar="SECONDS",
+                   help="Stop recording after SECONDS seconds")
+oparser.add_option("--binary-io", dest="binary_io", action="store_true",
+                   default=False,
+                   help="Read stdin in large blocks and buffer output until "
+                        "waiting for more input")
+
 def main():
     """main function for couch-named-python"""
-    linebuf_in = os.fdopen(sys.stdin.fileno(), 'r', 1)
-    linebuf_out = os.fdopen(sys.stdout.fileno(), 'w', 1)
-
-    NamedPythonViewServer(linebuf_in, linebuf_out).run()
+    started = time.time()
+    (options, args) = oparser.parse_args()
+
+    if options.startup_profile:
+        import_timer = ImportTimer()
+        import_timer.start()
+
+    if options.serve:
+        stdin = None
+        stdout = sys.stdout
+    elif options.binary_io:
+        stdout = base_io.BufferedWriter(sys.stdout.fileno())
+        stdin = base_io.LineReader(sys.stdin.fileno(),
+                                   before_block=stdout.flush)
+    else:
+        if options.batch:
+            # select() can't see lines waiting in a file object's buffer
+            stdin = base_io.LineReader(sys.stdin.fileno())
+        else:
+            stdin = os.fdopen(sys.stdin.fileno(), 'r', 1)
+        stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
+
+    def make_server(stdin, stdout):
+        # with --serve, this is called in each child
+        pid = str(os.getpid())
+
+        if options.profile or options.profile_interval is not None:
+            filename = options.profile
+            if filename:
+                filename = filename.replace("{pid}", pid)
+            import signal
+            from .profiler import Profiler
+            profiler = Profiler(filename, options.profile_interval)
+            signal.signal(signal.SIGUSR1, profiler.request_report)
+            signal.siginterrupt(signal.SIGUSR1, False)
+        else:
+            profiler = None
+
+        if options.record:
+            from .recorder import Recorder
+            recorder = Recorder(options.record.replace("{pid}", pid),
+                                options.record_sample,
+                                options.record_redact or [],
+                                options.record_duration)
+        else:
+            recorder = None
+
+        return NamedPythonViewServer(stdin, stdout, batch=options.batch,
+                codec=options.codec, map_workers=options.map_workers,
+                list_flush_bytes=options.list_flush_bytes,
+                list_flush_rows=options.list_flush_rows,
+                filter_workers=options.filter_workers,
+                ddoc_cache_size=options.ddoc_cache_size,
+                ddoc_cache_bytes=options.ddoc_cache_bytes,
+                rereduce_cache_size=options.rereduce_cache,
+                profiler=profiler, recorder=recorder,
+                modules_loaded=started)
+
+    vs = make_server(stdin, stdout)
+
+    preload = options.preload or []
+    if options.manifest:
+        preload += read_manifest(options.manifest)
+    if preload:
+        vs.preload(preload)
+
+    if options.startup_profile:
+        import_timer.stop()
+        vs.log("startup: " + vs.codec.dumps(import_timer.report()))
+
+    if options.serve:
+        # vs was only needed for preloading; each child has its own
+        from . import zygote
+        zygote.serve(options.serve, make_server)
+        return
+
+    try:
+        vs.run()
+    finally:
+        if options.binary_io:
+            stdout.flush()
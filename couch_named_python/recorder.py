@@ -0,0 +1,116 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+"""
+Recording the protocol, to replay it later.
+
+A Recorder writes every line that the view server reads and writes to a
+gzipped transcript, one record per line:
+
+    [time, "in", command]
+    [time, "out", response]
+
+python -m couch_named_python.bench --replay FILE replays the commands.
+
+Commands that change state (reset, add_fun, add_lib and new design docs)
+are always recorded; each other command (and its response, list rows,
+etc.) is recorded with probability sample. The values of the named
+fields of any object in the commands may be replaced with a hash; since
+they might also appear in responses, responses are then not recorded.
+"""
+
+import time
+import gzip
+import json
+import random
+import hashlib
+
+class Recorder(object):
+    """
+    Writes a transcript of the protocol to filename
+
+    sample: the fraction of commands to record
+    redact: the names of fields whose values should be hidden
+    duration: stop recording after this many seconds
+
+    The file is created when the first record is written.
+    """
+
+    state_commands = set(["reset", "add_fun", "add_lib"])
+    continuations = set(["list_row", "list_end"])
+
+    def __init__(self, filename, sample=1.0, redact=(), duration=None):
+        self.filename = filename
+        self.sample = sample
+        self.redact = set(redact)
+        self.file = None
+        self.recording = False
+        self.stopped = False
+        self.stop_at = None
+        if duration is not None:
+            self.stop_at = time.time() + duration
+
+    def _write(self, now, direction, line):
+        if self.file is None:
+            self.file = gzip.open(self.filename, "wb", 1)
+        self.file.write('[{0:.4f},"{1}",{2}]\n'.format(now, direction,
+                                                       line.rstrip()))
+
+    def _keep(self, command):
+        if command[0] in self.state_commands:
+            return True
+        if command[0] == "ddoc" and command[1] == "new":
+            return True
+        return self.sample >= 1 or random.random() < self.sample
+
+    def record_in(self, line, command, continued=False):
+        """
+        record line (command, decoded), if this command is being recorded
+
+        Unless continued (e.g., a list_row), this starts a new command,
+        and decides whether it is recorded.
+        """
+
+        if self.stopped:
+            return
+
+        now = time.time()
+        if self.stop_at is not None and now >= self.stop_at:
+            self.close()
+            return
+
+        if not continued and command[0] not in self.continuations:
+            self.recording = self._keep(command)
+
+        if self.recording:
+            if self.redact:
+                line = json.dumps(redact(command, self.redact),
+                                  separators=(',', ':'))
+            self._write(now, "in", line)
+
+    def record_out(self, data):
+        """record data (one or more lines), if recording this command"""
+        if self.recording and not self.redact and not self.stopped:
+            now = time.time()
+            for line in data.splitlines():
+                self._write(now, "out", line)
+
+    def close(self):
+        self.stopped = True
+        self.recording = False
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def redact(obj, fields):
+    """a copy of obj, with the values of fields in every dict hashed"""
+    if isinstance(obj, dict):
+        return dict((k, _hash(v) if k in fields else redact(v, fields))
+                    for (k, v) in obj.iteritems())
+    elif isinstance(obj, list):
+        return [redact(v, fields) for v in obj]
+    else:
+        return obj
+
+def _hash(value):
+    data = json.dumps(value, sort_keys=True)
+    return "redacted:" + hashlib.sha1(data).hexdigest()[:16]
@@ -0,0 +1,206 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+"""
+Ready-made reduce functions.
+
+These may be named in a design doc like any other function, e.g.
+
+    stats:
+        map: my_module.some_map
+        reduce: couch_named_python.reducers.stats
+
+ - sum: adds up numbers, or lists of numbers element-wise (like _sum)
+ - count: counts rows (like _count)
+ - stats: sum, count, min, max and sum of squares of numbers (like _stats)
+ - hll_distinct: estimates the number of distinct keys with a
+   HyperLogLog sketch (like _approx_count_distinct)
+ - topk: the 10 most common values, with their counts
+
+All of them are @pure. make_hll_distinct and make_topk produce variants
+with other parameters; remember to decorate the result with @version (and
+@pure) in your own module.
+"""
+
+import __builtin__
+import math
+import json
+import base64
+import hashlib
+from collections import defaultdict
+
+from . import version, pure
+
+_sum = __builtin__.sum
+
+def _sum_lists(values):
+    """sum lists of numbers element-wise; shorter lists are zero padded"""
+    total = []
+    for value in values:
+        if not isinstance(value, list):
+            raise TypeError("Cannot sum a mixture of numbers and lists")
+        if len(value) > len(total):
+            total.extend([0] * (len(value) - len(total)))
+        for (i, x) in enumerate(value):
+            total[i] += x
+    return total
+
+@pure
+@version(1)
+def sum(keys, values, rereduce):
+    """add up numbers, or lists of numbers element-wise"""
+    try:
+        return _sum(values)
+    except TypeError:
+        return _sum_lists(values)
+
+@pure
+@version(1)
+def count(keys, values, rereduce):
+    """count the rows"""
+    if rereduce:
+        return _sum(values)
+    else:
+        return len(values)
+
+@pure
+@version(1)
+def stats(keys, values, rereduce):
+    """sum, count, min, max and sumsqr of numbers"""
+    if rereduce:
+        return {"sum": _sum(v["sum"] for v in values),
+                "count": _sum(v["count"] for v in values),
+                "min": min(v["min"] for v in values),
+                "max": max(v["max"] for v in values),
+                "sumsqr": _sum(v["sumsqr"] for v in values)}
+    else:
+        return {"sum": _sum(values), "count": len(values),
+                "min": min(values), "max": max(values),
+                "sumsqr": _sum(x * x for x in values)}
+
+def _hash64(obj):
+    """a 64 bit hash of a JSON value that is the same in every process"""
+    data = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return int(hashlib.sha1(data).hexdigest()[:16], 16)
+
+def make_hll_distinct(precision=7):
+    """
+    produce a reduce function that counts distinct keys approximately
+
+    The sketch has 2 ** precision registers, and a standard error of
+    about 1.04 / sqrt(2 ** precision) (9% for the default precision).
+    Its output is {"count": estimate, "p": precision, ...}, plus either
+    "sparse", the base64 encoded index and value of each register that
+    isn't zero (4 bytes per register, used while only a few are set), or
+    "registers", the whole sketch, 6 bits per register, base64 encoded
+    (2 ** precision bytes).
+
+    With the default precision, the output is always less than 200 bytes
+    long, so is never too large for CouchDB's reduce_limit. With higher
+    precisions, rereducing sketches of different keys will exceed it.
+    """
+
+    if not 4 <= precision <= 16:
+        raise ValueError("precision must be between 4 and 16")
+
+    m = 1 << precision
+    rest_bits = 64 - precision
+    alpha = 0.7213 / (1 + 1.079 / m)
+
+    def estimate(registers):
+        e = alpha * m * m / _sum(2.0 ** -r for r in registers)
+        zeros = registers.count(b"\x00")
+        if e <= 2.5 * m and zeros:
+            e = m * math.log(float(m) / zeros)
+        return int(round(e))
+
+    # ranks are less than 64, so fit in 6 bits: the dense encoding packs
+    # four registers into 3 bytes, and each sparse entry is 3 bytes, a 16
+    # bit index followed by the rank.
+
+    def encode(registers):
+        nonzero = [(i, r) for (i, r) in enumerate(registers) if r]
+        data = bytearray()
+
+        if 4 * len(nonzero) >= m:
+            for j in xrange(0, m, 4):
+                x = (registers[j] << 18) | (registers[j + 1] << 12) | \
+                    (registers[j + 2] << 6) | registers[j + 3]
+                data.extend((x >> 16, (x >> 8) & 0xff, x & 0xff))
+            return {"registers": base64.b64encode(data)}
+
+        for (i, r) in nonzero:
+            x = (i << 6) | r
+            data.extend((x >> 16, (x >> 8) & 0xff, x & 0xff))
+        return {"sparse": base64.b64encode(data)}
+
+    def merge(registers, value):
+        if value["p"] != precision:
+            raise ValueError("Cannot merge sketches of different precisions")
+
+        sparse = "sparse" in value
+        data = bytearray(base64.b64decode(value["sparse" if sparse
+                                                else "registers"]))
+        for j in xrange(0, len(data), 3):
+            x = (data[j] << 16) | (data[j + 1] << 8) | data[j + 2]
+            if sparse:
+                pairs = [(x >> 6, x & 0x3f)]
+            else:
+                i = j // 3 * 4
+                pairs = [(i, x >> 18), (i + 1, (x >> 12) & 0x3f),
+                         (i + 2, (x >> 6) & 0x3f), (i + 3, x & 0x3f)]
+            for (i, r) in pairs:
+                if r > registers[i]:
+                    registers[i] = r
+
+    def hll_distinct(keys, values, rereduce):
+        registers = bytearray(m)
+
+        if rereduce:
+            for value in values:
+                merge(registers, value)
+        else:
+            for (key, doc_id) in keys:
+                h = _hash64(key)
+                i = h >> rest_bits
+                w = h & ((1 << rest_bits) - 1)
+                rank = rest_bits - w.bit_length() + 1
+                if rank > registers[i]:
+                    registers[i] = rank
+
+        result = {"count": estimate(registers), "p": precision}
+        result.update(encode(registers))
+        return result
+
+    hll_distinct.__name__ = "hll_distinct"
+    return hll_distinct
+
+hll_distinct = pure(version(1)(make_hll_distinct()))
+
+def make_topk(k=10):
+    """
+    produce a reduce function that finds the k most common values
+
+    The output is a list of [value, count] pairs, most common first. Since
+    only k values are kept in each reduction, counts near the bottom of
+    the list may be underestimates when there are many distinct values.
+    Values must be strings, numbers, booleans or null.
+    """
+
+    def topk(keys, values, rereduce):
+        counts = defaultdict(int)
+
+        if rereduce:
+            for pairs in values:
+                for (value, n) in pairs:
+                    counts[value] += n
+        else:
+            for value in values:
+                counts[value] += 1
+
+        top = sorted(counts.iteritems(), key=lambda i: (-i[1], i[0]))
+        return [[v, n] for (v, n) in top[:k]]
+
+    topk.__name__ = "topk"
+    return topk
+
+topk = pure(version(1)(make_topk()))
@@ -0,0 +1,159 @@
+# Copyright 2012 (C) Daniel Richman; GNU GPL 3
+
+"""
+An in-process stand-in for a CouchDB server, for testing cnp-upload
+
+It implements just enough of the HTTP API for couchdbkit: fetching docs
+with _all_docs, saving and deleting with _bulk_docs (with revision
+checking) and getting single docs. Every request is recorded in
+FakeCouch.requests.
+
+Views always return no rows. Querying one with stale=update_after starts
+a pretend index build, which the design doc's _info reports as running
+for the next build_polls requests; each query is recorded in
+FakeCouch.view_queries.
+"""
+
+import json
+import hashlib
+import urllib
+import urlparse
+import threading
+import BaseHTTPServer
+
+class FakeCouch(object):
+    def __init__(self, dbs=("database", )):
+        self.dbs = dict((name, {}) for name in dbs)
+        self.requests = []
+        self.view_queries = []
+        self.build_polls = 0
+        self.building = {}
+
+        class Handler(_Handler):
+            couch = self
+        self.httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       args=(0.01, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def put(self, db, doc):
+        """store a copy of doc (as if it had been saved), returning its rev"""
+        doc = json.loads(json.dumps(doc))
+        old = self.dbs[db].get(doc["_id"])
+        n = int(old["_rev"].split("-")[0]) + 1 if old else 1
+        doc.pop("_rev", None)
+        digest = hashlib.md5(json.dumps(doc, sort_keys=True)).hexdigest()
+        doc["_rev"] = "{0}-{1}".format(n, digest)
+        self.dbs[db][doc["_id"]] = doc
+        return doc["_rev"]
+
+    def all_docs(self, db, query, body):
+        rows = []
+        for key in body["keys"]:
+            doc = self.dbs[db].get(key)
+            if doc is None:
+                rows.append({"key": key, "error": "not_found"})
+                continue
+            row = {"id": key, "key": key, "value": {"rev": doc["_rev"]}}
+            if query.get("include_docs") == ["true"]:
+                row["doc"] = doc
+            rows.append(row)
+        return (200, {"total_rows": len(self.dbs[db]), "rows": rows})
+
+    def bulk_docs(self, db, query, body):
+        results = []
+        for doc in body["docs"]:
+            old = self.dbs[db].get(doc["_id"])
+            if (old and old["_rev"]) != doc.get("_rev"):
+                results.append({"id": doc["_id"], "error": "conflict",
+                                "reason": "Document update conflict."})
+            elif doc.get("_deleted"):
+                del self.dbs[db][doc["_id"]]
+                results.append({"id": doc["_id"], "rev": "0-deleted"})
+            else:
+                results.append({"id": doc["_id"],
+                                "rev": self.put(db, doc)})
+        return (201, results)
+
+    def view(self, db, doc_id, view, query):
+        if doc_id not in self.dbs[db]:
+            return (404, {"error": "not_found", "reason": "missing"})
+        stale = query.get("stale", [None])[0]
+        self.view_queries.append((doc_id, view, stale))
+        if stale == "update_after":
+            self.building[doc_id] = self.build_polls
+        return (200, {"total_rows": 0, "offset": 0, "rows": []})
+
+    def design_info(self, db, doc_id):
+        if doc_id not in self.dbs[db]:
+            return (404, {"error": "not_found", "reason": "missing"})
+        running = self.building.get(doc_id, 0) > 0
+        if running:
+            self.building[doc_id] -= 1
+        return (200, {"name": doc_id[len("_design/"):],
+                      "view_index": {"updater_running": running}})
+
+    def get_doc(self, db, doc_id, query):
+        doc = self.dbs[db].get(doc_id)
+        if doc is None:
+            return (404, {"error": "not_found", "reason": "missing"})
+        return (200, doc)
+
+    def handle(self, method, path, query, body):
+        """returns (status, response)"""
+        parts = [urllib.unquote(p) for p in path.strip("/").split("/")]
+        if parts[0] not in self.dbs:
+            return (404, {"error": "not_found",
+                          "reason": "no_db_file"})
+        (db, rest) = (parts[0], parts[1:])
+
+        if method == "POST" and rest == ["_all_docs"]:
+            return self.all_docs(db, query, body)
+        if method == "POST" and rest == ["_bulk_docs"]:
+            return self.bulk_docs(db, query, body)
+        if method == "GET" and rest[:1] == ["_design"] and len(rest) > 2:
+            doc_id = "/".join(rest[:2])
+            if rest[2:3] == ["_view"]:
+                return self.view(db, doc_id, "/".join(rest[3:]), query)
+            if rest[2:] == ["_info"]:
+                return self.design_info(db, doc_id)
+        if method == "GET" and rest:
+            return self.get_doc(db, "/".join(rest), query)
+
+        return (405, {"error": "method_not_allowed",
+                      "reason": "not supported by FakeCouch"})
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    couch = None
+
+    def _handle(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        length = int(self.headers.getheader("Content-Length") or 0)
+        body = self.rfile.read(length) if length else ""
+        body = json.loads(body) if body else None
+
+        self.couch.requests.append((self.command, url.path))
+        (status, response) = \
+                self.couch.handle(self.command, url.path, query, body)
+
+        data = json.dumps(response)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_COPY = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
@@ -1,10 +1,13 @@
 # Copyright 2011 (C) Daniel Richman; GNU GPL
 
+import os
 import mox
 import json
+import select
 import traceback
 from . import EqIfIn
-from ..base_io import BaseViewServer
+from ..base_io import BaseViewServer, LineReader, BufferedWriter, \
+        RequestError
 
 class JSON_NL(mox.Comparator):
     def __init__(self, obj):
@@ -71,6 +74,50 @@ class TestBaseViewServer(object):
         self.vs.run()
         self.mocker.VerifyAll()
 
+    def test_map_batch(self):
+        def f(doc):
+            self.vs.log("mapping " + str(doc["n"]))
+            self.vs.output([[doc["n"], None]])
+
+        self.vs.batch = 3
+        self.mocker.StubOutWithMock(self.vs, "_input_ready")
+        self.mocker.StubOutWithMock(self.vs, "map_doc")
+        self.mocker.StubOutWithMock(self.vs, "handle_input")
+
+        self.stdin.readline().AndReturn("""["map_doc",{"n":1}]\n""")
+        self.vs._input_ready().AndReturn(True)
+        self.stdin.readline().AndReturn("""["map_doc",{"n":2}]\n""")
+        self.vs._input_ready().AndReturn(True)
+        self.stdin.readline().AndReturn("""["reset"]\n""")
+        self.vs.map_doc({"n": 1}).WithSideEffects(f)
+        self.vs.map_doc({"n": 2}).WithSideEffects(f)
+        self.stdout.write('["log","mapping 1"]\n[[[1,null]]]\n'
+                          '["log","mapping 2"]\n[[[2,null]]]\n')
+        self.vs.handle_input("reset")
+
+        # a lone map_doc: nothing else is waiting
+        self.stdin.readline().AndReturn("""["map_doc",{"n":3}]\n""")
+        self.vs._input_ready().AndReturn(False)
+        self.vs.map_doc({"n": 3}).WithSideEffects(f)
+        self.stdout.write('["log","mapping 3"]\n[[[3,null]]]\n')
+
+        # the batch is limited to 3 documents
+        self.stdin.readline().AndReturn("""["map_doc",{"n":4}]\n""")
+        self.vs._input_ready().AndReturn(True)
+        self.stdin.readline().AndReturn("""["map_doc",{"n":5}]\n""")
+        self.vs._input_ready().AndReturn(True)
+        self.stdin.readline().AndReturn("""["map_doc",{"n":6}]\n""")
+        self.vs.map_doc({"n": 4}).WithSideEffects(f)
+        self.vs.map_doc({"n": 5}).WithSideEffects(f)
+        self.vs.map_doc({"n": 6}).WithSideEffects(f)
+        self.stdout.write(EqIfIn("mapping 6"))
+
+        self.stdin.readline().AndReturn("")
+        self.mocker.ReplayAll()
+
+        self.vs.run()
+        self.mocker.VerifyAll()
+
     def test_output_limit(self):
         self.stdout.write(JSON_NL(["blah"]))
         self.stdout.write(JSON_NL("some text and some other stuff"))
@@ -114,8 +161,29 @@ class TestBaseViewServer(object):
     def test_misc_exception(self):
         self.stdin.readline().AndReturn("invalid json, woo!")
         self.stdout.write(JSON_NL(["log", EqIfIn("Traceback")]))
-        self.stdout.write(JSON_NL(["error", "unhandled exception",
-                "ValueError: No JSON object could be decoded"]))
+        self.stdout.write(JSON_NL(["error", "query_protocol_error",
+                "ProtocolError: Invalid JSON: No JSON object could be "
+                "decoded"]))
+        self.mocker.ReplayAll()
+
+        self.vs_run_sysexit()
+        self.mocker.VerifyAll()
+
+    def test_not_a_command(self):
+        self.stdin.readline().AndReturn("""{"a": 1}\n""")
+        self.stdout.write(JSON_NL(["log", EqIfIn("Traceback")]))
+        self.stdout.write(JSON_NL(["error", "query_protocol_error",
+                """ProtocolError: Expected a command, got '{"a": 1}\\n'"""]))
+        self.mocker.ReplayAll()
+
+        self.vs_run_sysexit()
+        self.mocker.VerifyAll()
+
+    def test_unknown_command(self):
+        self.stdin.readline().AndReturn("""["list_row", {}]\n""")
+        self.stdout.write(JSON_NL(["log", EqIfIn("Traceback")]))
+        self.stdout.write(JSON_NL(["error", "query_protocol_error",
+                "ProtocolError: Unknown command: u'list_row'"]))
         self.mocker.ReplayAll()
 
         self.vs_run_sysexit()
@@ -123,14 +191,39 @@ class TestBaseViewServer(object):
 
     def test_command_exception(self):
         self.mocker.StubOutWithMock(self.vs, "handle_input")
+        self.mocker.StubOutWithMock(self.vs, "abort")
         self.stdin.readline().AndReturn("""["hello"]\n""")
         self.vs.handle_input("hello").AndRaise(ValueError("testing"))
+        self.vs.abort()
         self.stdout.write(JSON_NL(["log", EqIfIn("Traceback")]))
-        self.stdout.write(JSON_NL(["error", "unhandled exception",
+        self.stdout.write(JSON_NL(["error", "hello_runtime_error",
                                    "ValueError: testing"]))
+        # and carries on
+        self.stdin.readline().AndReturn("""["ddoc", "_design/a", """
+                                        """["updates", "u"], []]\n""")
+        self.vs.handle_input("ddoc", "_design/a", ["updates", "u"], []) \
+                .AndRaise(KeyError("x"))
+        self.vs.abort()
+        self.stdout.write(JSON_NL(["log", EqIfIn("Traceback")]))
+        self.stdout.write(JSON_NL(["error", "updates_runtime_error",
+                                   "KeyError: 'x'"]))
+        self.stdin.readline().AndReturn("")
         self.mocker.ReplayAll()
 
-        self.vs_run_sysexit()
+        self.vs.run()
+        self.mocker.VerifyAll()
+
+    def test_request_error(self):
+        self.mocker.StubOutWithMock(self.vs, "handle_input")
+        self.stdin.readline().AndReturn("""["hello"]\n""")
+        self.vs.handle_input("hello") \
+                .AndRaise(RequestError("compile_load", "no such thing"))
+        # no traceback
+        self.stdout.write(JSON_NL(["error", "compile_load", "no such thing"]))
+        self.stdin.readline().AndReturn("")
+        self.mocker.ReplayAll()
+
+        self.vs.run()
         self.mocker.VerifyAll()
 
     def test_fatal_exception(self):
@@ -253,3 +346,97 @@ class TestBaseViewServer(object):
         self.mocker.ReplayAll()
         self.vs.add_lib({"testing": True})
         self.mocker.VerifyAll()
+
+class TestLineReader(object):
+    def setup(self):
+        self.mocker = mox.Mox()
+        self.mocker.StubOutWithMock(os, "read")
+        self.mocker.StubOutWithMock(select, "select")
+        self.flushes = []
+        self.reader = LineReader(5, read_size=100,
+                before_block=lambda: self.flushes.append(True))
+
+    def teardown(self):
+        self.mocker.UnsetStubs()
+
+    def test_readline(self):
+        os.read(5, 100).AndReturn('["reset"]\n["add_fun", "a.b"]\n["map')
+        os.read(5, 100).AndReturn('_doc", {}]')
+        os.read(5, 100).AndReturn('\n["map_doc", {"x": 1}]\n')
+        os.read(5, 100).AndReturn('["no newline"]')
+        os.read(5, 100).AndReturn('')
+        self.mocker.ReplayAll()
+
+        assert self.reader.readline() == '["reset"]\n'
+        assert self.reader.readline() == '["add_fun", "a.b"]\n'
+        assert len(self.flushes) == 1
+        assert self.reader.readline() == '["map_doc", {}]\n'
+        assert len(self.flushes) == 3
+        assert self.reader.readline() == '["map_doc", {"x": 1}]\n'
+        assert self.reader.readline() == '["no newline"]'
+        assert self.reader.readline() == ''
+        assert self.reader.readline() == ''
+        assert len(self.flushes) == 5
+        self.mocker.VerifyAll()
+
+    def test_ready(self):
+        os.read(5, 100).AndReturn('["reset"]\n["reset"]\n')
+        select.select([5], [], [], 0).AndReturn(([], [], []))
+        select.select([5], [], [], 0).AndReturn(([5], [], []))
+        os.read(5, 100).AndReturn('')
+        self.mocker.ReplayAll()
+
+        assert self.reader.readline() == '["reset"]\n'
+        assert self.reader.ready()
+        assert self.reader.readline() == '["reset"]\n'
+        assert not self.reader.ready()
+        assert self.reader.ready()
+        assert self.reader.readline() == ''
+        assert self.reader.ready()
+        self.mocker.VerifyAll()
+
+class TestBufferedWriter(object):
+    def setup(self):
+        self.mocker = mox.Mox()
+        self.mocker.StubOutWithMock(os, "write")
+        self.writer = BufferedWriter(7, max_size=20)
+
+    def teardown(self):
+        self.mocker.UnsetStubs()
+
+    def test_write_flush(self):
+        os.write(7, 'true\n[[]]\n').AndReturn(6)
+        os.write(7, '[]]\n').AndReturn(4)
+        os.write(7, '["log","0123456789"]\n').AndReturn(21)
+        self.mocker.ReplayAll()
+
+        self.writer.flush()
+        self.writer.write('true\n')
+        self.writer.write('[[]]\n')
+        self.writer.flush()
+        self.writer.flush()
+        # over max_size
+        self.writer.write('["log","0123456789"]\n')
+        self.mocker.VerifyAll()
+
+class TestBinaryIO(object):
+    def test_view_server(self):
+        (rfd, wfd) = os.pipe()
+        (out_rfd, out_wfd) = os.pipe()
+
+        writer = BufferedWriter(out_wfd)
+        reader = LineReader(rfd, before_block=writer.flush)
+        vs = BaseViewServer(reader, writer)
+        vs.reset = lambda: vs.okay()
+        vs.map_doc = lambda doc: vs.output([[doc["n"], None]])
+
+        os.write(wfd, '["reset"]\n["map_doc", {"n": 1}]\n["reset"]\n')
+        os.close(wfd)
+        vs.run()
+        writer.flush()
+        os.close(out_wfd)
+
+        out = os.read(out_rfd, 1000)
+        assert out == 'true\n[[[1,null]]]\ntrue\n', out
+        os.close(rfd)
+        os.close(out_rfd)
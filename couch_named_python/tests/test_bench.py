@@ -0,0 +1,82 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import os
+import json
+import gzip
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from .. import bench
+
+class TestBench(object):
+    def test_map_emissions(self):
+        vs = bench.BenchViewServer(None, bench.NullWriter())
+        out = []
+        vs.output = lambda *args: out.append(args)
+        vs.add_fun("map_emit")
+        vs.add_fun("map_yield")
+
+        for doc in bench.make_docs(2):
+            vs.map_doc(doc)
+
+        expect = [[["doc0", 0], [["type0", 0], None]],
+                  [["doc1", 1], [["type1", 1], None]]]
+        assert out == [(expect[0], expect[0]), (expect[1], expect[1])]
+
+    def test_bench_map_doc(self):
+        result = bench.bench_map_doc(docs=10, funcs=3)
+        assert result["docs"] == 10
+        assert result["funcs"] == 3
+        assert result["docs_per_sec"] > 0
+
+    def test_synthetic_transcript(self):
+        commands = bench.make_transcript(docs=20, funcs=2, batch=10)
+        data = "".join(json.dumps(c) + "\n" for c in commands)
+        stdout = StringIO()
+        vs = bench.ReplayViewServer(StringIO(data), stdout)
+        vs.run()
+
+        responses = [json.loads(line)
+                     for line in stdout.getvalue().splitlines()]
+        assert not [r for r in responses
+                    if isinstance(r, list) and r[0] in ("error", "log")]
+        assert responses[:3] == [True, True, True]
+        assert vs.docs == 40
+
+    def test_replay(self):
+        commands = bench.make_transcript(docs=20, funcs=2, batch=10)
+        result = bench.replay(commands, "json")
+
+        assert result["exit_code"] is None
+        assert result["docs"] == 40
+        assert result["commands"] == len(commands) - 21 # list_row/list_end
+        assert result["bytes_in"] > 0 and result["bytes_out"] > 0
+        assert sorted(result["latency"]) == \
+                ["add_fun", "ddoc filters", "ddoc lists", "ddoc new",
+                 "ddoc shows", "ddoc updates", "ddoc validate_doc_update",
+                 "map_doc", "reduce", "rereduce", "reset"]
+        assert result["latency"]["map_doc"]["calls"] == 20
+        assert result["latency"]["reduce"]["calls"] == 2
+        json.dumps(result)
+        assert "commands/sec" in bench.format_replay(result)
+
+    def test_replay_exits(self):
+        result = bench.replay([["reset"], ["nonsense"], ["reset"]])
+        assert result["exit_code"] == 1
+        assert result["commands"] == 2
+
+    def test_read_transcript(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, "transcript.gz")
+            f = gzip.open(filename, "w")
+            f.write('["reset"]\n')
+            f.write('[1.5, "in", ["map_doc", {"_id": "a"}]]\n')
+            f.write('[1.6, "out", [[]]]\n')
+            f.close()
+
+            assert bench.read_transcript(filename) == \
+                    [["reset"], ["map_doc", {"_id": "a"}]]
+        finally:
+            shutil.rmtree(tempdir)
@@ -0,0 +1,91 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+from ..cache import LRUCache
+
+class TestLRUCache(object):
+    def test_get_set(self):
+        c = LRUCache(10)
+        c["a"] = 1
+        c["b"] = 2
+        assert c.get("a") == 1
+        assert c["b"] == 2
+        assert c.get("c") == None
+        assert c.get("c", 4) == 4
+        assert "a" in c and "c" not in c
+        assert len(c) == 2
+        assert (c.hits, c.misses) == (2, 2)
+
+        try:
+            c["nope"]
+        except KeyError:
+            pass
+        else:
+            raise AssertionError("Expected KeyError")
+
+        del c["a"]
+        assert "a" not in c
+
+    def test_evicts_least_recently_used(self):
+        c = LRUCache(2)
+        c["a"] = 1
+        c["b"] = 2
+        c.get("a")
+        c["c"] = 3
+        assert "a" in c and "c" in c and "b" not in c
+        assert c.evictions == 1
+
+        c["a"] = 4
+        c["d"] = 5
+        assert "c" not in c
+        assert c["a"] == 4
+        assert c.evictions == 2
+
+    def test_unbounded_and_clear(self):
+        c = LRUCache(None)
+        for i in xrange(1000):
+            c[i] = i
+        assert len(c) == 1000
+        c.clear()
+        assert len(c) == 0
+        assert c.stats() == {"size": 0, "maxsize": None, "bytes": 0,
+                             "maxbytes": None, "hits": 0, "misses": 0,
+                             "evictions": 0, "expirations": 0}
+
+    def test_ttl(self):
+        c = LRUCache(2, ttl=0)
+        c["a"] = 1
+        assert c.get("a") is None
+        assert "a" not in c
+        assert (c.misses, c.expirations) == (1, 1)
+
+        c.set("b", 2, ttl=100)
+        assert c["b"] == 2
+        c.set("c", 3, ttl=100)
+        c.set("d", 4, ttl=100)
+        assert c.evictions == 1
+        assert sorted(c.expiry) == ["c", "d"]
+
+        c = LRUCache(2)
+        c["a"] = 1
+        c.set("b", 2, ttl=-1)
+        assert c.get("a") == 1 and c.get("b") is None
+        assert c.stats()["expirations"] == 1
+
+    def test_maxbytes(self):
+        c = LRUCache(None, maxbytes=100)
+        c.set("a", 1, nbytes=40)
+        c.set("b", 2, nbytes=40)
+        c["c"] = 3
+        assert (c.bytes, c.evictions) == (80, 0)
+
+        c.set("a", 1, nbytes=70)
+        assert c.keys() == ["c", "a"]
+        assert (c.bytes, c.evictions) == (70, 1)
+        assert c.nbytes("a") == 70 and c.nbytes("c") == 0
+
+        # the newest item is kept, even if it is too large
+        c.set("d", 4, nbytes=500)
+        assert c.keys() == ["d"] and c.bytes == 500
+
+        del c["d"]
+        assert c.bytes == 0
@@ -0,0 +1,102 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import os
+import json
+from .. import jsoncodec
+from ..jsoncodec import get_codec, check_codec, StdlibCodec
+
+class SpaceyCodec(StdlibCodec):
+    """a codec whose output differs from the others'"""
+    name = "spacey"
+    def __init__(self):
+        super(SpaceyCodec, self).__init__()
+        dumps = self.dumps
+        self.dumps = lambda obj: dumps(obj).replace(",", ", ")
+
+class LossyCodec(StdlibCodec):
+    """a codec that rounds floats, as ujson does"""
+    name = "lossy"
+    def __init__(self):
+        super(LossyCodec, self).__init__()
+        dumps = self.dumps
+        self.dumps = lambda obj: dumps(_round(obj))
+
+class LossyLoadsCodec(StdlibCodec):
+    """a codec whose output is right, but which rounds floats it reads"""
+    name = "lossy_loads"
+    def __init__(self):
+        super(LossyLoadsCodec, self).__init__()
+        self.loads = lambda line: _round(json.loads(line))
+
+def _round(obj):
+    if isinstance(obj, float):
+        return float("{0:.10g}".format(obj))
+    elif isinstance(obj, list):
+        return [_round(v) for v in obj]
+    elif isinstance(obj, dict):
+        return dict((k, _round(v)) for (k, v) in obj.iteritems())
+    return obj
+
+class MissingCodec(StdlibCodec):
+    name = "missing"
+    def __init__(self):
+        raise ImportError("No module named missing")
+
+class TestJSONCodec(object):
+    def setup(self):
+        self.old_codecs = jsoncodec.codecs
+        self.old_environ = os.environ.get("CNP_JSON_CODEC")
+
+    def teardown(self):
+        jsoncodec.codecs = self.old_codecs
+        if self.old_environ is None:
+            os.environ.pop("CNP_JSON_CODEC", None)
+        else:
+            os.environ["CNP_JSON_CODEC"] = self.old_environ
+
+    def test_stdlib_codec(self):
+        c = StdlibCodec()
+        assert c.dumps([True, {"a": [1, None]}]) == '[true,{"a":[1,null]}]'
+        assert c.dumps([u"caf\u00e9"]) == '["caf\\u00e9"]'
+        assert c.loads('["caf\xc3\xa9", 2.5]') == [u"caf\u00e9", 2.5]
+        check_codec(c)
+
+    def test_check_codec(self):
+        for codec in [SpaceyCodec(), LossyCodec(), LossyLoadsCodec()]:
+            try:
+                check_codec(codec)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("Expected ValueError from check_codec "
+                                     "for " + codec.name)
+
+    def test_get_codec(self):
+        jsoncodec.codecs = [MissingCodec, SpaceyCodec, LossyCodec,
+                            LossyLoadsCodec, StdlibCodec]
+
+        assert get_codec("json").name == "json"
+        assert get_codec("auto").name == "json"
+
+        os.environ.pop("CNP_JSON_CODEC", None)
+        assert get_codec().name == "json"
+        os.environ["CNP_JSON_CODEC"] = "json"
+        assert get_codec().name == "json"
+
+        for (name, exc) in [("missing", ImportError), ("spacey", ValueError),
+                            ("nonexistant", ValueError)]:
+            try:
+                get_codec(name)
+            except exc:
+                pass
+            else:
+                raise AssertionError("Expected {0} from get_codec({1!r})"
+                                     .format(exc.__name__, name))
+
+        jsoncodec.codecs = [MissingCodec, SpaceyCodec]
+        try:
+            get_codec("auto")
+        except ImportError:
+            pass
+        else:
+            raise AssertionError("Expected ImportError from get_codec")
@@ -0,0 +1,69 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import os
+import sys
+import shutil
+import tempfile
+
+from ..manifest import design_doc_functions, read_manifest, write_manifest, \
+        ImportTimer
+
+class TestManifest(object):
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "manifest.txt")
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_design_doc_functions(self):
+        doc = {"_id": "_design/a", "language": "python",
+               "shows": {"b": "mod.show_b|1", "a": "mod.show_a"},
+               "validate_doc_update": "mod.validate|2",
+               "views": {"one": {"map": "mod.map|3", "reduce": "_count"},
+                         "two": {"map": "mod.map|3",
+                                 "reduce": "mod.reduce|4"}}}
+        assert list(design_doc_functions(doc)) == \
+                ["mod.show_a", "mod.show_b|1", "mod.validate|2",
+                 "mod.map|3", "mod.map|3", "mod.reduce|4"]
+
+    def test_read_write(self):
+        write_manifest(self.filename, ["b.f|2", "a.f", "b.f|2"])
+        with open(self.filename) as f:
+            assert f.read() == "# couch-named-python startup manifest\n" \
+                               "a.f\nb.f|2\n"
+
+        with open(self.filename, "a") as f:
+            f.write("\n  c.g|1  \n# d.h\n")
+        assert read_manifest(self.filename) == ["a.f", "b.f|2", "c.g|1"]
+
+class TestImportTimer(object):
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.tempdir)
+        with open(os.path.join(self.tempdir, "cnp_timed_a.py"), "w") as f:
+            f.write("import cnp_timed_b\n")
+        with open(os.path.join(self.tempdir, "cnp_timed_b.py"), "w") as f:
+            f.write("import sys\n")
+
+    def teardown(self):
+        sys.path.remove(self.tempdir)
+        for name in ["cnp_timed_a", "cnp_timed_b"]:
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.tempdir)
+
+    def test_times_new_imports(self):
+        timer = ImportTimer()
+        original = __import__
+        timer.start()
+        try:
+            import cnp_timed_a
+            import os
+        finally:
+            timer.stop()
+
+        assert __import__ is original
+        report = timer.report()
+        assert sorted(report["modules"]) == ["cnp_timed_a", "cnp_timed_b"]
+        assert report["total"] == sum(report["modules"].values())
+        assert min(report["modules"].values()) >= 0
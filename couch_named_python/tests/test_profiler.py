@@ -0,0 +1,122 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import os
+import json
+import time
+import tempfile
+from StringIO import StringIO
+
+from ..profiler import Histogram, Profiler, function_key
+from ..bench import BenchViewServer, make_docs
+from .example_mod_b import func_b, func_c
+
+class TestHistogram(object):
+    def test_percentiles(self):
+        h = Histogram()
+        assert h.percentile(50) == None
+
+        for i in xrange(1, 101):
+            h.add(i / 1000.0)
+
+        assert h.count == 100
+        assert abs(h.total - 5.05) < 1e-9
+        assert h.max == 0.1
+        assert 0.050 <= h.percentile(50) <= 0.050 * 1.1
+        assert 0.099 <= h.percentile(99) <= 0.1
+        assert h.percentile(100) == 0.1
+
+        h.add(0)
+        assert h.summary()["calls"] == 101
+
+class TestProfiler(object):
+    def test_function_key(self):
+        mod = "couch_named_python.tests.example_mod_b"
+        assert function_key(func_b, "map") == "map " + mod + ".func_b|2"
+        assert function_key(func_c, "shows") == \
+                "shows " + mod + ".func_c|556"
+        assert function_key(len, "reduce") == "reduce __builtin__.len"
+
+        p = Profiler()
+        assert p.key(func_b, "map") == "map " + mod + ".func_b|2"
+        assert p.key(func_b, "map") is p.key(func_b, "map")
+
+    def test_wrap_and_counts(self):
+        p = Profiler()
+        f = p.wrap("test", lambda a, b: a + b)
+        assert f(1, 2) == 3
+        assert f(3, 4) == 7
+        p.record("other", 0.5)
+        p.count_in("map_doc", 100)
+        p.count_in("map_doc", 50)
+        p.count_out("map_doc", 20)
+
+        stats = p.stats()
+        assert stats["functions"]["test"]["calls"] == 2
+        assert stats["functions"]["other"]["total"] == 0.5
+        assert stats["commands"] == {"map_doc": {"count": 2,
+                "bytes_in": 150, "bytes_out": 20}}
+
+    def test_report(self):
+        logs = []
+        p = Profiler(interval=1000)
+        p.record("a", 0.1)
+        assert not p.report_due()
+        p.request_report()
+        assert p.report_due()
+        p.report(logs.append, {"extra": True})
+        assert not p.report_due()
+
+        assert len(logs) == 1
+        assert logs[0].startswith("profile: ")
+        stats = json.loads(logs[0][len("profile: "):])
+        assert stats["extra"] == True
+        assert stats["functions"]["a"]["calls"] == 1
+
+        p.last_report = time.time() - 1001
+        assert p.report_due()
+
+        (fd, filename) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            p = Profiler(filename)
+            p.record("b", 0.2)
+            p.request_report()
+            p.report(logs.append)
+            with open(filename) as f:
+                assert json.load(f)["functions"]["b"]["calls"] == 1
+            assert len(logs) == 1
+        finally:
+            os.unlink(filename)
+
+    def test_view_server(self):
+        p = Profiler()
+        vs = BenchViewServer(None, StringIO(), profiler=p)
+        vs.functions = dict(vs.functions, sum=lambda k, v, r: sum(v),
+                            show=lambda doc, req: "hello")
+
+        vs._command = "add_fun"
+        vs.add_fun("map_emit")
+        vs.add_fun("map_yield")
+        vs._command = "map_doc"
+        for doc in make_docs(10):
+            vs.map_doc(doc)
+        vs.reduce(["sum"], [[[1, "a"], 1], [[2, "b"], 2]])
+        vs.rereduce(["sum"], [3, 4])
+        vs.add_ddoc("_design/x", {"shows": {"s": "show"}})
+        vs.use_ddoc("_design/x", ["shows", "s"], [{}, {}])
+
+        mod = "couch_named_python.bench"
+        stats = p.stats()
+        functions = stats["functions"]
+        assert functions["map " + mod + ".map_emit"]["calls"] == 10
+        assert functions["map " + mod + ".map_yield"]["calls"] == 10
+        keys = set(functions)
+        assert "reduce couch_named_python.tests.test_profiler.<lambda>" \
+                in keys
+        assert "rereduce couch_named_python.tests.test_profiler.<lambda>" \
+                in keys
+        assert "shows couch_named_python.tests.test_profiler.<lambda>" \
+                in keys
+        assert stats["commands"]["map_doc"]["bytes_out"] > 10 * 20
+
+        assert vs.profile_stats()["reduce_cache"]["misses"] == 1
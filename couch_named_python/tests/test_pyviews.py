@@ -3,10 +3,23 @@
 import mox
 import sys
 import gc
+import json
 import os
+import time
+import types
+import shutil
+import tempfile
+import subprocess
+from nose.plugins.skip import SkipTest
 from . import EqIfIn
+from StringIO import StringIO
 from ..pyviews import BasePythonViewServer, NamedPythonViewServer, main
-from .. import pyviews
+from ..bench import BenchViewServer, make_docs
+from ..cache import LRUCache
+from ..base_io import RequestError
+from ..jsoncodec import StdlibCodec
+from .. import pyviews, pure, vectorized, batch_filter, log, memo, \
+        send, emit
 
 class TestBasePythonViewServer(object):
     def setup(self):
@@ -18,6 +31,7 @@ class TestBasePythonViewServer(object):
         self.mocker.StubOutWithMock(self.vs, "output")
         self.mocker.StubOutWithMock(self.vs, "log")
         self.mocker.StubOutWithMock(self.vs, "read_line")
+        self.mocker.StubOutWithMock(self.vs, "write")
 
     def teardown(self):
         self.mocker.UnsetStubs()
@@ -32,6 +46,52 @@ class TestBasePythonViewServer(object):
         assert self.vs.ddocs["second_doc"] == ({"second": True}, {})
         self.mocker.VerifyAll()
 
+    def test_ddoc_eviction(self):
+        self.mocker.StubOutWithMock(self.vs, "ddoc_shows")
+        self.vs.ddocs = LRUCache(2, maxbytes=100)
+        for i in range(5):
+            self.vs.okay()
+        self.vs.compile("f").AndReturn("f")
+        self.vs.ddoc_shows("f", ["args"])
+        self.vs.output("error", "query_protocol_error",
+                       "uncached design doc: a")
+        self.mocker.ReplayAll()
+
+        self.vs.add_ddoc("a", {"shows": {"s": "f"}})
+        self.vs.add_ddoc("b", {"x": 1})
+        self.vs._current_ddoc = "a"
+        self.vs.memo("key", lambda: 1)
+        self.vs._current_ddoc = "b"
+        self.vs.memo("key", lambda: 2)
+
+        # c pushes a out
+        self.vs.add_ddoc("c", {"shows": {"s": "f"}})
+        assert "a" not in self.vs.ddocs and "b" in self.vs.ddocs
+        assert sorted(self.vs.ddoc_memos) == ["b"]
+
+        # d is large, so pushes b out, although there is room for two
+        self.vs._input_line_length = 80
+        self.vs.add_ddoc("d", {"x": "large"})
+        assert self.vs.ddocs.keys() == ["c", "d"]
+        assert self.vs.ddocs.evictions == 2
+
+        self.vs._input_line_length = 0
+        self.vs.add_ddoc("e", {"shows": {"s": "f"}})
+        assert self.vs.ddocs.bytes == 99
+        self.vs.use_ddoc("e", ["shows", "s"], ["args"])
+        assert self.vs.profile_stats()["ddocs"] == \
+                {"d": {"bytes": 80, "functions": 0},
+                 "e": {"bytes": 19, "functions": 1}}
+
+        try:
+            self.vs.use_ddoc("a", ["shows", "s"], ["args"])
+        except SystemExit as e:
+            assert e.code == 1
+        else:
+            raise AssertionError("Expected sys.exit(1)")
+
+        self.mocker.VerifyAll()
+
     def test_use_ddoc(self):
         self.mocker.StubOutWithMock(self.vs, "ddoc_shows")
         self.mocker.StubOutWithMock(self.vs, "ddoc_lists")
@@ -212,6 +272,7 @@ class TestBasePythonViewServer(object):
 
         self.vs.reset({"reduce_limit": True})
         assert len(self.vs.map_funcs) == 0
+        assert len(self.vs.map_plan) == 0
         assert self.vs.query_config == {"reduce_limit": True}
 
         self.mocker.VerifyAll()
@@ -243,6 +304,7 @@ class TestBasePythonViewServer(object):
         assert self.vs.map_funcs == [my_map]
         self.vs.add_fun("another map")
         assert self.vs.map_funcs == [my_map, my_map2]
+        assert [f for (f, invoke) in self.vs.map_plan] == [my_map, my_map2]
         self.mocker.VerifyAll()
 
     def test_set_lib(self):
@@ -305,6 +367,50 @@ class TestBasePythonViewServer(object):
             self.vs.map_doc(d)
         self.mocker.VerifyAll()
 
+    def test_emit_only_during_map(self):
+        from couch_named_python import emit, _set_vs
+
+        def check_emit_fails():
+            try:
+                emit("key", "value")
+            except AssertionError:
+                pass
+            else:
+                raise AssertionError("Expected emit to fail")
+
+        def map_one(doc):
+            emit(doc["_id"], 1)
+            emit(key=doc["_id"], value=2)
+        def show(doc, req):
+            check_emit_fails()
+            return "ok"
+
+        self.vs.compile("one").AndReturn(map_one)
+        self.vs.okay()
+        self.vs.output([["d1", 1], ["d1", 2]])
+        self.vs.okay()
+        self.vs.compile("show").AndReturn(show)
+        self.vs.output("resp", {"body": "ok"})
+        self.mocker.ReplayAll()
+
+        check_emit_fails()
+        self.vs.add_fun("one")
+        self.vs.map_doc({"_id": "d1"})
+        check_emit_fails()
+        self.vs.add_ddoc("d", {"shows": {"s": "show"}})
+        self.vs.use_ddoc("d", ["shows", "s"], [{}, {}])
+        check_emit_fails()
+
+        # outside of map_doc, emit falls back to calling vs.emit
+        self.vs.emissions = []
+        _set_vs(self.vs, ["emit"])
+        emit("a", "b")
+        _set_vs(None)
+        assert self.vs.emissions == [["a", "b"]]
+        check_emit_fails()
+
+        self.mocker.VerifyAll()
+
     def test_map_doc_no_functions(self):
         self.vs.output()
         self.mocker.ReplayAll()
@@ -324,13 +430,11 @@ class TestBasePythonViewServer(object):
 
         self.vs.compile("func1").AndReturn(f)
         self.vs.compile("func2").AndReturn(g)
-        self.vs.output(True, [41 + 102 + 251, {"meh": True}], limit=None)
-        self.vs.compile("func1").AndReturn(f)
-        self.vs.compile("func2").AndReturn(g)
+        self.vs.output(True, [41 + 102 + 251, {"meh": True}])
         self.vs.log("Ignored exception (reduce_runtime_error): "
                 "ValueError: Yeah whatever, func_name=g, "
                 "func_mod=couch_named_python.tests.test_pyviews")
-        self.vs.output(True, [41 + 3 + 2, None], limit=None)
+        self.vs.output(True, [41 + 3 + 2, None])
         self.mocker.ReplayAll()
 
         self.vs.reduce(["func1", "func2"],
@@ -351,25 +455,145 @@ class TestBasePythonViewServer(object):
 
         self.vs.compile("func1").AndReturn(f)
         self.vs.compile("func2").AndReturn(g)
-        self.vs.output(True, [11, 12], limit=None)
-        self.vs.compile("func1").AndReturn(f)
-        self.vs.compile("func2").AndReturn(g)
+        self.vs.output(True, [11, 12])
         self.vs.log("Ignored exception (rereduce_runtime_error): "
                 "AssertionError, func_name=g, "
                 "func_mod=couch_named_python.tests.test_pyviews")
-        self.vs.output(True, [4, None], limit=None)
+        self.vs.output(True, [4, None])
         self.mocker.ReplayAll()
 
         self.vs.rereduce(["func1", "func2"], [7, 5])
         self.vs.rereduce(["func1", "func2"], [-5, 10])
         self.mocker.VerifyAll()
 
+    def test_reduce_cache(self):
+        f = lambda k, v, r: sum(v)
+        g = lambda k, v, r: len(v)
+
+        self.vs.reduce_funcs.maxsize = 1
+        self.vs.compile("func1|1").AndReturn(f)
+        self.vs.output(True, [3])
+        self.vs.output(True, [3, 3])
+        self.vs.compile("func2|1").AndReturn(g)
+        self.vs.output(True, [2])
+        self.vs.compile("func1|1").AndReturn(f)
+        self.vs.output(True, [3])
+        self.vs.compile("func1|1").AndReturn(f)
+        self.vs.output(True, [3])
+        self.mocker.ReplayAll()
+
+        data = [[["k", "i"], 1], [["k2", "i2"], 2]]
+        self.vs.reduce(["func1|1"], data)
+        self.vs.rereduce(["func1|1", "func1|1"], [1, 2])
+        assert self.vs.reduce_funcs.stats() == {"size": 1, "maxsize": 1,
+                "bytes": 0, "maxbytes": None,
+                "hits": 2, "misses": 1, "evictions": 0,
+                "expirations": 0}
+
+        # func2 pushes func1 out of the cache
+        self.vs.reduce(["func2|1"], data)
+        self.vs.reduce(["func1|1"], data)
+        assert self.vs.reduce_funcs.evictions == 2
+
+        self.vs.clear_caches()
+        self.vs.reduce(["func1|1"], data)
+        assert self.vs.reduce_funcs.misses == 4
+
+        self.mocker.VerifyAll()
+
+    def test_rereduce_memo(self):
+        calls = []
+        def f(k, v, r):
+            calls.append(v)
+            return sum(v)
+        g = lambda k, v, r: len(v)
+
+        self.vs.rereduce_memo = LRUCache(2)
+        self.vs.compile("f|1").AndReturn(pure(f))
+        self.vs.compile("g|1").AndReturn(g)
+        self.vs.output(True, [3, 2])
+        self.vs.output(True, [3, 2])
+        self.vs.output(True, [7, 2])
+        self.vs.output(True, [3])
+        self.mocker.ReplayAll()
+
+        self.vs.rereduce(["f|1", "g|1"], [1, 2])
+        self.vs.rereduce(["f|1", "g|1"], [1, 2])
+        assert calls == [[1, 2]]
+        self.vs.rereduce(["f|1", "g|1"], [3, 4])
+        assert calls == [[1, 2], [3, 4]]
+        assert self.vs.rereduce_memo.stats() == {"size": 2, "maxsize": 2,
+                "bytes": 0, "maxbytes": None,
+                "hits": 1, "misses": 2, "evictions": 0,
+                "expirations": 0}
+        assert self.vs.profile_stats()["rereduce_cache"]["hits"] == 1
+
+        self.vs.rereduce(["f|1"], [1, 2])
+        assert len(calls) == 2
+
+        self.mocker.VerifyAll()
+
+    def test_vectorized(self):
+        if pyviews._import_numpy() is None:
+            raise SkipTest("numpy is not installed")
+
+        seen = []
+        def f(k, v, r):
+            seen.append(v)
+            return {"sum": v.sum(axis=0), "max": v.max()}
+
+        self.vs.compile("f|1").AndReturn(vectorized(f))
+        self.vs.compile("g|1").AndReturn(lambda k, v, r: len(v))
+        self.vs.output(True, [{"sum": 6, "max": 3}, 3])
+        self.vs.output(True, [{"sum": [4, 6], "max": 4}, 2])
+        self.vs.log(EqIfIn("'list' object has no attribute 'sum'"))
+        self.vs.output(True, [None, 2])
+        self.mocker.ReplayAll()
+
+        data = [[["k", "i"], 1], [["k2", "i2"], 2], [["k3", "i3"], 3]]
+        self.vs.reduce(["f|1", "g|1"], data)
+        self.vs.rereduce(["f|1", "g|1"], [[1, 2], [3, 4]])
+        assert type(seen[0]).__name__ == "ndarray"
+        assert seen[1].shape == (2, 2)
+
+        # Not numbers: a list, and so f fails
+        self.vs.rereduce(["f|1", "g|1"], [{"a": 1}, {"b": 2}])
+        assert seen[2] == [{"a": 1}, {"b": 2}]
+
+        self.mocker.VerifyAll()
+
+    def test_vectorized_without_numpy(self):
+        f = vectorized(lambda k, v, r: v)
+        self.vs.compile("f|1").AndReturn(f)
+        self.vs.output(True, [[1, 2]])
+        self.mocker.ReplayAll()
+
+        numpy = pyviews._numpy
+        pyviews._numpy = False
+        try:
+            self.vs.rereduce(["f|1"], [1, 2])
+        finally:
+            pyviews._numpy = numpy
+
+        self.mocker.VerifyAll()
+
+    def test_to_builtin(self):
+        if pyviews._import_numpy() is None:
+            raise SkipTest("numpy is not installed")
+        import numpy
+
+        r = pyviews._to_builtin({"a": numpy.int32(4),
+                                 "b": (numpy.float64(0.5), "s"),
+                                 "c": numpy.array([1, 2])})
+        assert r == {"a": 4, "b": [0.5, "s"], "c": [1, 2]}
+        assert type(r["a"]) is int and type(r["b"][0]) is float
+        assert type(r["c"]) is list
+
     def test_reduce_limit(self):
         self.vs.okay()
         self.vs.compile("func").AndReturn(lambda k, v, r: sum(v))
-        self.vs.output(True, [579], limit=200)
-        self.vs.compile("func").AndReturn(lambda k, v, r: sum(v))
-        self.vs.output(True, [1134], limit=500)
+        self.vs.write("[true,[579]]\n")
+        self.vs.write("[true,[1134]]\n")
         self.mocker.ReplayAll()
 
         self.vs._input_line_length = 10
@@ -380,6 +604,61 @@ class TestBasePythonViewServer(object):
 
         self.mocker.VerifyAll()
 
+    def test_reduce_overflow(self):
+        encoded = []
+        class Codec(object):
+            def dumps(self, obj):
+                encoded.append(obj)
+                return json.dumps(obj, separators=(',', ':'))
+
+        self.vs.codec = Codec()
+        self.vs.okay()
+        self.vs.compile("func").AndReturn(lambda k, v, r: v)
+        self.vs.compile("short").AndReturn(lambda k, v, r: len(v))
+        self.vs.write("[true,[[" + ",".join(["1"] * 94) + "]]]\n")
+        self.vs.output("error", "reduce_overflow_error",
+                       "Reduce output must shrink more rapidly: Current "
+                       "output: '" + ("[[" + "10," * 40)[:100] + "'... "
+                       "(limit 200 bytes)")
+        self.vs.output("error", "reduce_overflow_error",
+                       "Reduce output must shrink more rapidly: Current "
+                       "output: '[95'... (limit 200 bytes)")
+        self.mocker.ReplayAll()
+
+        self.vs.reset({"reduce_limit": True})
+        self.vs.rereduce(["func"], [1] * 94)
+        self.vs.rereduce(["func", "short"], [10] * 70)
+        assert encoded == [[1] * 94, [10] * 70]
+
+        # func's output must be too long, so isn't encoded
+        self.vs.rereduce(["short", "func"], [1] * 95)
+        assert encoded == [[1] * 94, [10] * 70, 95]
+
+        self.mocker.VerifyAll()
+
+    def test_batch_filter(self):
+        calls = []
+        @batch_filter
+        def f(docs, req):
+            calls.append(len(docs))
+            return [doc["n"] > req["min"] for doc in docs][:req["limit"]]
+
+        self.vs.output(True, [False, False, True, True])
+        self.mocker.ReplayAll()
+
+        docs = [{"n": i} for i in xrange(4)]
+        self.vs.ddoc_filters(f, [docs, {"min": 1, "limit": 4}])
+        assert calls == [4]
+
+        try:
+            self.vs.ddoc_filters(f, [docs, {"min": 1, "limit": 3}])
+        except ValueError as e:
+            assert str(e) == "Batch filter returned 3 results for 4 docs"
+        else:
+            raise AssertionError("Expected ValueError")
+
+        self.mocker.VerifyAll()
+
     def test_update(self):
         def f(doc, req):
             if req == {"blah": 2}:
@@ -409,6 +688,84 @@ class TestBasePythonViewServer(object):
 
         self.mocker.VerifyAll()
 
+    def test_abort(self):
+        def f(doc, req):
+            send("partial")
+            raise ValueError("failed")
+
+        self.vs.okay()
+        self.vs.compile("func").AndReturn(f)
+        self.mocker.ReplayAll()
+
+        self.vs.add_ddoc("desid", {"shows": {"f": "func"}})
+        try:
+            self.vs.use_ddoc("desid", ["shows", "f"], [None, {}])
+        except ValueError:
+            self.vs.abort()
+        else:
+            raise AssertionError("Expected ValueError")
+
+        # state from the failed request doesn't leak into the next one
+        assert self.vs.chunks == []
+        try:
+            send("later")
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError("send() should be unavailable")
+
+        self.mocker.VerifyAll()
+
+    def test_memo(self):
+        computed = []
+        def f(doc, req):
+            def compute():
+                computed.append(req["query"])
+                return len(computed)
+            return [doc, str(memo(req["query"], compute))]
+
+        self.vs.okay()
+        self.vs.compile("func").AndReturn(f)
+        self.vs.output("up", None, {"body": "1"})
+        self.vs.output("up", None, {"body": "1"})
+        self.vs.output("up", None, {"body": "2"})
+        self.vs.okay()
+        self.vs.compile("func").AndReturn(f)
+        self.vs.output("up", None, {"body": "3"})
+        self.mocker.ReplayAll()
+
+        path = ["updates", "f"]
+        self.vs.add_ddoc("desid", {"updates": {"f": "func"}})
+        self.vs.use_ddoc("desid", path, [None, {"query": {"a": 1}}])
+        self.vs.use_ddoc("desid", path, [None, {"query": {"a": 1}}])
+        self.vs.use_ddoc("desid", path, [None, {"query": {"a": 2}}])
+        assert self.vs.profile_stats()["memo"]["desid"]["hits"] == 1
+
+        # replacing the ddoc forgets its values
+        self.vs.add_ddoc("desid", {"updates": {"f": "func"}})
+        self.vs.use_ddoc("desid", path, [None, {"query": {"a": 1}}])
+        assert computed == [{"a": 1}, {"a": 2}, {"a": 1}]
+
+        try:
+            memo("x", lambda: 1)
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError("memo() should be unavailable")
+
+        self.mocker.VerifyAll()
+
+    def test_memo_ttl(self):
+        self.vs._current_ddoc = "desid"
+        assert self.vs.memo("a", lambda: 1) == 1
+        assert self.vs.memo("a", lambda: 2) == 1
+        assert self.vs.memo("b", lambda: 3, ttl=0) == 3
+        assert self.vs.memo("b", lambda: 4, ttl=0) == 4
+        assert self.vs.ddoc_memos["desid"].expirations == 1
+
+        self.vs.clear_caches()
+        assert self.vs.memo("a", lambda: 5) == 5
+
     def test_ddoc_lists(self):
         def n1(head, req):
             from couch_named_python import start, send, get_row
@@ -485,7 +842,7 @@ class TestBasePythonViewServer(object):
         self.vs.compile("n1").AndReturn(n1)
         self.vs.output("start", ["hello world"], {"code": 100})
         self.vs.read_line().AndReturn(["list_row", {"row": "one"}])
-        self.vs.output("chunks", [])
+        self.vs.write('["chunks",[]]\n')
         self.vs.read_line().AndReturn(["list_row", {"row": "two"}])
         self.vs.output("chunks", ["moo", "baa"])
         self.vs.read_line().AndReturn(["list_end"])
@@ -500,7 +857,7 @@ class TestBasePythonViewServer(object):
         self.vs.output("start", [], {})
         self.vs.read_line().AndReturn(["list_row", {"row": "one"}])
         self.vs.log("blah")
-        self.vs.output("chunks", [])
+        self.vs.write('["chunks",[]]\n')
         self.vs.read_line().AndReturn(["list_row", {"row": "two"}])
         self.vs.output("end", [])
 
@@ -540,9 +897,9 @@ class TestBasePythonViewServer(object):
         self.vs.compile("g3").AndReturn(g3)
         self.vs.output("start", [], {})
         self.vs.read_line().AndReturn(["list_row", {"row": "one"}])
-        self.vs.output("chunks", [])
+        self.vs.write('["chunks",[]]\n')
         self.vs.read_line().AndReturn(["list_row", {"row": "two"}])
-        self.vs.output("chunks", [])
+        self.vs.write('["chunks",[]]\n')
         self.vs.read_line().AndReturn(["list_end"])
         self.vs.output("end", [])
 
@@ -574,6 +931,220 @@ class TestBasePythonViewServer(object):
 
         # TODO: is sending {"error", "not_found", msg} for ddoc lists correct?
 
+    def test_list_flush_policy(self):
+        def f(head, req):
+            from couch_named_python import send, get_row
+            send("header\n")
+            while True:
+                row = get_row()
+                if row is None:
+                    break
+                send("row " + str(row) + "\n")
+            return "footer\n"
+
+        self.vs.okay()
+        self.vs.compile("f").AndReturn(f)
+
+        # flush every 20 bytes
+        self.vs.output("start", ["header\n"], {})
+        self.vs.read_line().AndReturn(["list_row", 1])
+        self.vs.write('["chunks",[]]\n')
+        self.vs.read_line().AndReturn(["list_row", 2])
+        self.vs.write('["chunks",[]]\n')
+        self.vs.read_line().AndReturn(["list_row", 3])
+        self.vs.write('["chunks",[]]\n')
+        self.vs.read_line().AndReturn(["list_row", 4])
+        self.vs.output("chunks", ["row 1\nrow 2\nrow 3\n"])
+        self.vs.read_line().AndReturn(["list_end"])
+        self.vs.output("end", ["row 4\nfooter\n"])
+
+        # flush every 2 rows
+        self.vs.output("start", ["header\n"], {})
+        self.vs.read_line().AndReturn(["list_row", 1])
+        self.vs.write('["chunks",[]]\n')
+        self.vs.read_line().AndReturn(["list_row", 2])
+        self.vs.write('["chunks",[]]\n')
+        self.vs.read_line().AndReturn(["list_row", 3])
+        self.vs.output("chunks", ["row 1\nrow 2\n"])
+        self.vs.read_line().AndReturn(["list_end"])
+        self.vs.output("end", ["row 3\nfooter\n"])
+
+        self.mocker.ReplayAll()
+
+        self.vs.add_ddoc("dd", {"lists": {"f": "f"}})
+        self.vs.list_flush_bytes = 18
+        self.vs.use_ddoc("dd", ["lists", "f"], [{}, {}])
+        self.vs.list_flush_bytes = 0
+        self.vs.list_flush_rows = 2
+        self.vs.use_ddoc("dd", ["lists", "f"], [{}, {}])
+
+        self.mocker.VerifyAll()
+
+class TestMapWorkers(object):
+    def setup(self):
+        self.stdout = StringIO()
+        self.vs = BenchViewServer(None, self.stdout, map_workers=2)
+        self.vs.functions = dict(BenchViewServer.functions, bad=bad_map,
+                                 unencodable=unencodable_map)
+
+    def teardown(self):
+        self.vs._stop_map_pool()
+
+    def test_map_docs(self):
+        self.vs.add_fun("map_emit")
+        self.vs.add_fun("bad")
+        docs = make_docs(50)
+        self.vs.map_docs(docs)
+        pool = self.vs._map_pool
+        assert pool is not None
+
+        # the same functions: the pool is reused
+        self.vs.reset()
+        self.vs.add_fun("map_emit")
+        self.vs.add_fun("bad")
+        self.vs.map_docs(docs[:10])
+        assert self.vs._map_pool is pool
+
+        serial = BenchViewServer(None, StringIO())
+        serial.functions = self.vs.functions
+        serial.add_fun("map_emit")
+        serial.add_fun("bad")
+        serial.map_docs(docs)
+        serial.reset()
+        serial.add_fun("map_emit")
+        serial.add_fun("bad")
+        serial.map_docs(docs[:10])
+
+        assert self.stdout.getvalue() == serial.stdout.getvalue()
+        assert "doc_id=doc3, func_name=bad_map" in self.stdout.getvalue()
+
+        # different functions: a new pool
+        self.vs.reset()
+        self.vs.add_fun("map_yield")
+        self.vs.map_docs(docs[:5])
+        assert self.vs._map_pool is not pool
+
+    def test_map_docs_errors(self):
+        # a failure outside the map functions (here, encoding the output)
+        # must still produce exactly one response per document
+        docs = make_docs(20)
+        outputs = []
+        for vs in [self.vs, BenchViewServer(None, StringIO())]:
+            vs.functions = self.vs.functions
+            vs.add_fun("map_emit")
+            vs.add_fun("unencodable")
+            vs.map_docs(docs)
+            lines = [line for line in vs.stdout.getvalue().splitlines()[2:]
+                     if not line.startswith('["log",')]
+            assert len(lines) == len(docs)
+            assert len([line for line in lines
+                        if line.startswith('["error",')]) == 5
+            outputs.append(lines)
+
+        assert outputs[0] == outputs[1]
+        assert outputs[0][1].startswith(
+                '["error","map_doc_runtime_error","TypeError: ')
+        assert outputs[0][2].startswith('[[["doc2",2]')
+
+    def test_single_doc(self):
+        self.vs.add_fun("map_emit")
+        self.vs.map_docs(make_docs(1))
+        assert self.vs._map_pool is None
+        assert self.stdout.getvalue() == \
+                'true\n[[["doc0",0],[["type0",0],null]]]\n'
+
+def bad_map(doc):
+    if doc["n"] % 3 == 0:
+        raise ValueError("multiple of three")
+
+def unencodable_map(doc):
+    if doc["n"] % 4 == 1:
+        emit(set(), None)
+
+def odd_filter(doc, req):
+    if doc["n"] == 7:
+        log("seven")
+    return doc["n"] % req["query"]["mod"]
+
+@batch_filter
+def batch_odd_filter(docs, req):
+    mod = req["query"]["mod"]
+    log("batch of {0}".format(len(docs)))
+    return [doc["n"] % mod for doc in docs]
+
+memo_mod = 2
+
+def memo_filter(doc, req):
+    return doc["n"] % memo("mod", lambda: memo_mod)
+
+class TestFilterWorkers(object):
+    def setup(self):
+        self.stdout = StringIO()
+        self.vs = BenchViewServer(None, self.stdout, filter_workers=2)
+        self.vs.filter_pool_min_docs = 10
+        self.req = {"query": {"mod": 2}}
+
+    def teardown(self):
+        self.vs._stop_filter_pool()
+
+    def serial(self, func, docs):
+        serial = BenchViewServer(None, StringIO())
+        serial.ddoc_filters(func, [docs, self.req])
+        return serial.stdout.getvalue()
+
+    def test_filter(self):
+        docs = make_docs(50)
+        self.vs.ddoc_filters(odd_filter, [docs, self.req])
+        assert self.vs._filter_pool is not None
+        assert self.stdout.getvalue() == self.serial(odd_filter, docs)
+        assert self.stdout.getvalue().startswith('["log","seven"]\n')
+
+    def test_batch_filter(self):
+        docs = make_docs(50)
+        self.vs.ddoc_filters(batch_odd_filter, [docs, self.req])
+        output = self.stdout.getvalue().splitlines()
+
+        # one batch per task
+        assert output[:8] == ['["log","batch of 7"]'] * 7 + \
+                             ['["log","batch of 1"]']
+        assert output[8] == self.serial(odd_filter, docs).splitlines()[1]
+
+    def test_small_batches(self):
+        self.vs.ddoc_filters(odd_filter, [make_docs(5), self.req])
+        assert self.vs._filter_pool is None
+
+    def test_replaced_ddoc(self):
+        global memo_mod
+        ddoc = {"filters": {"odd": "memo_filter"}}
+        docs = make_docs(50)
+        self.vs.compile = lambda func: globals()[func]
+
+        def filter_docs():
+            self.stdout.truncate(0)
+            self.vs.use_ddoc("_design/a", ["filters", "odd"],
+                             [docs, self.req])
+            assert self.vs._filter_pool is not None
+            return json.loads(self.stdout.getvalue())[1]
+
+        try:
+            self.vs.add_ddoc("_design/a", ddoc)
+            assert filter_docs() == [bool(doc["n"] % 2) for doc in docs]
+
+            # the workers' memo values are forgotten with the old ddoc
+            memo_mod = 3
+            self.vs.add_ddoc("_design/a", ddoc)
+            assert self.vs._filter_pool is None
+            assert filter_docs() == [bool(doc["n"] % 3) for doc in docs]
+        finally:
+            memo_mod = 2
+
+    def test_unpicklable(self):
+        f = lambda doc, req: True
+        self.vs.ddoc_filters(f, [make_docs(50), self.req])
+        assert self.vs._filter_pool is None
+        expect = "[true,[true" + ",true" * 49 + "]]\n"
+        assert self.stdout.getvalue() == expect
+
 class TestNamedPythonViewServer(object):
     def setup(self):
         self.mocker = mox.Mox()
@@ -595,13 +1166,14 @@ class TestNamedPythonViewServer(object):
 
         self.mocker.VerifyAll()
 
-    def compile_sysexit(self, what):
+    def compile_error(self, what):
+        # run() would report the error
         try:
             self.vs.compile(what)
-        except SystemExit as e:
-            assert e.code == 1
+        except RequestError as e:
+            self.vs.error(e.error, e.reason)
         else:
-            raise ValueError("Expected sys.exit(1)")
+            raise ValueError("Expected RequestError")
 
     def test_bad_name(self):
         for bad_string in ["asdf..fghj", "", ".", ".asdf.dfgh", "jkg.asdf.",
@@ -611,7 +1183,7 @@ class TestNamedPythonViewServer(object):
                            "ValueError: Invalid function path")
             self.mocker.ReplayAll()
 
-            self.compile_sysexit(bad_string)
+            self.compile_error(bad_string)
 
             self.mocker.VerifyAll()
             self.mocker.ResetAll()
@@ -622,7 +1194,7 @@ class TestNamedPythonViewServer(object):
                        "ImportError: No module named couch_named_python_other")
         self.mocker.ReplayAll()
 
-        self.compile_sysexit("couch_named_python_other.asdf")
+        self.compile_error("couch_named_python_other.asdf")
         self.mocker.VerifyAll()
         self.mocker.ResetAll()
 
@@ -632,39 +1204,39 @@ class TestNamedPythonViewServer(object):
                        "'other_function'")
         self.mocker.ReplayAll()
 
-        self.compile_sysexit("couch_named_python.tests.example_mod_b."
+        self.compile_error("couch_named_python.tests.example_mod_b."
                              "other_function")
         self.mocker.VerifyAll()
         self.mocker.ResetAll()
 
     def test_checks_version(self):
-        # No traceback
+        # Nothing has changed on disk, so fails without reloading
         self.vs.output("error", "compile_load",
                        "ValueError: Loaded version None did not match "
                        "expected version 2")
         self.mocker.ReplayAll()
 
-        self.compile_sysexit("couch_named_python.tests.example_mod_b.func_a|2")
+        self.compile_error("couch_named_python.tests.example_mod_b.func_a|2")
         self.mocker.VerifyAll()
         self.mocker.ResetAll()
 
-        # No traceback
+        # Nothing has changed on disk, so fails without reloading
         self.vs.output("error", "compile_load",
                        "ValueError: Loaded version 556 did not match "
                        "expected version None")
         self.mocker.ReplayAll()
 
-        self.compile_sysexit("couch_named_python.tests.example_mod_b.func_c")
+        self.compile_error("couch_named_python.tests.example_mod_b.func_c")
         self.mocker.VerifyAll()
         self.mocker.ResetAll()
 
-        # No traceback
+        # Nothing has changed on disk, so fails without reloading
         self.vs.output("error", "compile_load",
                        "ValueError: Loaded version 556 did not match "
                        "expected version 2")
         self.mocker.ReplayAll()
 
-        self.compile_sysexit("couch_named_python.tests.example_mod_b.func_c|2")
+        self.compile_error("couch_named_python.tests.example_mod_b.func_c|2")
         self.mocker.VerifyAll()
         self.mocker.ResetAll()
 
@@ -683,12 +1255,218 @@ class TestNamedPythonViewServer(object):
         self.mocker.VerifyAll()
 
 
+    def test_preload(self):
+        self.vs.output("log", "Ignored exception (preload "
+                       "couch_named_python.tests.example_mod_b.func_b|3): "
+                       "ValueError: Loaded version 2 did not match "
+                       "expected version 3")
+        self.vs.output("log", "Ignored exception (preload nonsense): "
+                       "ValueError: Invalid function path")
+        self.mocker.StubOutWithMock(self.vs, "reload_modules")
+        self.vs.reload_modules("couch_named_python.tests.example_mod_b")\
+                .AndReturn(False)
+        self.mocker.ReplayAll()
+
+        name = "couch_named_python.tests.example_mod_c"
+        sys.modules.pop(name, None)
+        self.vs.preload([name + ".f",
+                         "couch_named_python.tests.example_mod_b.func_b|3",
+                         "nonsense"])
+        assert name in sys.modules
+
+        self.mocker.VerifyAll()
+
+class TestReload(object):
+    module_a = """
+from couch_named_python import version
+
+def helper():
+    return {helper}
+
+@version({version})
+def f(doc):
+    pass
+"""
+
+    module_b = """
+from couch_named_python import version
+from {dependency} import helper
+
+@version(1)
+def g(doc):
+    yield helper(), None
+"""
+
+    def setup(self):
+        self.mocker = mox.Mox()
+        self.tempdir = tempfile.mkdtemp()
+        sys.path.insert(0, self.tempdir)
+        self.write("cnp_reload_a", self.module_a.format(helper=1, version=1))
+        self.write("cnp_reload_b",
+                   self.module_b.format(dependency="cnp_reload_a"))
+        self.vs = NamedPythonViewServer(None, None)
+        self.mocker.StubOutWithMock(self.vs, "output")
+        self.mocker.StubOutWithMock(self.vs, "okay")
+
+    def teardown(self):
+        self.mocker.UnsetStubs()
+        sys.path.remove(self.tempdir)
+        for name in ["cnp_reload_a", "cnp_reload_b", "cnp_reload_z"]:
+            sys.modules.pop(name, None)
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, source, mtime=None):
+        filename = os.path.join(self.tempdir, name + ".py")
+        with open(filename, "w") as f:
+            f.write(source)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+
+    def test_reload(self):
+        self.vs.okay()
+        self.vs.output("log", "Reloading modules: cnp_reload_a, cnp_reload_b")
+        self.mocker.ReplayAll()
+
+        self.vs.compile("cnp_reload_a.f|1")
+        self.vs.add_fun("cnp_reload_b.g|1")
+        self.vs.reduce_funcs["something|1"] = None
+        self.vs.ddocs["_design/a"] = ({}, {("shows", "a"): None})
+        assert list(self.vs.map_funcs[0]({})) == [(1, None)]
+
+        self.write("cnp_reload_a", self.module_a.format(helper=2, version=2),
+                   mtime=time.time() + 10)
+        f = self.vs.compile("cnp_reload_a.f|2")
+
+        assert f is sys.modules["cnp_reload_a"].f
+        assert self.vs.map_funcs == [sys.modules["cnp_reload_b"].g]
+        assert self.vs.map_func_names == ["cnp_reload_b.g|1"]
+        assert list(self.vs.map_funcs[0]({})) == [(2, None)]
+        assert len(self.vs.reduce_funcs) == 0
+        assert self.vs.ddocs["_design/a"] == ({}, {})
+
+        self.mocker.VerifyAll()
+
+    def test_reload_order(self):
+        # cnp_reload_b (which uses cnp_reload_z) sorts first, but must be
+        # reloaded second
+        self.vs.okay()
+        self.vs.output("log", "Reloading modules: cnp_reload_z, cnp_reload_b")
+        self.mocker.ReplayAll()
+
+        self.write("cnp_reload_z", self.module_a.format(helper=1, version=1))
+        self.write("cnp_reload_b",
+                   self.module_b.format(dependency="cnp_reload_z"))
+        self.vs.add_fun("cnp_reload_b.g|1")
+        assert list(self.vs.map_funcs[0]({})) == [(1, None)]
+
+        self.write("cnp_reload_z", self.module_a.format(helper=2, version=2),
+                   mtime=time.time() + 10)
+        self.vs.compile("cnp_reload_z.f|2")
+        assert list(self.vs.map_funcs[0]({})) == [(2, None)]
+
+        self.mocker.VerifyAll()
+
+    def test_modules_loaded(self):
+        # a view server forked from a daemon that loaded the modules at
+        # started, after which both were modified (times are in the
+        # future, so that no other modules count as modified)
+        __import__("cnp_reload_b")
+        started = time.time() + 100
+        self.write("cnp_reload_a", self.module_a.format(helper=2, version=1),
+                   mtime=started + 50)
+        self.write("cnp_reload_b",
+                   self.module_b.format(dependency="cnp_reload_a")
+                   .replace("@version(1)", "@version(2)"), mtime=started + 50)
+
+        self.vs = NamedPythonViewServer(None, None, modules_loaded=started)
+        self.mocker.StubOutWithMock(self.vs, "output")
+        self.vs.output("log", "Reloading modules: cnp_reload_a, cnp_reload_b")
+        self.mocker.ReplayAll()
+
+        g = self.vs.compile("cnp_reload_b.g|2")
+        assert list(g({})) == [(2, None)]
+
+        self.mocker.VerifyAll()
+
+    def test_map_function_mismatched(self):
+        self.vs.okay()
+        self.vs.okay()
+        self.vs.output("log", "Reloading modules: cnp_reload_a")
+        self.vs.output("error", "compile_load",
+                       "ValueError: Loaded version 2 did not match "
+                       "expected version 1")
+        self.mocker.ReplayAll()
+
+        self.vs.add_fun("cnp_reload_a.f|1")
+        self.vs.add_fun("cnp_reload_a.f|1")
+        map_plan = self.vs.map_plan
+
+        self.write("cnp_reload_a", self.module_a.format(helper=2, version=2),
+                   mtime=time.time() + 10)
+        try:
+            self.vs.compile("cnp_reload_a.f|2")
+        except SystemExit:
+            pass
+        else:
+            raise AssertionError("Expected SystemExit")
+
+        assert self.vs.map_func_names == ["cnp_reload_a.f|1"] * 2
+        assert self.vs.map_plan is map_plan
+
+        self.mocker.VerifyAll()
+
+    def compile_error(self, func_id):
+        try:
+            self.vs.compile(func_id)
+        except RequestError as e:
+            self.vs.error(e.error, e.reason)
+        else:
+            raise ValueError("Expected RequestError")
+
+    def test_still_mismatched(self):
+        mismatched = ("ValueError: Loaded version 1 did not match "
+                      "expected version 2")
+        self.vs.output("error", "compile_load", mismatched)
+        self.vs.output("error", "compile_load", mismatched)
+        self.vs.output("log", "Reloading modules: cnp_reload_a")
+        self.vs.output("error", "compile_load", mismatched)
+        self.vs.output("error", "compile_load", mismatched)
+        self.mocker.ReplayAll()
+
+        # nothing has changed on disk, so nothing is reloaded
+        __import__("cnp_reload_a")
+        self.compile_error("cnp_reload_a.f|2")
+        self.compile_error("cnp_reload_a.f|2")
+
+        # reloaded once when the file changes, even if still mismatched
+        self.write("cnp_reload_a", self.module_a.format(helper=2, version=1),
+                   mtime=time.time() + 10)
+        self.compile_error("cnp_reload_a.f|2")
+        self.compile_error("cnp_reload_a.f|2")
+
+        self.mocker.VerifyAll()
+
+    def test_freshly_imported(self):
+        # cnp_reload_a was changed after the server started, but is
+        # imported for the first time by compile, so is already current
+        self.write("cnp_reload_a", self.module_a.format(helper=1, version=1),
+                   mtime=time.time() + 10)
+        self.vs.output("error", "compile_load",
+                       "ValueError: Loaded version 1 did not match "
+                       "expected version 2")
+        self.mocker.ReplayAll()
+
+        self.compile_error("cnp_reload_a.f|2")
+        self.mocker.VerifyAll()
+
 class TestMain(object):
     def setup(self):
         self.mocker = mox.Mox()
         self.mocker.StubOutWithMock(os, "fdopen")
         self.sys_stdin = sys.stdin
         self.sys_stdout = sys.stdout
+        self.sys_argv = sys.argv
+        sys.argv = ["couch-named-python"]
         sys.stdin = self.mocker.CreateMock(file)
         sys.stdout = self.mocker.CreateMock(file)
         self.vs = self.mocker.CreateMock(NamedPythonViewServer)
@@ -697,6 +1475,7 @@ class TestMain(object):
     def teardown(self):
         sys.stdin = self.sys_stdin
         sys.stdout = self.sys_stdout
+        sys.argv = self.sys_argv
         self.mocker.UnsetStubs()
 
     def test_main(self):
@@ -708,10 +1487,229 @@ class TestMain(object):
         sys.stdout.fileno().AndReturn(7890)
         os.fdopen(7890, 'w', 1).AndReturn(sout)
 
-        pyviews.NamedPythonViewServer(sin, sout).AndReturn(self.vs)
+        pyviews.NamedPythonViewServer(sin, sout, batch=0, codec=None,
+                                      map_workers=0, list_flush_bytes=0,
+                                      list_flush_rows=0, filter_workers=0,
+                                      ddoc_cache_size=None,
+                                      ddoc_cache_bytes=None,
+                                      rereduce_cache_size=0, profiler=None,
+                                      recorder=None,
+                                      modules_loaded=mox.IsA(float))\
+                .AndReturn(self.vs)
+        self.vs.run()
+
+        self.mocker.ReplayAll()
+
+        main()
+        self.mocker.VerifyAll()
+
+    def test_main_batch(self):
+        self.mocker.StubOutWithMock(pyviews.base_io, "LineReader")
+        sin = object()
+        sout = object()
+
+        sys.stdin.fileno().AndReturn(1234)
+        pyviews.base_io.LineReader(1234).AndReturn(sin)
+        sys.stdout.fileno().AndReturn(7890)
+        os.fdopen(7890, 'w', 1).AndReturn(sout)
+
+        pyviews.NamedPythonViewServer(sin, sout, batch=64, codec="json",
+                                      map_workers=4, list_flush_bytes=4096,
+                                      list_flush_rows=100, filter_workers=2,
+                                      ddoc_cache_size=10,
+                                      ddoc_cache_bytes=100000,
+                                      rereduce_cache_size=50, profiler=None,
+                                      recorder=None,
+                                      modules_loaded=mox.IsA(float))\
+                .AndReturn(self.vs)
+        self.vs.run()
+
+        self.mocker.ReplayAll()
+
+        sys.argv = ["couch-named-python", "--batch", "64", "--json", "json",
+                    "--map-workers", "4", "--list-flush-bytes", "4096",
+                    "--list-flush-rows", "100", "--rereduce-cache", "50",
+                    "--filter-workers", "2", "--ddoc-cache-size", "10",
+                    "--ddoc-cache-bytes", "100000"]
+        main()
+        self.mocker.VerifyAll()
+
+    def test_main_preload(self):
+        sin = object()
+        sout = object()
+        self.mocker.StubOutWithMock(pyviews, "read_manifest")
+
+        sys.stdin.fileno().AndReturn(1234)
+        os.fdopen(1234, 'r', 1).AndReturn(sin)
+        sys.stdout.fileno().AndReturn(7890)
+        os.fdopen(7890, 'w', 1).AndReturn(sout)
+
+        pyviews.NamedPythonViewServer(sin, sout, batch=0, codec=None,
+                                      map_workers=0, list_flush_bytes=0,
+                                      list_flush_rows=0, filter_workers=0,
+                                      ddoc_cache_size=None,
+                                      ddoc_cache_bytes=None,
+                                      rereduce_cache_size=0, profiler=None,
+                                      recorder=None,
+                                      modules_loaded=mox.IsA(float))\
+                .AndReturn(self.vs)
+        pyviews.read_manifest("manifest.txt").AndReturn(["c.f|2"])
+        self.vs.preload(["a.f", "b.g|1", "c.f|2"])
+        self.vs.codec = StdlibCodec()
+        self.vs.log(EqIfIn('"modules":{'))
+        self.vs.run()
+
+        self.mocker.ReplayAll()
+
+        sys.argv = ["couch-named-python", "--preload", "a.f",
+                    "--preload", "b.g|1", "--manifest", "manifest.txt",
+                    "--startup-profile"]
+        main()
+        self.mocker.VerifyAll()
+
+    def test_main_serve(self):
+        from .. import zygote
+        self.mocker.StubOutWithMock(zygote, "serve")
+
+        pyviews.NamedPythonViewServer(None, sys.stdout, batch=0, codec=None,
+                                      map_workers=0, list_flush_bytes=0,
+                                      list_flush_rows=0, filter_workers=0,
+                                      ddoc_cache_size=None,
+                                      ddoc_cache_bytes=None,
+                                      rereduce_cache_size=0, profiler=None,
+                                      recorder=None,
+                                      modules_loaded=mox.IsA(float))\
+                .AndReturn(self.vs)
+        self.vs.preload(["a.f"])
+        zygote.serve("/tmp/sock", mox.IsA(types.FunctionType))
+
+        self.mocker.ReplayAll()
+
+        sys.argv = ["couch-named-python", "--serve", "/tmp/sock",
+                    "--preload", "a.f"]
+        main()
+        self.mocker.VerifyAll()
+
+    def test_main_binary_io(self):
+        self.mocker.StubOutWithMock(pyviews.base_io, "LineReader")
+        self.mocker.StubOutWithMock(pyviews.base_io, "BufferedWriter")
+        sout = self.mocker.CreateMock(pyviews.base_io.BufferedWriter)
+        sin = object()
+
+        sys.stdout.fileno().AndReturn(7890)
+        pyviews.base_io.BufferedWriter(7890).AndReturn(sout)
+        sys.stdin.fileno().AndReturn(1234)
+        pyviews.base_io.LineReader(1234, before_block=sout.flush)\
+                .AndReturn(sin)
+
+        pyviews.NamedPythonViewServer(sin, sout, batch=0, codec=None,
+                                      map_workers=0, list_flush_bytes=0,
+                                      list_flush_rows=0, filter_workers=0,
+                                      ddoc_cache_size=None,
+                                      ddoc_cache_bytes=None,
+                                      rereduce_cache_size=0, profiler=None,
+                                      recorder=None,
+                                      modules_loaded=mox.IsA(float))\
+                .AndReturn(self.vs)
+        self.vs.run().AndRaise(SystemExit(1))
+        sout.flush()
+
+        self.mocker.ReplayAll()
+
+        sys.argv = ["couch-named-python", "--binary-io"]
+        try:
+            main()
+        except SystemExit:
+            pass
+        else:
+            raise AssertionError("Expected SystemExit")
+        self.mocker.VerifyAll()
+
+    def test_main_profile(self):
+        import signal
+        from .. import profiler as profiler_module
+        self.mocker.StubOutWithMock(signal, "signal")
+        self.mocker.StubOutWithMock(signal, "siginterrupt")
+        self.mocker.StubOutWithMock(profiler_module, "Profiler")
+        profiler = self.mocker.CreateMock(profiler_module.Profiler)
+        sin = object()
+        sout = object()
+
+        sys.stdin.fileno().AndReturn(1234)
+        os.fdopen(1234, 'r', 1).AndReturn(sin)
+        sys.stdout.fileno().AndReturn(7890)
+        os.fdopen(7890, 'w', 1).AndReturn(sout)
+
+        filename = "/tmp/profile-{0}.json".format(os.getpid())
+        profiler_module.Profiler(filename, 60.0).AndReturn(profiler)
+        signal.signal(signal.SIGUSR1, profiler.request_report)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        pyviews.NamedPythonViewServer(sin, sout, batch=0, codec=None,
+                                      map_workers=0, list_flush_bytes=0,
+                                      list_flush_rows=0, filter_workers=0,
+                                      ddoc_cache_size=None,
+                                      ddoc_cache_bytes=None,
+                                      rereduce_cache_size=0,
+                                      profiler=profiler, recorder=None,
+                                      modules_loaded=mox.IsA(float))\
+                .AndReturn(self.vs)
+        self.vs.run()
+
+        self.mocker.ReplayAll()
+
+        sys.argv = ["couch-named-python", "--profile",
+                    "/tmp/profile-{pid}.json", "--profile-interval", "60"]
+        main()
+        self.mocker.VerifyAll()
+
+    def test_main_record(self):
+        from .. import recorder as recorder_module
+        self.mocker.StubOutWithMock(recorder_module, "Recorder")
+        sin = object()
+        sout = object()
+        recorder = object()
+
+        sys.stdin.fileno().AndReturn(1234)
+        os.fdopen(1234, 'r', 1).AndReturn(sin)
+        sys.stdout.fileno().AndReturn(7890)
+        os.fdopen(7890, 'w', 1).AndReturn(sout)
+
+        filename = "/tmp/cnp-{0}.gz".format(os.getpid())
+        recorder_module.Recorder(filename, 0.25, ["email", "name"], 120.0) \
+                .AndReturn(recorder)
+        pyviews.NamedPythonViewServer(sin, sout, batch=0, codec=None,
+                                      map_workers=0, list_flush_bytes=0,
+                                      list_flush_rows=0, filter_workers=0,
+                                      ddoc_cache_size=None,
+                                      ddoc_cache_bytes=None,
+                                      rereduce_cache_size=0, profiler=None,
+                                      recorder=recorder,
+                                      modules_loaded=mox.IsA(float))\
+                .AndReturn(self.vs)
         self.vs.run()
 
         self.mocker.ReplayAll()
 
+        sys.argv = ["couch-named-python", "--record", "/tmp/cnp-{pid}.gz",
+                    "--record-sample", "0.25", "--record-redact", "email",
+                    "--record-redact", "name", "--record-duration", "120"]
         main()
         self.mocker.VerifyAll()
+
+class TestStartup(object):
+    def test_lazy_imports(self):
+        # modules for optional features are imported only when used
+        package_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+        code = ("import sys, couch_named_python.pyviews; "
+                "print ' '.join(n for (n, m) in sys.modules.items() if m)")
+        process = subprocess.Popen([sys.executable, "-c", code],
+                                   stdout=subprocess.PIPE, cwd=package_dir)
+        modules = set(process.communicate()[0].split())
+        assert process.returncode == 0
+        assert "couch_named_python.pyviews" in modules
+        for name in ["json", "hashlib", "cPickle", "gzip", "random",
+                     "couch_named_python.zygote",
+                     "couch_named_python.profiler",
+                     "couch_named_python.recorder"]:
+            assert name not in modules, name
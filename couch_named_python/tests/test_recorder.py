@@ -0,0 +1,96 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import os
+import json
+import gzip
+import shutil
+import random
+import tempfile
+from StringIO import StringIO
+
+from .. import bench
+from ..recorder import Recorder, redact
+
+class TestRecorder(object):
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "transcript.gz")
+        self.random = random.random
+
+    def teardown(self):
+        random.random = self.random
+        shutil.rmtree(self.tempdir)
+
+    def records(self):
+        with gzip.open(self.filename) as f:
+            return [json.loads(line) for line in f]
+
+    def test_record_and_replay(self):
+        commands = bench.make_transcript(docs=10, funcs=2, batch=5)
+        data = "".join(json.dumps(c) + "\n" for c in commands)
+        stdout = StringIO()
+        vs = bench.ReplayViewServer(StringIO(data), stdout,
+                                    recorder=Recorder(self.filename))
+        vs.run()
+
+        records = self.records()
+        assert [r[2] for r in records if r[1] == "in"] == commands
+        assert [r[2] for r in records if r[1] == "out"] == \
+                [json.loads(line) for line in stdout.getvalue().splitlines()]
+        assert all(isinstance(r[0], float) for r in records)
+        assert bench.read_transcript(self.filename) == commands
+
+    def test_sample(self):
+        choices = iter([0.5, 0.1, 0.9])
+        random.random = lambda: next(choices)
+
+        r = Recorder(self.filename, sample=0.2)
+        r.record_in('["reset"]\n', ["reset"])
+        r.record_out('true\n')
+        r.record_in('["map_doc",{"a":1}]\n', ["map_doc", {"a": 1}])
+        r.record_out('[[]]\n')
+        r.record_in('["map_doc",{"a":2}]\n', ["map_doc", {"a": 2}])
+        r.record_in('["map_doc",{"a":3}]\n', ["map_doc", {"a": 3}],
+                    continued=True)
+        r.record_out('[[]]\n[[]]\n')
+        r.record_in('["ddoc","d",["lists","l"],[{},{}]]\n',
+                    ["ddoc", "d", ["lists", "l"], [{}, {}]])
+        r.record_out('["start",[],{}]\n')
+        r.record_in('["list_row",{}]\n', ["list_row", {}])
+        r.record_in('["list_end"]\n', ["list_end"])
+        r.record_out('["end",[]]\n')
+        r.record_in('["ddoc","new","d",{}]\n', ["ddoc", "new", "d", {}])
+        r.close()
+
+        assert [r[1:] for r in self.records()] == [
+            ["in", ["reset"]], ["out", True],
+            ["in", ["map_doc", {"a": 2}]], ["in", ["map_doc", {"a": 3}]],
+            ["out", [[]]], ["out", [[]]],
+            ["in", ["ddoc", "new", "d", {}]]]
+
+    def test_redact(self):
+        doc = {"_id": "a", "email": "someone@example.com",
+               "friends": [{"email": "other@example.com", "n": 1}]}
+        hidden = redact(["map_doc", doc], set(["email"]))
+        assert hidden[1]["_id"] == "a"
+        assert hidden[1]["friends"][0]["n"] == 1
+        assert hidden[1]["email"].startswith("redacted:")
+        assert hidden[1]["email"] != hidden[1]["friends"][0]["email"]
+        assert hidden[1]["email"] == \
+                redact(doc, set(["email"]))["email"]
+        assert doc["email"] == "someone@example.com"
+
+        r = Recorder(self.filename, redact=["email"])
+        r.record_in(json.dumps(["map_doc", doc]), ["map_doc", doc])
+        r.record_out('[[["someone@example.com",1]]]\n')
+        r.close()
+
+        assert [r[1:] for r in self.records()] == [["in", hidden]]
+
+    def test_duration(self):
+        r = Recorder(self.filename, duration=0)
+        r.record_in('["reset"]\n', ["reset"])
+        r.record_out('true\n')
+        r.close()
+
+        assert not os.path.exists(self.filename)
@@ -0,0 +1,127 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import json
+from StringIO import StringIO
+
+from .. import get_version, is_pure
+from .. import reducers
+from ..pyviews import NamedPythonViewServer
+
+def keys_for(ks):
+    return [[k, "docid" + str(i)] for (i, k) in enumerate(ks)]
+
+class TestReducers(object):
+    def test_versions(self):
+        for name in ["sum", "count", "stats", "hll_distinct", "topk"]:
+            assert get_version(getattr(reducers, name)) == 1
+            assert is_pure(getattr(reducers, name))
+
+    def test_sum(self):
+        assert reducers.sum(keys_for("abc"), [1, 2, 3.5], False) == 6.5
+        assert reducers.sum(None, [6.5, 1], True) == 7.5
+        assert reducers.sum(keys_for("ab"), [[1, 2], [3, 4, 5]], False) \
+                == [4, 6, 5]
+        assert reducers.sum(None, [[4, 6, 5], [1]], True) == [5, 6, 5]
+
+        try:
+            reducers.sum(keys_for("ab"), [[1, 2], 3], False)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("Expected TypeError")
+
+    def test_count(self):
+        assert reducers.count(keys_for("abc"), [None, 4, "x"], False) == 3
+        assert reducers.count(None, [3, 5], True) == 8
+
+    def test_stats(self):
+        a = reducers.stats(keys_for("abc"), [1, 5, -2], False)
+        assert a == {"sum": 4, "count": 3, "min": -2, "max": 5, "sumsqr": 30}
+        b = reducers.stats(keys_for("d"), [10], False)
+        c = reducers.stats(None, [a, b], True)
+        assert c == {"sum": 14, "count": 4, "min": -2, "max": 10,
+                     "sumsqr": 130}
+
+    def test_hll_distinct(self):
+        f = reducers.hll_distinct
+        keys = [[i % 1000, "x"] for i in xrange(3000)]
+
+        a = f(keys[:1500], None, False)
+        b = f(keys[1500:], None, False)
+        assert a["p"] == 7
+        assert abs(a["count"] - 1000) < 200
+        assert "sparse" not in a and len(a["registers"]) == 128
+
+        c = f(None, [a, b], True)
+        assert abs(c["count"] - 1000) < 200
+        assert c == f(keys, None, False)
+
+        small = f([["a", "1"], ["b", "2"], ["a", "3"], [["c", 1], "4"]],
+                  None, False)
+        assert small["count"] == 3
+        assert "registers" not in small and len(small["sparse"]) == 12
+
+        # merging sparse and dense sketches
+        d = f(None, [small, f(keys[:6], None, False)], True)
+        assert d["count"] == 9 and "sparse" in d
+        assert f(None, [a, small], True) == \
+                f(keys[:1500] + [["a", "5"], ["b", "6"], [["c", 1], "7"]],
+                  None, False)
+
+        g = reducers.make_hll_distinct(12)
+        e = g(keys, None, False)
+        assert e["p"] == 12
+        assert abs(e["count"] - 1000) < 50
+        assert g(None, [g(keys[:1500], None, False), e], True) == e
+
+        try:
+            f(None, [a, e], True)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected ValueError")
+
+    def test_hll_distinct_reduce_limit(self):
+        name = "couch_named_python.reducers.hll_distinct|1"
+        rows = [[["user{0}".format(i), "doc{0}".format(i)], None]
+                for i in xrange(100)]
+        commands = [["reset", {"reduce_limit": True}],
+                    ["reduce", [name], rows[:50]],
+                    ["reduce", [name], rows[50:]],
+                    ["reduce", [name], rows[:3]]]
+        outputs = self.run_commands(commands)
+        assert outputs[0] is True
+        results = []
+        for (ok, [r]) in outputs[1:]:
+            assert ok is True
+            results.append(r)
+        assert abs(results[0]["count"] - 50) < 10
+        assert results[2]["count"] == 3
+
+        # rereducing sketches of different keys can't shrink their size
+        # by half, but the output is small enough not to be checked
+        [(ok, [r])] = self.run_commands([["rereduce", [name], results]],
+                                        {"reduce_limit": True})
+        assert ok is True
+        assert abs(r["count"] - 100) < 20
+
+    def run_commands(self, commands, config=None):
+        stdin = StringIO("".join(json.dumps(c) + "\n" for c in commands))
+        stdout = StringIO()
+        vs = NamedPythonViewServer(stdin, stdout)
+        if config:
+            vs.reset(config, silent=True)
+        vs.run()
+        return [json.loads(l) for l in stdout.getvalue().splitlines()]
+
+    def test_topk(self):
+        values = ["a"] * 5 + ["b"] * 3 + ["c"] * 3 + ["d"] * 20
+        top = reducers.topk(keys_for(values), values, False)
+        assert top == [["d", 20], ["a", 5], ["b", 3], ["c", 3]]
+
+        top2 = reducers.make_topk(2)
+        assert top2.__name__ == "topk"
+        a = top2(None, values, False)
+        assert a == [["d", 20], ["a", 5]]
+        b = top2(None, ["b"] * 30, False)
+        assert top2(None, [a, b], True) == [["b", 30], ["d", 20]]
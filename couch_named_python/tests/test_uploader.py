@@ -4,10 +4,12 @@ import sys
 import mox
 import couchdbkit
 from copy import deepcopy
+from StringIO import StringIO
 import __builtin__
 
 from .. import uploader
-from ..uploader import generate_doc, upload, main
+from ..uploader import generate_doc, diff_docs, upload, main
+from .fakecouch import FakeCouch
 
 mod = "couch_named_python.tests.example_mod_c"
 
@@ -57,6 +59,11 @@ class TestUploader(object):
     def teardown(self):
         self.m.UnsetStubs()
 
+        if hasattr(self, 'couch'):
+            self.couch.stop()
+        if hasattr(self, 'old_stdout'):
+            sys.stdout = self.old_stdout
+
         if hasattr(self, 'old_argv'):
             sys.argv = self.old_argv
         if hasattr(uploader, 'open'):
@@ -72,7 +79,9 @@ class TestUploader(object):
                    "properview": {"map": m("pmap"), "reduce": m("pred")},
                    "sumreduce": {"map": m("pmap"), "reduce": "_sum"},
                    "countreduce": {"map": m("pmap"), "reduce": "_count"},
-                   "statsreduce": {"map": m("pmap"), "reduce": "_stats"}},
+                   "statsreduce": {"map": m("pmap"), "reduce": "_stats"},
+                   "approxreduce": {"map": m("pmap"),
+                                    "reduce": "_approx_count_distinct"}},
                "validate_doc_update": m("validate")}
         expect = {"_id": "_design/mydesign", "language": "python",
                "shows": {"show1": m("s_one"), "show2": m("s_two")},
@@ -83,7 +92,9 @@ class TestUploader(object):
                   "properview": {"map": m("pmap|5"), "reduce": m("pred|100")},
                    "sumreduce": {"map": m("pmap|5"), "reduce": "_sum"},
                    "countreduce": {"map": m("pmap|5"), "reduce": "_count"},
-                   "statsreduce": {"map": m("pmap|5"), "reduce": "_stats"}},
+                   "statsreduce": {"map": m("pmap|5"), "reduce": "_stats"},
+                   "approxreduce": {"map": m("pmap|5"),
+                                    "reduce": "_approx_count_distinct"}},
                "validate_doc_update": m("validate|100")}
 
         # generate_doc modifies the dict in-place
@@ -91,20 +102,137 @@ class TestUploader(object):
         generate_doc("mydesign", tmp)
         assert tmp == expect
 
+        # and without importing anything
+        tmp = deepcopy(doc)
+        generate_doc("mydesign", tmp, static=True)
+        assert tmp == expect
+
+    def capture_stdout(self):
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO()
+        return sys.stdout
+
+    def test_diff_docs(self):
+        views = {"one": {"map": "m.a|1"}, "two": {"map": "m.b|1"}}
+        docs = [{"_id": "_design/new", "views": deepcopy(views)},
+                {"_id": "_design/same", "views": deepcopy(views)},
+                {"_id": "_design/shows", "views": deepcopy(views),
+                 "shows": {"s": "m.s|2"}},
+                {"_id": "_design/views", "views": deepcopy(views),
+                 "language": "python"},
+                {"_id": "_design/noviews", "shows": {"s": "m.s|2"}}]
+        existing = {
+            "_design/same": {"_id": "_design/same", "_rev": "1-a",
+                             "views": deepcopy(views)},
+            "_design/shows": {"_id": "_design/shows", "_rev": "2-b",
+                              "views": deepcopy(views),
+                              "shows": {"s": "m.s|1"}},
+            "_design/views": {"_id": "_design/views", "_rev": "3-c",
+                              "views": {"one": {"map": "m.a|1"},
+                                        "two": {"map": "m.b|0"}},
+                              "language": "python"}}
+
+        (changed, invalidated) = diff_docs(docs, existing)
+
+        assert [d["_id"] for d in changed] == \
+                ["_design/new", "_design/shows", "_design/views",
+                 "_design/noviews"]
+        assert "_rev" not in docs[0] and "_rev" not in docs[4]
+        assert docs[2]["_rev"] == "2-b" and docs[3]["_rev"] == "3-c"
+        assert invalidated == {"_design/new": ["one", "two"],
+                               "_design/views": ["one", "two"]}
+
     def test_uploads(self):
-        self.m.StubOutWithMock(uploader, 'couchdbkit')
-        self.mock_server = self.m.CreateMock(couchdbkit.Server)
-        self.mock_db = self.m.CreateMock(couchdbkit.Database)
-        uploader.couchdbkit.Server("http://server:port")\
-                .AndReturn(self.mock_server)
-        self.mock_server.__getitem__("database").AndReturn(self.mock_db)
+        self.couch = FakeCouch()
+        self.couch.put("database", {"_id": "_design/one",
+                                    "views": {"v": {"map": "m.a|1"}}})
+        self.couch.put("database", {"_id": "_design/two",
+                                    "views": {"v": {"map": "m.a|1"}}})
+        stdout = self.capture_stdout()
+
+        docs = [{"_id": "_design/one", "views": {"v": {"map": "m.a|1"}}},
+                {"_id": "_design/two", "views": {"v": {"map": "m.a|2"}}},
+                {"_id": "_design/three", "shows": {"s": "m.s|1"}}]
+        invalidated = upload(self.couch.url, "database", deepcopy(docs))
+
+        assert invalidated == {"_design/two": ["v"]}
+        assert stdout.getvalue() == \
+                "_design/one: unchanged\n" \
+                "_design/two: updated; building views v\n" \
+                "_design/three: created\n"
+
+        # one request to fetch, and one to save
+        assert self.couch.requests == [("POST", "/database/_all_docs"),
+                                       ("POST", "/database/_bulk_docs")]
+        stored = self.couch.dbs["database"]
+        assert stored["_design/one"]["_rev"].startswith("1-")
+        assert stored["_design/two"]["_rev"].startswith("2-")
+        assert stored["_design/two"]["views"] == docs[1]["views"]
+        assert stored["_design/three"]["shows"] == docs[2]["shows"]
+
+        # nothing to do the second time around
+        del self.couch.requests[:]
+        assert upload(self.couch.url, "database", deepcopy(docs)) == {}
+        assert self.couch.requests == [("POST", "/database/_all_docs")]
+
+    def test_staged_upload(self):
+        self.couch = FakeCouch()
+        self.couch.build_polls = 2
+        old_views = {"v": {"map": "m.a|1"}, "w": {"map": "m.b|1"}}
+        new_views = {"v": {"map": "m.a|2"}, "w": {"map": "m.b|1"}}
+        self.couch.put("database", {"_id": "_design/a", "views": old_views})
+        self.couch.put("database", {"_id": "_design/b",
+                                    "shows": {"s": "m.s|1"}})
+        # left over from an earlier attempt
+        self.couch.put("database", {"_id": "_design/a-staging",
+                                    "views": old_views})
+        stdout = self.capture_stdout()
+
+        docs = [{"_id": "_design/a", "views": new_views},
+                {"_id": "_design/b", "shows": {"s": "m.s|2"}}]
+        upload(self.couch.url, "database", deepcopy(docs), staged=True,
+               poll_interval=0)
+
+        assert stdout.getvalue() == \
+                "_design/a: updated; building views v, w\n" \
+                "_design/b: updated\n" \
+                "Waiting for the index of _design/a-staging\n"
 
-        docs = [{"_id": "design/one"}, {"_id": "design/two"}]
-        self.mock_db.save_doc(docs[0], force_update=True)
-        self.mock_db.save_doc(docs[1], force_update=True)
+        info = ("GET", "/database/_design/a-staging/_info")
+        assert self.couch.requests == [
+            ("POST", "/database/_all_docs"),
+            ("POST", "/database/_all_docs"),
+            ("POST", "/database/_bulk_docs"),
+            ("GET", "/database/_design/a-staging/_view/v"),
+            info, info, info,
+            ("GET", "/database/_design/a-staging/_view/v"),
+            ("POST", "/database/_bulk_docs"),
+            ("POST", "/database/_bulk_docs")]
+        assert self.couch.view_queries == \
+                [("_design/a-staging", "v", "update_after"),
+                 ("_design/a-staging", "v", None)]
 
+        stored = self.couch.dbs["database"]
+        assert sorted(stored) == ["_design/a", "_design/b"]
+        assert stored["_design/a"]["views"] == new_views
+        assert stored["_design/b"]["shows"] == {"s": "m.s|2"}
+
+    def test_upload_conflict(self):
+        self.couch = FakeCouch()
+        self.capture_stdout()
+        self.m.StubOutWithMock(uploader, 'fetch_docs')
+        uploader.fetch_docs(mox.IgnoreArg(), ["_design/one"]).AndReturn({})
         self.m.ReplayAll()
-        upload("http://server:port", "database", docs)
+
+        self.couch.put("database", {"_id": "_design/one"})
+        try:
+            upload(self.couch.url, "database",
+                   [{"_id": "_design/one", "shows": {"s": "m.s|1"}}])
+        except couchdbkit.BulkSaveError:
+            pass
+        else:
+            raise AssertionError("Expected BulkSaveError")
+
         self.m.VerifyAll()
 
     def test_main(self):
@@ -130,22 +258,40 @@ class TestUploader(object):
         assert hasattr(uploader, 'open')
         assert hasattr(self, 'old_argv')
 
-        sys.argv = ["prog", "http://server:5984", "database2",
+        self.couch = FakeCouch(["database2"])
+        self.capture_stdout()
+        sys.argv = ["prog", self.couch.url, "database2",
                     "file1.yml", "file2.yml"]
 
-        self.m.StubOutWithMock(uploader, 'couchdbkit')
-        self.mock_server = self.m.CreateMock(couchdbkit.Server)
-        self.mock_db = self.m.CreateMock(couchdbkit.Database)
-        uploader.couchdbkit.Server("http://server:5984")\
-                .AndReturn(self.mock_server)
-        self.mock_server.__getitem__("database2").AndReturn(self.mock_db)
+        main()
 
-        self.mock_db.save_doc(main_docs[0], force_update=True).InAnyOrder()
-        self.mock_db.save_doc(main_docs[1], force_update=True).InAnyOrder()
-        self.mock_db.save_doc(main_docs[2], force_update=True).InAnyOrder()
+        stored = self.couch.dbs["database2"]
+        assert sorted(stored) == [doc["_id"] for doc in main_docs]
+        for doc in main_docs:
+            doc = dict(doc, _rev=stored[doc["_id"]]["_rev"])
+            assert stored[doc["_id"]] == doc
 
-        self.m.ReplayAll()
+    def test_main_manifest(self):
+        class F(object):
+            def __enter__(self):
+                return ymlfile_b
+            def __exit__(self, *args):
+                pass
 
-        main()
+        uploader.open = lambda x: F()
+        self.old_argv = sys.argv
+        sys.argv = ["prog", "--manifest", "manifest.txt",
+                    "http://server:5984", "database2", "file2.yml"]
 
+        self.m.StubOutWithMock(uploader, 'write_manifest')
+        self.m.StubOutWithMock(uploader, 'upload')
+        uploader.write_manifest("manifest.txt", mox.SameElementsAs(
+            [mod + ".s_one",
+             mod + ".u_one|5", mod + ".f_one|2", mod + ".f_two|2",
+             mod + ".validate|100"]))
+        uploader.upload("http://server:5984", "database2", mox.IgnoreArg(),
+                        staged=False, poll_interval=5)
+
+        self.m.ReplayAll()
+        main()
         self.m.VerifyAll()
@@ -0,0 +1,147 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import os
+import sys
+import shutil
+import tempfile
+
+from .. import get_version, reducers
+from .. import versions
+from ..versions import static_version, find_source, scan, Unresolved
+from ..uploader import append_version
+from . import example_mod_c
+
+heavy_source = """
+from couch_named_python import version, pure
+import couch_named_python as cnp
+from .helpers import helper as renamed
+from . import helpers
+
+raise ImportError("this module must not be imported")
+
+@version(3)
+def a(doc):
+    pass
+
+@pure
+@cnp.version(4)
+def b(keys, values, rereduce):
+    pass
+
+c = pure(version(5)(b))
+d = c
+
+def e(doc):
+    pass
+
+@version(2 + 1)
+def f(doc):
+    pass
+
+if True:
+    @version(7)
+    def g(doc):
+        pass
+
+@something_else
+@version(8)
+def h(doc):
+    pass
+"""
+
+helpers_source = """
+from couch_named_python import version
+
+@version(9)
+def helper(doc):
+    pass
+
+N = 10
+
+@version(N)
+def not_literal(doc):
+    return N
+"""
+
+class TestVersions(object):
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.package = os.path.join(self.tempdir, "cnp_versions_pkg")
+        os.mkdir(self.package)
+        self.write("__init__.py", "")
+        self.write("heavy.py", heavy_source)
+        self.write("helpers.py", helpers_source)
+        sys.path.insert(0, self.tempdir)
+
+    def teardown(self):
+        sys.path.remove(self.tempdir)
+        for name in list(sys.modules):
+            if name.startswith("cnp_versions_pkg"):
+                del sys.modules[name]
+        shutil.rmtree(self.tempdir)
+
+    def write(self, filename, source):
+        with open(os.path.join(self.package, filename), "w") as f:
+            f.write(source)
+
+    def test_scan(self):
+        names = scan(heavy_source, "cnp_versions_pkg.heavy")
+        assert names["a"] == ("version", 3)
+        assert names["b"] == ("version", 4)
+        assert names["c"] == ("version", 5)
+        assert names["d"] == ("alias", "c")
+        assert names["e"] == ("version", None)
+        assert names["renamed"] == \
+                ("import", "cnp_versions_pkg.helpers", "helper")
+        assert names["helpers"] == ("import", "cnp_versions_pkg", "helpers")
+        for name in ["f", "g", "h", "cnp"]:
+            assert names[name] == ("unknown", )
+
+    def test_static_version(self):
+        m = "cnp_versions_pkg.heavy"
+        assert find_source(m) == os.path.join(self.package, "heavy.py")
+        assert static_version(m, "a") == 3
+        assert static_version(m, "d") == 5
+        assert static_version(m, "e") is None
+        assert static_version(m, "renamed") == 9
+        assert "cnp_versions_pkg" not in sys.modules
+
+        for name in ["f", "g", "h", "helpers", "missing"]:
+            try:
+                static_version(m, name)
+            except Unresolved:
+                pass
+            else:
+                raise AssertionError("Expected Unresolved for " + name)
+
+        assert find_source("cnp_versions_pkg.nonexistent") is None
+        assert find_source("cnp_versions_pkg.heavy.a") is None
+
+    def test_matches_import(self):
+        mod = "couch_named_python.tests.example_mod_c"
+        for name in ["f", "g", "s_one", "l_two", "pmap", "validate"]:
+            assert static_version(mod, name) == \
+                    get_version(getattr(example_mod_c, name))
+
+        for name in ["sum", "count", "stats", "hll_distinct", "topk"]:
+            assert static_version("couch_named_python.reducers", name) == \
+                    get_version(getattr(reducers, name))
+
+    def test_cache(self):
+        m = "cnp_versions_pkg.helpers"
+        filename = find_source(m)
+        assert static_version(m, "helper") == 9
+        assert versions._cache[filename][1]["helper"] == ("version", 9)
+
+        self.write("helpers.py", helpers_source.replace("(9)", "(11)"))
+        os.utime(filename, (1000, 1000))
+        assert static_version(m, "helper") == 11
+
+    def test_append_version_fallback(self):
+        m = "cnp_versions_pkg.helpers"
+        assert append_version(m + ".helper", static=True) == m + ".helper|9"
+        assert m not in sys.modules
+
+        assert append_version(m + ".not_literal", static=True) == \
+                m + ".not_literal|10"
+        assert m in sys.modules
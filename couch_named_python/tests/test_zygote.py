@@ -0,0 +1,156 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+import mox
+import os
+import sys
+import time
+import signal
+import socket
+import shutil
+import tempfile
+
+from .. import zygote, pyviews
+from ..bench import BenchViewServer
+
+commands = '["reset"]\n["add_fun","map_yield"]\n' \
+           '["map_doc",{"_id":"a","n":1,"type":"t"}]\n'
+responses = 'true\ntrue\n[[["a",1],[["t",1],null]]]\n'
+
+class TestSplice(object):
+    def setup(self):
+        (self.stdin_r, self.stdin_w) = os.pipe()
+        (self.stdout_r, self.stdout_w) = os.pipe()
+        (self.sock, self.peer) = socket.socketpair()
+
+    def teardown(self):
+        for fd in [self.stdin_r, self.stdout_r, self.stdout_w]:
+            os.close(fd)
+        self.sock.close()
+        self.peer.close()
+
+    def test_splice(self):
+        os.write(self.stdin_w, commands)
+        os.close(self.stdin_w)
+        self.peer.sendall(responses)
+        self.peer.shutdown(socket.SHUT_WR)
+
+        assert zygote.splice(self.sock, self.stdin_r, self.stdout_w)
+        assert os.read(self.stdout_r, 4096) == responses
+        assert self.peer.recv(4096) == commands
+
+    def test_server_exits_first(self):
+        self.peer.sendall('["error","x","y"]\n')
+        self.peer.shutdown(socket.SHUT_WR)
+
+        assert not zygote.splice(self.sock, self.stdin_r, self.stdout_w)
+        assert os.read(self.stdout_r, 4096) == '["error","x","y"]\n'
+        os.close(self.stdin_w)
+
+class TestChild(object):
+    def test_child(self):
+        (conn, peer) = socket.socketpair()
+        peer.sendall(commands)
+        peer.shutdown(socket.SHUT_WR)
+
+        assert zygote._child(conn, BenchViewServer) == 0
+        conn.close()
+        assert peer.recv(4096) == responses
+        peer.close()
+
+    def test_child_exit_status(self):
+        (conn, peer) = socket.socketpair()
+        peer.sendall('["no_such_command"]\n')
+        peer.shutdown(socket.SHUT_WR)
+
+        assert zygote._child(conn, BenchViewServer) == 1
+        conn.close()
+        assert peer.recv(4096).startswith('["log",')
+        peer.close()
+
+class TestServe(object):
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "cnp.sock")
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                zygote.serve(self.path, BenchViewServer)
+            finally:
+                os._exit(1)
+
+    def teardown(self):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        shutil.rmtree(self.tempdir)
+
+    def connect(self):
+        for i in range(500):
+            sock = zygote.connect(self.path)
+            if sock is not None:
+                return sock
+            time.sleep(0.01)
+        raise AssertionError("daemon did not start")
+
+    def test_serve(self):
+        for i in range(2):
+            sock = self.connect()
+            sock.sendall(commands)
+            sock.shutdown(socket.SHUT_WR)
+
+            received = []
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                received.append(data)
+            sock.close()
+
+            assert "".join(received) == responses
+
+class TestClientMain(object):
+    def setup(self):
+        self.mocker = mox.Mox()
+        self.sys_argv = sys.argv
+        self.mocker.StubOutWithMock(zygote, "connect")
+        self.mocker.StubOutWithMock(zygote, "splice")
+        self.mocker.StubOutWithMock(pyviews, "main")
+
+    def teardown(self):
+        sys.argv = self.sys_argv
+        self.mocker.UnsetStubs()
+
+    def test_no_zygote(self):
+        pyviews.main()
+        self.mocker.ReplayAll()
+
+        sys.argv = ["couch-named-python", "--batch", "10"]
+        zygote.client_main()
+        assert sys.argv == ["couch-named-python", "--batch", "10"]
+        self.mocker.VerifyAll()
+
+    def test_zygote(self):
+        sock = object()
+        zygote.connect("/tmp/sock").AndReturn(sock)
+        zygote.splice(sock).AndReturn(True)
+        self.mocker.ReplayAll()
+
+        sys.argv = ["couch-named-python", "--zygote", "/tmp/sock"]
+        try:
+            zygote.client_main()
+        except SystemExit as e:
+            assert e.code == 0
+        else:
+            raise AssertionError("Expected sys.exit(0)")
+        self.mocker.VerifyAll()
+
+    def test_fallback(self):
+        zygote.connect("/tmp/sock").AndReturn(None)
+        pyviews.main()
+        self.mocker.ReplayAll()
+
+        sys.argv = ["couch-named-python", "--batch", "10",
+                    "--zygote", "/tmp/sock", "--binary-io"]
+        zygote.client_main()
+        assert sys.argv == ["couch-named-python", "--batch", "10",
+                            "--binary-io"]
+        self.mocker.VerifyAll()
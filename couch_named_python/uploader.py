@@ -31,18 +31,22 @@ the uploader will import the modules and append them.
 """
 
 import sys
+import time
 import yaml
 import optparse
 import couchdbkit
 
 from . import get_version
+from .manifest import builtin_reduces, design_doc_functions, write_manifest
+from .versions import static_version, Unresolved
 
-def append_version(function):
+def append_version(function, static=False):
     """
     appends |{version} to a module.module.function path
 
     This will import the function using the same method as pyviews, get
-    the version and append the suffix.
+    the version and append the suffix. If static, the version is found
+    by reading the module's source (see versions.py) if possible, instead.
     """
     assert '|' not in function
 
@@ -52,9 +56,18 @@ def append_version(function):
     module = '.'.join(parts[:-1])
     name = parts[-1]
 
-    __import__(module)
-    f = getattr(sys.modules[module], name)
-    f_ver = get_version(f)
+    resolved = False
+    if static:
+        try:
+            f_ver = static_version(module, name)
+            resolved = True
+        except Unresolved:
+            pass
+
+    if not resolved:
+        __import__(module)
+        f = getattr(sys.modules[module], name)
+        f_ver = get_version(f)
 
     if f_ver != None:
         suffix = '|' + str(f_ver)
@@ -63,11 +76,11 @@ def append_version(function):
 
     return function + suffix
 
-def generate_doc(name, doc, view_server="python"):
+def generate_doc(name, doc, view_server="python", static=False):
     """
     Prepares a loaded design doc for upload
 
-     - appends versions to function names
+     - appends versions to function names (see append_version)
      - transforms short-hand map-only views
 
     This function modifies the design doc in place.
@@ -77,10 +90,11 @@ def generate_doc(name, doc, view_server="python"):
         if func_type in doc:
             section = doc[func_type]
             for key in section:
-                section[key] = append_version(section[key])
+                section[key] = append_version(section[key], static)
 
     if "validate_doc_update" in doc:
-        doc["validate_doc_update"] = append_version(doc["validate_doc_update"])
+        doc["validate_doc_update"] = \
+                append_version(doc["validate_doc_update"], static)
 
     if "views" in doc:
         views = doc["views"]
@@ -92,10 +106,11 @@ def generate_doc(name, doc, view_server="python"):
                 view = views[key]
 
             if "map" in view:
-                view["map"] = append_version(view["map"])
+                view["map"] = append_version(view["map"], static)
             if "reduce" in view:
-                if view["reduce"] not in ["_sum", "_count", "_stats"]:
-                    view["reduce"] = append_version(view["reduce"])
+                if view["reduce"] not in builtin_reduces:
+                    view["reduce"] = append_version(view["reduce"],
+                                                    static)
 
             u = set(view) - set(["map", "reduce"])
             if u:
@@ -111,19 +126,162 @@ def generate_doc(name, doc, view_server="python"):
     doc["_id"] = "_design/" + name
     doc["language"] = view_server
 
-def upload(server, db, docs):
-    """upload all docs to couch, overwriting existing"""
+def fetch_docs(db, doc_ids):
+    """get the current versions of doc_ids, in one request, as a dict"""
+    existing = {}
+    for row in db.all_docs(keys=doc_ids, include_docs=True):
+        if row.get("doc") is not None:
+            existing[row["id"]] = row["doc"]
+    return existing
+
+def index_fields(doc):
+    """the parts of a design doc that its view index depends on"""
+    return (doc.get("language"), doc.get("views"), doc.get("options"))
+
+def diff_docs(docs, existing):
+    """
+    compare generated design docs with the existing ones (from fetch_docs)
+
+    Returns (changed, invalidated). changed is the docs that are new or
+    differ, with _rev set to replace the existing version; invalidated
+    maps the _id of each of those whose views CouchDB will have to build
+    from scratch to the names of the views. CouchDB indexes the views of
+    a design doc together, so changing one rebuilds all of them.
+    """
+
+    changed = []
+    invalidated = {}
+
+    for doc in docs:
+        old = existing.get(doc["_id"])
+        if old is not None:
+            old = dict(old)
+            rev = old.pop("_rev")
+            if old == doc:
+                continue
+            doc["_rev"] = rev
+
+        changed.append(doc)
+
+        views = sorted(v for v in doc.get("views", {}) if v != "lib")
+        if views and (old is None or index_fields(old) != index_fields(doc)):
+            invalidated[doc["_id"]] = views
+
+    return (changed, invalidated)
+
+def staging_id(doc_id):
+    return doc_id + "-staging"
+
+def build_staged(db, docs, invalidated, poll_interval=5):
+    """
+    upload docs as _design/<name>-staging, and wait for their indexes
+
+    Since a design doc's index is identified by a signature of its views,
+    once the build completes the live design doc can be replaced with the
+    same content, and CouchDB will use the finished index. Returns the
+    staging docs, which should be deleted afterwards.
+    """
+
+    staging = []
+    for doc in docs:
+        doc = dict(doc, _id=staging_id(doc["_id"]))
+        doc.pop("_rev", None)
+        staging.append(doc)
+
+    # left over from an interrupted deploy?
+    existing = fetch_docs(db, [doc["_id"] for doc in staging])
+    for doc in staging:
+        if doc["_id"] in existing:
+            doc["_rev"] = existing[doc["_id"]]["_rev"]
+    db.bulk_save(staging)
+
+    # start every build before waiting for any of them
+    views = []
+    for (doc, live) in zip(staging, docs):
+        name = doc["_id"][len("_design/"):]
+        views.append(name + "/" + invalidated[live["_id"]][0])
+        db.view(views[-1], limit=0, stale="update_after").fetch()
+
+    for (doc, view) in zip(staging, views):
+        print "Waiting for the index of " + doc["_id"]
+        wait_for_index(db, doc["_id"], poll_interval)
+        # returns when the index is up to date (immediately, hopefully)
+        db.view(view, limit=0).fetch()
+
+    return staging
+
+def wait_for_index(db, doc_id, poll_interval=5):
+    """poll a design doc's _info until its index isn't being updated"""
+    while True:
+        info = db.res.get(doc_id + "/_info").json_body
+        if not info["view_index"]["updater_running"]:
+            return
+        time.sleep(poll_interval)
+
+def upload(server, db, docs, staged=False, poll_interval=5):
+    """
+    upload docs to couch in one request, skipping those that are unchanged
+
+    Prints what happened to each doc, and which views will be rebuilt. If
+    staged, views are built (see build_staged) before the design docs
+    that need them are replaced, so that queries don't wait for them.
+    """
     server = couchdbkit.Server(server)
     db = server[db]
 
+    existing = fetch_docs(db, [doc["_id"] for doc in docs])
+    (changed, invalidated) = diff_docs(docs, existing)
+    changed_ids = set(doc["_id"] for doc in changed)
+
     for doc in docs:
-        db.save_doc(doc, force_update=True)
+        if doc["_id"] not in changed_ids:
+            status = "unchanged"
+        elif doc["_id"] in existing:
+            status = "updated"
+        else:
+            status = "created"
+        if doc["_id"] in invalidated:
+            status += "; building views " + \
+                      ", ".join(invalidated[doc["_id"]])
+        print doc["_id"] + ": " + status
+
+    staging = []
+    if staged and invalidated:
+        staging = build_staged(db, [doc for doc in changed
+                                    if doc["_id"] in invalidated],
+                               invalidated, poll_interval)
+
+    if changed:
+        db.bulk_save(changed)
+
+    if staging:
+        db.delete_docs(staging)
+
+    return invalidated
 
 usage = "%prog [options] couch_uri couch_db file.yml [file2.yml ...]"
 oparser = optparse.OptionParser(usage=usage)
 oparser.add_option("--view-server", dest="view_server", default="python",
                    metavar="VS",
                    help="The name by which couch knows the view server")
+oparser.add_option("--manifest", dest="manifest", default=None,
+                   metavar="FILE",
+                   help="Also write a startup manifest, listing every "
+                        "function, to FILE (see couch-named-python "
+                        "--manifest)")
+oparser.add_option("--static-versions", dest="static", action="store_true",
+                   default=False,
+                   help="Find @version decorators by reading the source of "
+                        "modules, only importing them if that fails")
+oparser.add_option("--staged", dest="staged", action="store_true",
+                   default=False,
+                   help="Build the views of changed design docs under "
+                        "_design/<name>-staging before replacing the live "
+                        "ones, so that queries don't wait for them")
+oparser.add_option("--poll-interval", dest="poll_interval", type="float",
+                   default=5, metavar="SECONDS",
+                   help="With --staged, how often to check whether the "
+                        "views have been built")
 
 def main():
     """
@@ -147,7 +305,13 @@ def main():
             data = yaml.load(f)
 
         for name in data:
-            generate_doc(name, data[name], options.view_server)
+            generate_doc(name, data[name], options.view_server,
+                         options.static)
             docs.append(data[name])
 
-    upload(server, db, docs)
+    if options.manifest:
+        write_manifest(options.manifest,
+                       [f for doc in docs for f in design_doc_functions(doc)])
+
+    upload(server, db, docs, staged=options.staged,
+           poll_interval=options.poll_interval)
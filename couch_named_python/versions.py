@@ -0,0 +1,255 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+"""
+Finding function versions without importing their modules.
+
+cnp-upload normally imports each module to read a function's @version,
+which can be slow if the module imports a lot. static_version() instead
+finds the module's source file, parses it with ast, and looks for
+
+    @version(3)
+    def func(doc): ...
+
+    func = version(3)(make_func())
+    other_name = func
+    from other.module import func
+
+at the top level of the module. The results for each file are cached
+until its modification time changes. If the version can't be worked out
+this way (e.g., the argument to version isn't a number, or the function
+is defined inside an if statement), it raises Unresolved; append_version
+then imports the module as usual.
+"""
+
+import os
+import imp
+import ast
+
+class Unresolved(Exception):
+    """the version of a function can't be found without importing it"""
+
+_cache = {}
+
+_unknown = ("unknown", )
+_no_version = ("version", None)
+
+def static_version(module, name):
+    """the version of module.name, or None if it has none"""
+    return _resolve(module, name, 0)
+
+def _resolve(module, name, depth):
+    if depth > 10:
+        raise Unresolved("Too many imports to follow")
+
+    filename = find_source(module)
+    if filename is None:
+        raise Unresolved("Can't find the source of " + module)
+
+    entry = scan_file(filename, module).get(name, _unknown)
+
+    seen = set()
+    while entry[0] == "alias":
+        if entry[1] in seen:
+            raise Unresolved("Circular assignments in " + module)
+        seen.add(entry[1])
+        entry = scan_file(filename, module).get(entry[1], _unknown)
+
+    if entry[0] == "version":
+        return entry[1]
+    elif entry[0] == "import":
+        return _resolve(entry[1], entry[2], depth + 1)
+    else:
+        raise Unresolved("Can't work out the version of {0}.{1}"
+                         .format(module, name))
+
+def find_source(module):
+    """the .py file for module (without importing it), or None"""
+    path = None
+    filename = None
+
+    for part in module.split("."):
+        if filename is not None:
+            # the previous part wasn't a package
+            return None
+        try:
+            (f, pathname, (suffix, mode, kind)) = imp.find_module(part, path)
+        except ImportError:
+            return None
+        if f is not None:
+            f.close()
+
+        if kind == imp.PKG_DIRECTORY:
+            path = [pathname]
+        elif kind == imp.PY_SOURCE:
+            filename = pathname
+        else:
+            return None
+
+    if filename is None:
+        filename = os.path.join(path[0], "__init__.py")
+        if not os.path.exists(filename):
+            return None
+    return filename
+
+def scan_file(filename, module):
+    """scan(source of filename), cached until the file is modified"""
+    mtime = os.stat(filename).st_mtime
+    cached = _cache.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(filename) as f:
+        source = f.read()
+    is_package = os.path.basename(filename) == "__init__.py"
+    try:
+        names = scan(source, module, is_package)
+    except SyntaxError:
+        raise Unresolved("Can't parse " + filename)
+    _cache[filename] = (mtime, names)
+    return names
+
+def scan(source, module, is_package=False):
+    """
+    find what each name at the top level of a module's source refers to
+
+    Returns a dict mapping names to ("version", n) (n may be None),
+    ("alias", other_name), ("import", module, name) or ("unknown", ).
+    """
+
+    tree = ast.parse(source)
+    scanner = _Scanner(module, is_package)
+    for node in tree.body:
+        scanner.statement(node)
+    return scanner.names
+
+def _absolute(module, is_package, level, target):
+    """the absolute name of a module imported with from (.*level)target"""
+    if not level:
+        return target
+    parts = module.split(".")
+    if not is_package:
+        parts = parts[:-1]
+    if level > 1:
+        parts = parts[:-(level - 1)]
+    if target:
+        parts.append(target)
+    return ".".join(parts)
+
+class _Scanner(object):
+    package = "couch_named_python"
+
+    # decorators that return the function they are given
+    preserving = set(["version", "pure", "vectorized", "batch_filter"])
+
+    def __init__(self, module, is_package):
+        self.module = module
+        self.is_package = is_package
+        self.names = {}
+        self.package_attrs = {}
+        self.package_names = set()
+
+    def bind(self, name, entry):
+        self.names[name] = entry
+        self.package_attrs.pop(name, None)
+        self.package_names.discard(name)
+
+    def statement(self, node):
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            self.bind(node.name, self.decorated(node.decorator_list))
+        elif isinstance(node, ast.Assign):
+            entry = self.value(node.value)
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    self.bind(target.id, entry)
+                else:
+                    self.unknown(target)
+        elif isinstance(node, ast.ImportFrom):
+            self.import_from(node)
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                name = alias.asname or alias.name.split(".")[0]
+                self.bind(name, _unknown)
+                if name == self.package or alias.name == self.package:
+                    self.package_names.add(name)
+        else:
+            # names bound in if statements, loops, etc. can't be trusted
+            self.unknown(node)
+
+    def unknown(self, node):
+        """mark every name that node binds as unknown"""
+        for child in ast.walk(node):
+            if isinstance(child, (ast.FunctionDef, ast.ClassDef)):
+                self.bind(child.name, _unknown)
+            elif isinstance(child, ast.Name) and \
+                    isinstance(child.ctx, ast.Store):
+                self.bind(child.id, _unknown)
+            elif isinstance(child, (ast.Import, ast.ImportFrom)):
+                for alias in child.names:
+                    self.bind(alias.asname or alias.name.split(".")[0],
+                              _unknown)
+
+    def import_from(self, node):
+        source = _absolute(self.module, self.is_package, node.level,
+                           node.module)
+        for alias in node.names:
+            if alias.name == "*":
+                # anything might have been replaced
+                self.names = {}
+                self.package_attrs = {}
+                self.package_names = set()
+                continue
+            name = alias.asname or alias.name
+            self.bind(name, ("import", source, alias.name))
+            if source == self.package:
+                self.package_attrs[name] = alias.name
+
+    def package_attr(self, node):
+        """the name of the couch_named_python attribute node refers to"""
+        if isinstance(node, ast.Name):
+            return self.package_attrs.get(node.id)
+        if isinstance(node, ast.Attribute) and \
+                isinstance(node.value, ast.Name) and \
+                node.value.id in self.package_names:
+            return node.attr
+        return None
+
+    def version_call(self, node):
+        """
+        if node is a call to version(), ("version", n) (or _unknown if its
+        argument isn't a number); otherwise None
+        """
+        if not isinstance(node, ast.Call) or \
+                self.package_attr(node.func) != "version":
+            return None
+        if len(node.args) == 1 and not node.keywords and \
+                isinstance(node.args[0], ast.Num) and \
+                isinstance(node.args[0].n, (int, long)):
+            return ("version", node.args[0].n)
+        return _unknown
+
+    def decorated(self, decorators):
+        """what a function with these decorators will end up as"""
+        for decorator in decorators:
+            entry = self.version_call(decorator)
+            if entry is not None:
+                return entry
+            if self.package_attr(decorator) not in self.preserving:
+                # it might return anything
+                return _unknown
+        return _no_version
+
+    def value(self, node):
+        """what a name assigned node will refer to"""
+        if isinstance(node, ast.Name):
+            return ("alias", node.id)
+
+        # e.g., pure(version(1)(make_hll_distinct()))
+        while isinstance(node, ast.Call) and len(node.args) == 1:
+            entry = self.version_call(node.func)
+            if entry is not None:
+                return entry
+            if self.package_attr(node.func) not in self.preserving:
+                break
+            node = node.args[0]
+
+        return _unknown
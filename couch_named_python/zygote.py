@@ -0,0 +1,163 @@
+# Copyright 2011 (C) Daniel Richman; GNU GPL 3
+
+"""
+Warm view server processes, forked from a long-lived daemon.
+
+Start the daemon with the usual options, plus --serve:
+
+    couch-named-python --serve /var/run/cnp.sock --manifest manifest.txt
+
+It imports everything (and preloads the manifest) once, then listens on
+the Unix socket, forking a child view server for each connection. Then
+configure CouchDB to run
+
+    couch-named-python --zygote /var/run/cnp.sock
+
+which connects to the daemon and copies data between CouchDB and the
+child, so starts in a few milliseconds. If it can't connect, it runs the
+view server itself as normal (with its other options).
+"""
+
+import os
+import sys
+import errno
+import select
+import signal
+import socket
+
+def serve(path, make_server, backlog=128):
+    """
+    listen on the Unix socket path, forking a view server per connection
+
+    make_server(stdin, stdout) should return a view server; it is called
+    in the child, with stdin and stdout reading from and writing to the
+    connection. This function never returns.
+    """
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(backlog)
+
+    signal.signal(signal.SIGCHLD, _reap_children)
+
+    while True:
+        try:
+            (conn, address) = listener.accept()
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os._exit(_child(conn, make_server))
+
+        conn.close()
+
+def _reap_children(signum, frame):
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except OSError:
+        pass
+
+def _child(conn, make_server):
+    """run a view server on conn, returning the exit status"""
+    from .base_io import LineReader, BufferedWriter
+
+    fd = conn.fileno()
+    stdout = BufferedWriter(fd)
+    stdin = LineReader(fd, before_block=stdout.flush)
+
+    try:
+        try:
+            make_server(stdin, stdout).run()
+        finally:
+            stdout.flush()
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            return e.code
+        return 0 if e.code is None else 1
+    except:
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    return 0
+
+def connect(path):
+    """connect to a daemon's socket, or return None if it isn't running"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def _select(fds):
+    while True:
+        try:
+            return select.select(fds, [], [])[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+def splice(sock, stdin_fd=0, stdout_fd=1, read_size=65536):
+    """
+    copy stdin_fd to sock, and sock to stdout_fd, until sock is closed
+
+    Returns True if stdin reached end of file before sock was closed (i.e.,
+    the view server exited because CouchDB was finished with it).
+    """
+
+    fds = [stdin_fd, sock]
+
+    while True:
+        readable = _select(fds)
+
+        if stdin_fd in readable:
+            data = os.read(stdin_fd, read_size)
+            if data:
+                sock.sendall(data)
+            else:
+                sock.shutdown(socket.SHUT_WR)
+                fds.remove(stdin_fd)
+
+        if sock in readable:
+            data = sock.recv(read_size)
+            if not data:
+                return stdin_fd not in fds
+            while data:
+                data = data[os.write(stdout_fd, data):]
+
+def client_main():
+    """
+    main function for couch-named-python
+
+    With --zygote PATH, hands over to a daemon if one is listening on
+    PATH; otherwise (or if it isn't), runs pyviews.main.
+    """
+
+    args = sys.argv[1:]
+    if "--zygote" in args:
+        i = args.index("--zygote")
+        path = args[i + 1:i + 2]
+        if not path:
+            sys.stderr.write("--zygote option requires an argument\n")
+            sys.exit(2)
+        del args[i:i + 2]
+
+        sock = connect(path[0])
+        if sock is not None:
+            sys.exit(0 if splice(sock) else 1)
+
+        sys.argv[1:] = args
+
+    from .pyviews import main
+    main()